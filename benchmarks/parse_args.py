@@ -0,0 +1,70 @@
+# !/usr/bin/env python
+#
+# A logging and statistics bot for Telegram based on python-telegram-bot.
+# Copyright (C) 2020
+# Michael DM Dryden <mk.dryden@utoronto.ca>
+#
+# This file is part of telegram-stats-bot.
+#
+# telegram-stats-bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser Public License for more details.
+#
+# You should have received a copy of the GNU Public License
+# along with this program. If not, see [http://www.gnu.org/licenses/].
+"""
+Per command dispatch overhead of /stats: rebuilding the parser for every command (as before
+it was cached), parsing with the cached parser, and the lookup for invocations without
+options. No database is needed, only argument parsing is timed.
+
+    python benchmarks/parse_args.py
+"""
+import shlex
+import timeit
+
+import typer
+
+from telegram_stats_bot.stats import StatsRunner, build_parser, get_parser
+
+invocations = [
+    "",
+    "counts",
+    "hours",
+    "counts -n 200",
+    "hours -me -start 2024-01 -approx",
+    "search -lquery 'gato & preto' -start 2023",
+]
+
+
+class ParserRunner(StatsRunner):
+    def __init__(self):
+        pass
+
+
+def main(number: int = 2000):
+    """
+    :param number: Dispatches per measurement, the best of 5 is reported
+    """
+    runner = ParserRunner()
+    parser = get_parser(runner)
+
+    def best(fn) -> float:
+        return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+    print(f"{'invocation':50}{'rebuild µs':>12}{'cached µs':>12}{'fast path':>10}")
+    for invocation in invocations:
+        args = shlex.split(invocation)
+        rebuild = best(lambda: vars(build_parser(runner).parse_args(args)))
+        cached  = best(lambda: parser.parse_command(args))
+        fast    = "yes" if tuple(args) in parser.fast_paths else "no"
+        print(f"{'/stats ' + invocation:50}{rebuild:12.1f}{cached:12.1f}{fast:>10}")
+
+
+if __name__ == '__main__':
+    typer.run(main)
@@ -1,7 +1,7 @@
 from collections.abc import Mapping
 from datetime import datetime
 from typing import Any
-from sqlalchemy import Computed, Index
+from sqlalchemy import FetchedValue, Index
 from sqlalchemy.orm import Mapped, mapped_column
 from sqlalchemy.types import TIMESTAMP, BigInteger, Text
 from sqlalchemy.dialects.postgresql import TSVECTOR
@@ -25,8 +25,9 @@ class Message(Base):
     file_id:           Mapped[str]       = mapped_column(Text,       nullable=True)
     type:              Mapped[str]       = mapped_column(Text,       nullable=True)
 
-    text_index_col: Mapped[str] = mapped_column(TSVECTOR,
-        Computed("to_tsvector('english', coalesce(text, ''))"))
+    # Set by the messages_utc_text_index trigger, with the text search configuration in the
+    # column's comment (see text_search.py)
+    text_index_col: Mapped[str] = mapped_column(TSVECTOR, FetchedValue(), nullable=True)
 
     __table_args__: tuple[Any, ...] = (
         Index("text_idx", text_index_col, postgresql_using="gin"),
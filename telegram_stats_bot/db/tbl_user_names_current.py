@@ -0,0 +1,13 @@
+from datetime import datetime
+from sqlalchemy import TIMESTAMP, BigInteger, Text
+from sqlalchemy.orm import Mapped, mapped_column
+from telegram_stats_bot.db.base import Base
+
+class UserNameCurrent(Base):
+    # Latest row of user_names for each user, kept up to date by StatsRunner.update_user_ids
+    __tablename__: str = "user_names_current"
+
+    user_id:      Mapped[int]      = mapped_column(BigInteger, primary_key=True)
+    date:         Mapped[datetime] = mapped_column(TIMESTAMP(timezone=True), nullable=True)
+    username:     Mapped[str]      = mapped_column(Text,       nullable=True)
+    display_name: Mapped[str]      = mapped_column(Text,       nullable=True)
@@ -0,0 +1,256 @@
+# !/usr/bin/env python
+#
+# A logging and statistics bot for Telegram based on python-telegram-bot.
+# Copyright (C) 2020
+# Michael DM Dryden <mk.dryden@utoronto.ca>
+#
+# This file is part of telegram-stats-bot.
+#
+# telegram-stats-bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser Public License for more details.
+#
+# You should have received a copy of the GNU Public License
+# along with this program. If not, see [http://www.gnu.org/licenses/].
+"""
+Coordination of concurrent stats requests.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from io import BytesIO
+from typing import Any, AsyncIterator, Awaitable, Callable, Generic, Hashable, Optional, TypeVar
+
+from telegram_stats_bot.stats import StatsRunner, StatsRunnerResult
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class SingleFlight(Generic[T]):
+    """
+    Coalesces concurrent calls with the same key: the first caller starts the computation
+    and later callers wait for the same result until it finishes. Nothing is kept afterwards.
+    The computation is cancelled once every caller waiting on it has been cancelled.
+    """
+    def __init__(self):
+        self.calls:   dict[Hashable, asyncio.Future[T]] = {}
+        self.waiters: dict[Hashable, int] = {}
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        call = self.calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(fn())
+            self.calls[key]   = call
+            self.waiters[key] = 0
+            call.add_done_callback(lambda _: self.forget(key, call))
+        else:
+            logger.debug("Joining in-flight call %s", key)
+
+        self.waiters[key] += 1
+        try:
+            # A receiver being cancelled must not cancel the computation the others wait on
+            return await asyncio.shield(call)
+        except asyncio.CancelledError:
+            if self.calls.get(key) is call and self.waiters[key] == 1:
+                self.forget(key, call)  # Later callers start over instead of joining a cancelled call
+                _ = call.cancel()
+            raise
+        finally:
+            if self.calls.get(key) is call:
+                self.waiters[key] -= 1
+
+    def forget(self, key: Hashable, call: 'asyncio.Future[T]'):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+            del self.waiters[key]
+
+
+def freeze(value: Any) -> Hashable:
+    """Hashable, order independent version of parsed command arguments."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+class Overloaded(Exception):
+    def __init__(self, msg: str):
+        self.msg = msg
+        super().__init__(msg)
+
+
+class AdmissionController(object):
+    """
+    Limits the total cost of the stats computations running at once, overall and per user.
+    Requests that don't fit wait in a priority queue, cheapest first, so a few expensive
+    commands can't hold up the cheap ones. Requests are refused when the user already has
+    too much pending, when the queue is full or when they waited for too long.
+    """
+    def __init__(self, global_budget: int, user_budget: int, max_queue: int, max_wait: float):
+        self.global_budget = global_budget
+        self.user_budget   = user_budget
+        self.max_queue     = max_queue
+        self.max_wait      = max_wait
+
+        self.in_use = 0
+        self.user_in_use: defaultdict[int, int] = defaultdict(int)
+        self.queue: list[tuple[int, int, asyncio.Future[None]]] = []  # Heap of (cost, arrival, waiter)
+        self.arrivals = itertools.count()
+
+    def admit_queued(self):
+        while self.queue and self.in_use + self.queue[0][0] <= self.global_budget:
+            cost, _, waiter = heapq.heappop(self.queue)
+            if waiter.done():  # Gave up waiting
+                continue
+            self.in_use += cost
+            waiter.set_result(None)
+
+    def dequeue(self, waiter: 'asyncio.Future[None]'):
+        """Drops a waiter that gave up, so it doesn't count against max_queue until it reaches the front."""
+        self.queue = [entry for entry in self.queue if entry[2] is not waiter]
+        heapq.heapify(self.queue)
+        self.admit_queued()
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, cost: int,
+                   on_queued: Optional[Callable[[], Awaitable[Any]]] = None) -> AsyncIterator[Callable[[], None]]:
+        """
+        Holds cost of the global and of user_id's budget while in the context. It yields a function
+        giving the user's share back early, when work that can't be stopped goes on for a request
+        that was abandoned: the user's next request may start while the global share stays taken.
+        """
+        cost = min(cost, self.global_budget)
+        if self.user_in_use.get(user_id, 0) + cost > self.user_budget:
+            raise Overloaded("Você já tem estatísticas sendo calculadas, espere elas chegarem.")
+        if len(self.queue) >= self.max_queue:
+            raise Overloaded("Muitos pedidos agora, tente de novo daqui a pouco.")
+
+        self.user_in_use[user_id] += cost
+        waiter: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (cost, next(self.arrivals), waiter))
+        self.admit_queued()
+
+        try:
+            if not waiter.done():
+                if on_queued:
+                    _ = await on_queued()
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+                except asyncio.TimeoutError:
+                    raise Overloaded("Muitos pedidos agora, tente de novo daqui a pouco.")
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():  # Admitted just as we gave up
+                self.in_use -= cost
+                self.admit_queued()
+            else:
+                _ = waiter.cancel()
+                self.dequeue(waiter)
+            self.release_user(user_id, cost)
+            raise
+
+        user_charged = True
+
+        def release_user_early():
+            nonlocal user_charged
+            if user_charged:
+                user_charged = False
+                self.release_user(user_id, cost)
+
+        try:
+            yield release_user_early
+        finally:
+            self.in_use -= cost
+            release_user_early()
+            self.admit_queued()
+
+    def release_user(self, user_id: int, cost: int):
+        self.user_in_use[user_id] -= cost
+        if not self.user_in_use[user_id]:
+            del self.user_in_use[user_id]
+
+
+# Relative cost of each /stats command, by how hard it hits the database and the renderer
+command_costs: dict[str, int] = {
+    'ecdf':    2,
+    'hours':   2,
+    'days':    2,
+    'week':    2,
+    'history': 2,
+    'types':   2,
+    'delta':   3,
+    'corr':    4,
+    'words':   4,
+    'search':  2,
+}
+method_costs = {method: command_costs.get(name, 1) for name, method in StatsRunner.allowed_methods.items()}
+
+stats_flights: SingleFlight[Any] = SingleFlight()
+admission = AdmissionController(global_budget=8, user_budget=4, max_queue=32, max_wait=60)
+
+
+async def run_method(func: Callable[..., T], args: dict[str, Any], user_id: int,
+                     on_queued: Optional[Callable[[], Awaitable[Any]]] = None,
+                     method: Optional[str] = None) -> T:
+    """
+    Runs a StatsRunner method in a worker thread once admitted, sharing the call with identical
+    concurrent requests, which don't count against any budget. Its queries run with the
+    method's statement timeout and are cancelled if every requester goes away.
+    :param user_id: User charged for the call
+    :param on_queued: Awaited if the call has to wait for capacity
+    :param method: Command method func works for, whose cost and timeout apply, func by default
+    :raises Overloaded: The call was refused, the message can be shown to the user
+    """
+    runner: StatsRunner = getattr(func, '__self__')
+    method = method or func.__name__
+
+    async def compute() -> T:
+        async with admission.slot(user_id, method_costs.get(method, 1), on_queued) as release_user_early:
+            with runner.scoped(method) as scope:
+                worker = asyncio.ensure_future(asyncio.to_thread(func, **args))
+                try:
+                    return await asyncio.shield(worker)
+                except asyncio.CancelledError:  # Nobody waits for the result anymore
+                    scope.cancel()
+                    # A replacing request from the user may start, but the thread can't be
+                    # interrupted, so it keeps its global share until its queries give up
+                    release_user_early()
+                    while not worker.done():
+                        try:
+                            _ = await asyncio.wait([worker])
+                        except asyncio.CancelledError:
+                            pass
+                    if not worker.cancelled():
+                        _ = worker.exception()
+                    raise
+
+    key = func.__name__, freeze(args)
+    return await stats_flights.run(key, compute)
+
+
+async def run_stats(func: Callable[..., StatsRunnerResult], args: dict[str, Any], user_id: int,
+                    on_queued: Optional[Callable[[], Awaitable[Any]]] = None) -> StatsRunnerResult:
+    """
+    run_method for the /stats commands. Every receiver gets its own copy of an encoded image,
+    since uploading consumes it.
+    """
+    text, md, image = await run_method(func, args, user_id, on_queued)
+
+    if isinstance(image, BytesIO):
+        copy = BytesIO(image.getvalue())
+        copy.name = image.name
+        image = copy
+    return text, md, image
@@ -0,0 +1,272 @@
+# !/usr/bin/env python
+#
+# A logging and statistics bot for Telegram based on python-telegram-bot.
+# Copyright (C) 2020
+# Michael DM Dryden <mk.dryden@utoronto.ca>
+#
+# This file is part of telegram-stats-bot.
+#
+# telegram-stats-bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser Public License for more details.
+#
+# You should have received a copy of the GNU Public License
+# along with this program. If not, see [http://www.gnu.org/licenses/].
+import datetime
+import json
+import logging
+import os
+from typing import Any, Iterator, Optional
+
+import typer
+from sqlalchemy import Column, Engine, Table, create_engine, func, select
+from sqlalchemy.types import TIMESTAMP, BigInteger, Integer
+
+from telegram_stats_bot.db.tbl_messages import Message
+from telegram_stats_bot.db.tbl_user_events import UserEvent
+from telegram_stats_bot.db.tbl_user_names import UserName
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+export_tables: dict[str, Table] = {
+    'messages_utc': Message.__table__,   # pyright: ignore[reportAssignmentType]
+    'user_events':  UserEvent.__table__, # pyright: ignore[reportAssignmentType]
+    'user_names':   UserName.__table__,  # pyright: ignore[reportAssignmentType]
+}
+
+excluded_columns = {'text_index_col'}
+
+file_suffixes = {
+    'parquet': '.parquet',
+    'arrow':   '.arrow',
+}
+
+
+def arrow_type(column: Column[Any]) -> 'pa.DataType':
+    if isinstance(column.type, (BigInteger, Integer)):
+        return pa.int64()
+    if isinstance(column.type, TIMESTAMP):
+        return pa.timestamp('us', tz='UTC')
+    return pa.string()
+
+
+def month_start(date: datetime.datetime) -> datetime.datetime:
+    return date.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(date: datetime.datetime) -> datetime.datetime:
+    if date.month == 12:
+        return month_start(date).replace(year=date.year + 1, month=1)
+    return month_start(date).replace(month=date.month + 1)
+
+
+def month_ranges(start: datetime.datetime, end: datetime.datetime) -> Iterator[tuple[datetime.datetime, datetime.datetime]]:
+    """Yields [lo, hi) ranges covering start to end, split on month boundaries."""
+    lo = start
+    while lo < end:
+        hi = next_month(lo)
+        yield lo, min(hi, end)
+        lo = hi
+
+
+def manifest_path(path: str) -> str:
+    """Manifest of a partition file, dataset readers ignore files starting with an underscore."""
+    return os.path.join(os.path.dirname(path), f"_{os.path.basename(path)}.json")
+
+
+def read_manifest(path: str) -> Optional[dict[str, Any]]:
+    try:
+        with open(manifest_path(path)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_manifest(path: str, manifest: dict[str, Any]):
+    path = manifest_path(path)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def is_complete(manifest: Optional[dict[str, Any]], month: datetime.datetime, columns: list[str]) -> bool:
+    """Whether a partition's manifest says it holds the whole month, written after it ended, with these columns."""
+    if manifest is None or manifest.get('columns') != columns:
+        return False
+    lo, hi, written_at = (datetime.datetime.fromisoformat(manifest[key]) for key in ('start', 'end', 'written_at'))
+    return lo <= month and hi >= next_month(month) and written_at >= next_month(month)
+
+
+class PartitionWriter(object):
+    """Writes record batches to a temporary file that replaces path when closed."""
+    def __init__(self, path: str, schema: 'pa.Schema', fmt: str):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if fmt == 'parquet':
+            self.writer = pq.ParquetWriter(self.tmp_path, schema, compression='zstd')
+        else:
+            self.writer = pa.ipc.new_file(self.tmp_path, schema)
+
+    def write(self, batch: 'pa.RecordBatch'):
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+        os.replace(self.tmp_path, self.path)
+
+
+def export_table(
+    engine:     Engine,
+    table:      Table,
+    out_dir:    str,
+    columns:    Optional[list[str]]        = None,
+    start:      Optional[datetime.datetime] = None,
+    end:        Optional[datetime.datetime] = None,
+    fmt:        str                         = 'parquet',
+    batch_rows: int                         = 50000,
+    overwrite:  bool                        = False,
+) -> list[str]:
+    """
+    Exports a table into monthly partitions ``{out_dir}/{table}/month=YYYY-MM/part-0.{fmt}``.
+    Rows are streamed through a server-side cursor batch_rows at a time. Partitions are written
+    under a temporary name and renamed when complete, then a manifest next to them records the
+    date range and columns they hold. A partition is skipped unless overwrite is set if its
+    manifest covers the whole month with the same columns and was written after the month
+    ended, so interrupted or nightly exports only redo the missing, partial and still open
+    months. Rows without a date are not exported.
+    :return: Paths of the partitions written
+    """
+    if pa is None:
+        raise ImportError("Exporting requires the pyarrow package (pip install telegram-stats-bot[export])")
+
+    selected = [c for c in table.columns if c.name not in excluded_columns and (not columns or c.name in columns)]
+    date_col = table.columns['date']
+    if date_col not in selected:
+        selected.insert(0, date_col)  # Partition key is always exported
+
+    schema = pa.schema([pa.field(c.name, arrow_type(c)) for c in selected])
+
+    if start is None or end is None:
+        with engine.connect() as con:
+            first, last = con.execute(select(func.min(date_col), func.max(date_col))).one()
+        if first is None:
+            return []
+        first = first if first.tzinfo else first.replace(tzinfo=datetime.timezone.utc)
+        start = start or month_start(first)  # Nothing is older, so the first month counts as whole
+        end   = end or last + datetime.timedelta(microseconds=1)
+    assert start is not None and end is not None
+    start, end = (d if d.tzinfo else d.replace(tzinfo=datetime.timezone.utc) for d in (start, end))
+    column_names = [c.name for c in selected]
+
+    written: list[str] = []
+
+    for lo, hi in month_ranges(start, end):
+        path = os.path.join(out_dir, table.name, f"month={lo:%Y-%m}", f"part-0{file_suffixes[fmt]}")
+        if not overwrite and os.path.exists(path) and is_complete(read_manifest(path), month_start(lo), column_names):
+            continue
+
+        query = (select(*selected)
+            .where(date_col >= lo, date_col < hi)
+            .order_by(date_col)
+        )
+
+        written_at = datetime.datetime.now(datetime.timezone.utc)
+        writer = PartitionWriter(path, schema, fmt)
+        with engine.connect() as con:
+            con = con.execution_options(stream_results=True, yield_per=batch_rows)
+            for rows in con.execute(query).partitions():
+                arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+                writer.write(pa.record_batch(arrays, schema=schema))
+        writer.close()
+        write_manifest(path, {
+            'start':      lo.isoformat(),
+            'end':        hi.isoformat(),
+            'columns':    column_names,
+            'written_at': written_at.isoformat(),  # Rows logged later than this may be missing
+        })
+
+        written.append(path)
+        logger.info("Exported %s %s", table.name, path)
+
+    return written
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime.datetime]:
+    if not value:
+        return None
+    date = datetime.datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date
+
+
+def main(
+    db_url:     str,
+    out_dir:    str,
+    tables:     str  = ",".join(export_tables),
+    columns:    str  = "",
+    start:      str  = "",
+    end:        str  = "",
+    fmt:        str  = 'parquet',
+    batch_rows: int  = 50000,
+    overwrite:  bool = False,
+):
+    """
+    Export tables to monthly Parquet or Arrow IPC partitions.
+    :param db_url: Sqlalchemy-compatible postgresql url
+    :param out_dir: Output directory
+    :param tables: Comma separated tables to export (messages_utc, user_events, user_names)
+    :param columns: Comma separated columns to export from each table (default all), date is always included
+    :param start: Start timestamp (e.g. 2019-01-01, "2019-01-01 14:21"), UTC
+    :param end: End timestamp (e.g. 2019-01-01, "2019-01-01 14:21"), UTC
+    :param fmt: 'parquet' or 'arrow'
+    :param batch_rows: Rows fetched and written per batch
+    :param overwrite: Rewrite partitions even if they are complete
+    """
+    logging.basicConfig(level=logging.INFO)
+
+    if fmt not in file_suffixes:
+        raise typer.BadParameter(f"fmt must be one of {list(file_suffixes)}")
+
+    table_names = [t.strip() for t in tables.split(',') if t.strip()]
+    unknown = set(table_names) - set(export_tables)
+    if unknown:
+        raise typer.BadParameter(f"Unknown tables {sorted(unknown)}")
+
+    column_names = [c.strip() for c in columns.split(',') if c.strip()]
+    known = {c.name for name in table_names for c in export_tables[name].columns}
+    if set(column_names) - known:
+        raise typer.BadParameter(f"Unknown columns {sorted(set(column_names) - known)}")
+
+    if db_url.startswith('postgresql://'):
+        db_url = db_url.replace('postgresql://', 'postgresql+psycopg://', 1)
+    engine = create_engine(db_url, echo=False)
+
+    for name in table_names:
+        export_table(engine, export_tables[name], out_dir,
+            columns    = column_names,
+            start      = parse_date(start),
+            end        = parse_date(end),
+            fmt        = fmt,
+            batch_rows = batch_rows,
+            overwrite  = overwrite,
+        )
+
+
+if __name__ == '__main__':
+    typer.run(main)
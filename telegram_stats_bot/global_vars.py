@@ -2,6 +2,7 @@ from os import PathLike
 from typing import Any, Optional
 
 from telegram_stats_bot.log_storage import JSONStore, PostgresStore
+from telegram_stats_bot.utils import NameCache
 
 
 stats:      Optional[Any] = None
@@ -9,3 +10,4 @@ other_path: Optional[PathLike[str]] = None
 chat_id:    int = 0
 store:      Optional[PostgresStore] = None
 bak_store:  Optional[JSONStore]     = None
+name_cache: Optional[NameCache]     = None
@@ -8,7 +8,7 @@ from . import decorator
 def load_handlers(application: Application[Any, Any, Any, Any, Any, Any]):
     decorator.application = application
 
-    allowed_prefixes = [ "cmd_", "msg_", "job_" ]
+    allowed_prefixes = [ "cmd_", "msg_", "job_", "cbq_" ]
 
     for module in os.listdir(os.path.dirname(__file__)):
         if module[:4] not in allowed_prefixes or module[-3:] != ".py":
@@ -0,0 +1,64 @@
+import logging
+
+import telegram
+from telegram import Update
+from telegram.error import BadRequest
+from telegram.ext import ContextTypes
+
+from telegram_stats_bot import stats_loader
+from telegram_stats_bot.handlers.decorator import callback_query
+
+logger = logging.getLogger(__name__)
+
+
+# Callback data is "pager:token:page", see paging.page_buttons
+@callback_query(pattern=r"^\w+:[0-9a-f]+:\d+$", block=False)
+async def turn_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    stats = await stats_loader.get_stats()
+    query = update.callback_query
+
+    # Imported with the stats engine, see stats_loader
+    from telegram_stats_bot.dispatch import Overloaded
+    from telegram_stats_bot.paging import pagers_by_name
+    from telegram_stats_bot.stats import HelpException
+
+    assert query != None
+    assert query.data != None
+
+    if query.from_user.id not in stats.users:
+        _ = await query.answer()
+        return
+
+    name, token, index = query.data.split(':')
+    pager = pagers_by_name.get(name)
+    if pager is None:
+        _ = await query.answer()
+        return
+
+    try:
+        reply = await pager.turn(token, int(index), query.from_user.id)
+    except (HelpException, Overloaded) as e:
+        _ = await query.answer(text=e.msg, show_alert=True)
+        return
+    except IndexError:
+        reply = None
+
+    if reply is None:
+        _ = await query.answer(text="Essa página expirou, peça de novo.", show_alert=True)
+        try:
+            _ = await query.edit_message_reply_markup(reply_markup=None)
+        except BadRequest:
+            pass
+        return
+
+    text, markup = reply
+    _ = await query.answer()
+    try:
+        _ = await query.edit_message_text(
+            text         = text,
+            reply_markup = markup,
+            parse_mode   = telegram.constants.ParseMode.MARKDOWN_V2
+        )
+    except BadRequest as e:  # Same page clicked twice
+        if "not modified" not in str(e):
+            raise
@@ -1,19 +1,34 @@
 import argparse
+import asyncio
+import logging
 import shlex
-from typing import Callable 
+from typing import TYPE_CHECKING, Any, Callable
 from telegram import Update
 import telegram
+from telegram.constants import ChatAction
 from telegram.ext import ContextTypes
 
-from telegram_stats_bot import global_vars
+from telegram_stats_bot import stats_loader
 from telegram_stats_bot.handlers.decorator import command
-from telegram_stats_bot.stats import HelpException, get_parser
 
-@command(["stats", "s"])
+if TYPE_CHECKING:
+    from telegram_stats_bot.stats import StatsRunnerResult
+
+logger = logging.getLogger(__name__)
+
+chat_action_interval = 4.5  # Telegram shows an action for 5 s
+
+running: dict[tuple[int, int], asyncio.Task[None]] = {}  # (chat id, user id) -> request being answered
+
+
+# Doesn't block, so other updates (and message logging) go on while stats are computed
+@command(["stats", "s"], block=False)
 async def command_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    stats = global_vars.stats
+    stats = await stats_loader.get_stats()
+
+    # Imported with the stats engine, see stats_loader
+    from telegram_stats_bot.stats import HelpException, get_parser
 
-    assert stats != None
     assert update.effective_user != None
     assert context.args != None
 
@@ -21,10 +36,9 @@ async def command_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
 
     stats_parser = get_parser(stats)
-    image = None
 
     try:
-        ns = stats_parser.parse_args(shlex.split(" ".join(context.args)))
+        args = stats_parser.parse_command(shlex.split(" ".join(context.args)))
     except HelpException as e:
         text = e.msg
         assert text != None
@@ -35,8 +49,7 @@ async def command_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await send_help(text, context, update)
         return
     else:
-        args = vars(ns)
-        func: Callable[..., tuple[str, bool, str]] = args.pop('func')
+        func: Callable[..., 'StatsRunnerResult'] = args.pop('func')
 
         try:
             if args['user']:
@@ -56,29 +69,95 @@ async def command_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         except KeyError:
             pass
 
+        assert update.effective_chat != None
+        key = update.effective_chat.id, update.effective_user.id
+
+        # A new request from the same user replaces the one still running
+        previous = running.get(key)
+        if previous and not previous.done():
+            _ = previous.cancel()
+
+        task = asyncio.create_task(reply_stats(update, context, func, args))
+        running[key] = task
         try:
-            text, md, image = func(**args)
+            await task
+        except asyncio.CancelledError:
+            logger.debug("Stats request from %s replaced", update.effective_user.id)
+        finally:
+            if running.get(key) is task:
+                del running[key]
+
+
+async def keep_chat_action(context: ContextTypes.DEFAULT_TYPE, chat_id: int, action: str):
+    while True:
+        try:
+            _ = await context.bot.send_chat_action(chat_id=chat_id, action=action)
+        except telegram.error.TelegramError:
+            return
+        await asyncio.sleep(chat_action_interval)
+
+
+async def reply_stats(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                      func: Callable[..., 'StatsRunnerResult'], args: dict[str, Any]):
+    """
+    Runs a stats method off the event loop, shared with identical requests in flight, showing
+    a chat action meanwhile. Text is sent as soon as the query is done and the plot follows once
+    encoded. Paged commands get their first page, with buttons to turn pages.
+    """
+    stats = await stats_loader.get_stats()
+
+    from telegram_stats_bot.dispatch import Overloaded, run_stats
+    from telegram_stats_bot.paging import pagers
+    from telegram_stats_bot.stats import DeferredImage, HelpException, defer_images
+
+    assert update.effective_chat != None
+    assert update.effective_user != None
+    assert update.effective_message != None
+    assert context.args != None
+
+    plots  = {stats.allowed_methods[name] for name in stats.plot_methods}
+    action = ChatAction.UPLOAD_PHOTO if func.__name__ in plots else ChatAction.TYPING
+    indicator = asyncio.create_task(keep_chat_action(context, update.effective_chat.id, action))
+
+    try:
+        _ = defer_images.set(True)  # Only affects this task and the threads it starts
+        async def queued():
+            return await update.effective_message.reply_text(text="Muita gente pedindo estatísticas, seu pedido está na fila.")
+
+        pager = pagers.get(func.__name__)
+        try:
+            if pager:
+                text, markup = await pager.open(func, args, update.effective_user.id, queued)
+                _ = await update.effective_message.reply_text(text=text, reply_markup=markup,
+                                                              parse_mode=telegram.constants.ParseMode.MARKDOWN_V2)
+                return
+            text, md, image = await run_stats(func, args, update.effective_user.id, queued)
         except HelpException as e:
             text = e.msg
             assert text != None
 
             await send_help(text, context, update)
             return
+        except Overloaded as e:
+            _ = await update.effective_message.reply_text(text=e.msg)
+            return
 
-    if image:
-        assert update.effective_message != None
-        _ = await update.effective_message.reply_photo(
-            caption    = '`' + " ".join(context.args) + '`',
-            photo      = image,
-            parse_mode = telegram.constants.ParseMode.MARKDOWN_V2
-        )
-        
-    if text:
-        assert update.effective_message != None
-        if md == False:
-            _ = await update.effective_message.reply_text(text=text)
-        else:
-            _ = await update.effective_message.reply_text(text=text, parse_mode=telegram.constants.ParseMode.MARKDOWN_V2)
+        if text:
+            if md == False:
+                _ = await update.effective_message.reply_text(text=text)
+            else:
+                _ = await update.effective_message.reply_text(text=text, parse_mode=telegram.constants.ParseMode.MARKDOWN_V2)
+
+        if image:
+            if isinstance(image, DeferredImage):
+                image = await asyncio.to_thread(image.render)
+            _ = await update.effective_message.reply_photo(
+                caption    = '`' + " ".join(context.args) + '`',
+                photo      = image,
+                parse_mode = telegram.constants.ParseMode.MARKDOWN_V2
+            )
+    finally:
+        _ = indicator.cancel()
 
 async def send_help(text: str, context: ContextTypes.DEFAULT_TYPE, update: Update):
     """
@@ -7,7 +7,7 @@ from typing import Any, Optional, Union
 from telegram import Update
 from telegram._utils.defaultvalue import DEFAULT_TRUE
 from telegram._utils.types import RT, SCT, DVType, JSONDict
-from telegram.ext import Application, CommandHandler, MessageHandler
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler
 from telegram.ext._utils.types import CCT, HandlerCallback, JobCallback
 from telegram.ext.filters import BaseFilter
 
@@ -65,6 +65,27 @@ class message(object):
         assert application != None
         application.add_handler(MessageHandler(self.filters, handler, self.block))
         return handler
+
+
+class callback_query(object):
+    # Decorator that registers the inline keyboard callback in the application
+
+    pattern: Optional[str]
+    block:   DVType[bool]
+
+    def __init__(
+        self,
+        pattern: Optional[str] = None,
+        block:   DVType[bool]  = DEFAULT_TRUE,
+    ) -> None:
+        self.pattern = pattern
+        self.block   = block
+
+    def __call__(self, handler: HandlerCallback[Update, CCT, RT]) -> HandlerCallback[Update, CCT, RT]:
+        assert application != None
+        application.add_handler(CallbackQueryHandler(handler, self.pattern, block=self.block))
+        return handler
+
     
 class run_repeating(object):
 
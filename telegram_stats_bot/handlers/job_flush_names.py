@@ -0,0 +1,31 @@
+import logging
+
+from telegram.ext import ContextTypes
+
+from telegram_stats_bot import global_vars
+from telegram_stats_bot.handlers.decorator import run_repeating
+
+logger = logging.getLogger(__name__)
+
+
+@run_repeating(interval=60, first=60)
+async def flush_names(_context: ContextTypes.DEFAULT_TYPE):
+    stats      = global_vars.stats
+    name_cache = global_vars.name_cache
+
+    if not name_cache:  # Created along with the stats engine
+        return
+    assert stats != None
+
+    changed = name_cache.drain()
+    if not changed:
+        return
+
+    stats.update_user_ids(changed)
+    if stats.users_lock.acquire(timeout=10):
+        stats.users.update({uid: name_cache.known[uid] for uid in changed})
+        stats.users_lock.release()
+    else:
+        logger.warning("Couldn't acquire username lock.")
+        return
+    logger.info("Usernames updated from messages (%d changed)", len(changed))
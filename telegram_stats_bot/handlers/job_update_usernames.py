@@ -1,49 +1,99 @@
+import asyncio
 import logging
-from typing import Union
+import time
+from datetime import datetime, timezone
+from typing import Optional, Union
 
 import telegram
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ContextTypes
 
-from telegram_stats_bot import global_vars
+from telegram_stats_bot import global_vars, stats_loader
 from telegram_stats_bot.handlers.decorator import run_repeating
+from telegram_stats_bot.utils import TokenBucket
 
 logger = logging.getLogger(__name__)
 
+max_concurrency    = 8
+requests_per_sec   = 20
+full_refresh_every = 24     # Runs between refreshes of every user ever seen
+bad_request_ttl    = 86400  # Seconds to skip users that couldn't be fetched
+
+bucket: Optional[TokenBucket] = None  # Created in the job so it belongs to the running event loop
+bad_requests: dict[int, float] = {}  # user id -> time of last BadRequest
+last_run: Optional[datetime] = None
+run_count = 0
+
+
+async def fetch_user(context: ContextTypes.DEFAULT_TYPE, chat_id: int, u_id: int,
+                     semaphore: asyncio.Semaphore) -> Union[tuple[str, str], None]:
+    assert bucket != None
+    async with semaphore:
+        for _ in range(3):
+            await bucket.acquire()
+            try:
+                chat_member: telegram.ChatMember = await context.bot.get_chat_member(chat_id=chat_id, user_id=u_id)
+            except RetryAfter as e:  # Flood wait, stop everyone for as long as asked
+                logger.warning("Flood control while updating usernames, waiting %s s", e.retry_after)
+                bucket.pause(float(e.retry_after))
+                continue
+            except BadRequest:  # Handle users no longer in chat or haven't messaged since bot joined
+                logger.debug("Couldn't get user %s", u_id)  # debug level because will spam every hour
+                bad_requests[u_id] = time.monotonic()
+                return None
+            user = chat_member.user
+            return user.name, user.full_name
+    return None
+
+
 @run_repeating(interval=3600, first=5, chat_id=global_vars.chat_id)
 async def update_usernames(context: ContextTypes.DEFAULT_TYPE):
-    stats = global_vars.stats
+    global bucket, last_run, run_count
+    stats = await stats_loader.get_stats()
 
-    assert stats != None
     assert context.job != None
     assert context.job.chat_id != None
 
-    user_ids = stats.get_message_user_ids()
+    # Only users active since the previous run are refreshed, except for a periodic full refresh
+    since = last_run if run_count % full_refresh_every else None
+    last_run = datetime.now(timezone.utc)
+    run_count += 1
+
+    user_ids = stats.get_message_user_ids(since=since)
     db_users = stats.get_db_users()
 
-    tg_users: dict[int, Union[tuple[str, str], None]]
-    tg_users = {user_id: None for user_id in user_ids}
+    # Users who posted since the last run had their names captured from their messages
+    seen = global_vars.name_cache.take_seen() if global_vars.name_cache else set()
+
+    now = time.monotonic()
+    user_ids = [u_id for u_id in user_ids if u_id not in seen
+                and now - bad_requests.get(u_id, -bad_request_ttl) >= bad_request_ttl]
+
+    if bucket is None:
+        bucket = TokenBucket(rate=requests_per_sec, capacity=requests_per_sec)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    results = await asyncio.gather(*(fetch_user(context, context.job.chat_id, u_id, semaphore)
+                                     for u_id in user_ids))
+
     to_update = {}
-    for u_id in tg_users:
+    for u_id, tg_user in zip(user_ids, results):
+        if tg_user is None:
+            continue
         try:
-            chat_member: telegram.ChatMember = await context.bot.get_chat_member(chat_id=context.job.chat_id,
-                                                                                 user_id=u_id)
-            user = chat_member.user
-            tg_users[u_id] = user.name, user.full_name
-            if tg_users[u_id] != db_users[u_id]:
-                if tg_users[u_id][1] == db_users[u_id][1]:  # Flag these so we don't insert new row
-                    to_update[u_id] = tg_users[u_id][0], None
+            if tg_user != db_users[u_id]:
+                if tg_user[1] == db_users[u_id][1]:  # Flag these so we don't insert new row
+                    to_update[u_id] = tg_user[0], None
                 else:
-                    to_update[u_id] = tg_users[u_id]
+                    to_update[u_id] = tg_user
         except KeyError:  # First time user
-            to_update[u_id] = tg_users[u_id]
-        except BadRequest:  # Handle users no longer in chat or haven't messaged since bot joined
-            logger.debug("Couldn't get user %s", u_id)  # debug level because will spam every hour
+            to_update[u_id] = tg_user
     stats.update_user_ids(to_update)
+    if global_vars.name_cache:
+        global_vars.name_cache.known.update({u_id: tg_user for u_id, tg_user in zip(user_ids, results) if tg_user})
     if stats.users_lock.acquire(timeout=10):
         stats.users = stats.get_db_users()
         stats.users_lock.release()
     else:
         logger.warning("Couldn't acquire username lock.")
         return
-    logger.info("Usernames updated")
+    logger.info("Usernames updated (%d checked, %d changed)", len(user_ids), len(to_update))
@@ -0,0 +1,20 @@
+import logging
+
+from telegram.ext import ContextTypes
+
+from telegram_stats_bot import stats_loader
+from telegram_stats_bot.handlers.decorator import run_once
+
+logger = logging.getLogger(__name__)
+
+
+async def warm_stats(_context: ContextTypes.DEFAULT_TYPE):
+    """Loads the stats engine in the background, so the first /stats doesn't wait for it."""
+    try:
+        _ = await stats_loader.get_stats()
+    except Exception:  # Retried by the next command that needs it
+        logger.exception("Couldn't start the stats engine")
+
+
+if stats_loader.warmup is not None:
+    _ = run_once(when=stats_loader.warmup)(warm_stats)
@@ -16,6 +16,10 @@ async def log_message(update: Update, _context: ContextTypes.DEFAULT_TYPE):
 
     logger.debug(update)
 
+    tg_user = update.effective_user
+    if global_vars.name_cache and tg_user:
+        global_vars.name_cache.observe(tg_user.id, tg_user.name, tg_user.full_name)
+
     if update.edited_message and update.effective_message:
         edited_message, user = parse_message(update.effective_message)
         if bak_store:
@@ -19,12 +19,16 @@
 # You should have received a copy of the GNU Public License
 # along with this program. If not, see [http://www.gnu.org/licenses/].
 import datetime
+import gzip
 import logging
 import json
 import os
-from typing import Union
+import shutil
+import threading
+import time
+from typing import IO, Optional, Union
 
-from sqlalchemy import Engine, create_engine, update
+from sqlalchemy import Engine, create_engine, make_url, update
 from sqlalchemy.dialects.postgresql import Any
 from sqlalchemy.orm import Session
 from sqlalchemy_utils import database_exists
@@ -32,27 +36,292 @@ from sqlalchemy_utils import database_exists
 from telegram_stats_bot.db.tbl_messages import Message
 from telegram_stats_bot.db.tbl_user_events import UserEvent
 
+from . import segments
 from .parse import MessageDict, UserEventDict
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 logger = logging.getLogger(__name__)
 
+compression_suffixes = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
 def date_converter(o):
     if isinstance(o, datetime.datetime):
         return o.__str__()
 
 
+def compress_segment(path: str, compression: str):
+    """
+    Compresses a closed segment next to the original and removes the original.
+    :param path: path of the closed segment
+    :param compression: 'gzip' or 'zstd'
+    """
+    out_path = path + compression_suffixes[compression]
+    tmp_path = out_path + ".tmp"
+
+    with open(path, 'rb') as src:
+        if compression == 'gzip':
+            with gzip.open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        else:
+            assert zstandard != None
+            with open(tmp_path, 'wb') as dst:
+                _ = zstandard.ZstdCompressor().copy_stream(src, dst)
+
+    os.replace(tmp_path, out_path)
+    os.remove(path)
+
+
+class SegmentWriter(object):
+    """
+    Keeps the current segment of one backup stream open behind a buffered writer.
+    Segments are named ``{name}.{YYYY-MM-DD}.{seq}.json`` (or ``.msgpack``, see segments.py)
+    and are rotated when they reach rotate_size bytes or when the (UTC) day changes.
+    """
+    def __init__(self,
+        path:         str,
+        name:         str,
+        fsync:        Union[str, int] = 'rotate',
+        rotate_size:  int             = 64 * 2**20,
+        rotate_daily: bool            = True,
+        compression:  Optional[str]   = None,
+        fmt:          str             = 'json',
+        index_every:  int             = 256,
+        buffer_size:  int             = 2**16,
+    ):
+        self.path         = path
+        self.name         = name
+        self.fsync        = fsync
+        self.rotate_size  = rotate_size
+        self.rotate_daily = rotate_daily
+        self.compression  = compression
+        self.fmt          = fmt
+        self.index_every  = index_every
+        self.buffer_size  = buffer_size
+
+        self.file:        Optional[IO[bytes]] = None
+        self.index_file:  Optional[IO[bytes]] = None
+        self.file_path:   str   = ""
+        self.day:         str   = ""
+        self.size:        int   = 0
+        self.records:     int   = 0
+        self.last_entry:  bytes = b''
+        self.last_key:    tuple[int, int] = (0, 0)
+        self.last_fsync:  float = 0.
+        self.compressors: list[threading.Thread] = []
+        self.lock = threading.Lock()
+
+    def next_segment_path(self, day: str) -> str:
+        prefix = f"{self.name}.{day}."
+        seqs = [-1]
+        for fname in os.listdir(self.path):
+            if not fname.startswith(prefix):
+                continue
+            seq = fname[len(prefix):].split('.', 1)[0]
+            if seq.isdigit():
+                seqs.append(int(seq))
+        suffix = segments.segment_suffix if self.fmt == 'msgpack' else '.json'
+        return os.path.join(self.path, f"{prefix}{max(seqs) + 1:04d}{suffix}")
+
+    def open(self, day: str):
+        self.day        = day
+        self.file_path  = self.next_segment_path(day)
+        self.file       = open(self.file_path, 'ab', buffering=self.buffer_size)
+        self.size       = 0
+        self.records    = 0
+        self.last_entry = b''
+        self.last_key   = (0, 0)
+        self.last_fsync = time.monotonic()
+        if self.fmt == 'msgpack':
+            self.index_file = open(self.file_path + segments.index_suffix, 'ab')
+
+    def sync(self):
+        assert self.file != None
+        for f in (self.index_file, self.file):
+            if f is None:
+                continue
+            f.flush()
+            os.fsync(f.fileno())
+        self.last_fsync = time.monotonic()
+
+    def close_segment(self):
+        if self.file is None:
+            return
+        if self.index_file is not None and self.last_entry:
+            _ = self.index_file.write(self.last_entry)  # Index last record so readers know the segment's range
+        self.sync()
+        self.file.close()
+        self.file = None
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+
+        if self.size == 0:
+            os.remove(self.file_path)
+            if self.fmt == 'msgpack' and os.path.exists(self.file_path + segments.index_suffix):
+                os.remove(self.file_path + segments.index_suffix)
+        elif self.compression:
+            thread = threading.Thread(
+                target = compress_segment,
+                args   = (self.file_path, self.compression),
+                name   = f"compress-{os.path.basename(self.file_path)}",
+                daemon = True,
+            )
+            thread.start()
+            self.compressors = [t for t in self.compressors if t.is_alive()] + [thread]
+
+    def drop_index(self):
+        """Removes the index of the current segment, whose records are out of order (see segments.py)."""
+        assert self.index_file != None
+        self.index_file.close()
+        self.index_file = None
+        self.last_entry = b''
+        os.remove(self.file_path + segments.index_suffix)
+        logger.debug("%s is out of order, not indexed", self.file_path)
+
+    def encode(self, data: Union[MessageDict, UserEventDict]) -> bytes:
+        if self.fmt == 'msgpack':
+            return segments.pack_record(dict(data), default=date_converter)
+        return (json.dumps(data, default=date_converter) + "\n").encode('utf-8')
+
+    def write(self, data: Union[MessageDict, UserEventDict]):
+        day = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
+        record = self.encode(data)
+
+        with self.lock:
+            if self.file is not None and (
+                self.size >= self.rotate_size or (self.rotate_daily and day != self.day)
+            ):
+                self.close_segment()
+            if self.file is None:
+                self.open(day)
+            assert self.file != None
+
+            if self.index_file is not None:
+                key = segments.index_key(dict(data))
+                if key[0] < self.last_key[0] or key[1] < self.last_key[1]:
+                    self.drop_index()
+                else:
+                    self.last_key = key
+
+            if self.index_file is not None:
+                entry = segments.pack_index_entry(dict(data), self.size)
+                if self.records % self.index_every == 0:
+                    _ = self.index_file.write(entry)
+                    self.last_entry = b''
+                else:
+                    self.last_entry = entry
+
+            _ = self.file.write(record)
+            self.size    += len(record)
+            self.records += 1
+
+            if self.fsync == 'message':
+                self.sync()
+            elif isinstance(self.fsync, int) and (time.monotonic() - self.last_fsync) * 1000 >= self.fsync:
+                self.sync()
+
+    def close(self):
+        with self.lock:
+            self.close_segment()
+        for thread in self.compressors:
+            thread.join()
+        self.compressors = []
+
+
 class JSONStore(object):
-    def __init__(self, path: str):
-        self.store = path
+    """
+    Backup store writing one JSON document per line.
+
+    By default every record opens, appends to and closes ``{name}.json``. With
+    segmented=True each stream keeps a buffered segment open instead (see SegmentWriter),
+    syncing it according to fsync: 'message' (every record), 'rotate' (only when a segment
+    is closed) or an integer number of milliseconds between syncs. Segmented stores can also
+    write the indexed msgpack format from segments.py with fmt='msgpack'.
+    """
+    def __init__(self,
+        path:         str,
+        segmented:    bool            = False,
+        fsync:        Union[str, int] = 'rotate',
+        rotate_size:  int             = 64 * 2**20,
+        rotate_daily: bool            = True,
+        compression:  Optional[str]   = None,
+        fmt:          str             = 'json',
+    ):
+        if fmt not in ('json', 'msgpack'):
+            raise ValueError(f"Unknown backup format {fmt}")
+        if fmt == 'msgpack':
+            segments.require_msgpack()
+            if not segmented:
+                raise ValueError("msgpack backups must be segmented")
+            if compression:
+                raise ValueError("msgpack segments are memory-mapped by readers and can't be compressed")
+        if compression is not None and compression not in compression_suffixes:
+            raise ValueError(f"Unknown compression {compression}, must be one of {list(compression_suffixes)}")
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError("zstd compression requires the zstandard package (pip install telegram-stats-bot[segments])")
+        if not (fsync in ('message', 'rotate') or (isinstance(fsync, int) and fsync >= 0)):
+            raise ValueError(f"Invalid fsync policy {fsync}")
+
+        self.store        = path
+        self.segmented    = segmented
+        self.fsync        = fsync
+        self.rotate_size  = rotate_size
+        self.rotate_daily = rotate_daily
+        self.compression  = compression
+        self.fmt          = fmt
+        self.writers: dict[str, SegmentWriter] = {}
+
+    def get_writer(self, name: str) -> SegmentWriter:
+        try:
+            return self.writers[name]
+        except KeyError:
+            writer = SegmentWriter(
+                self.store,
+                name,
+                fsync        = self.fsync,
+                rotate_size  = self.rotate_size,
+                rotate_daily = self.rotate_daily,
+                compression  = self.compression,
+                fmt          = self.fmt,
+            )
+            self.writers[name] = writer
+            return writer
 
     def append_data(self, name: str, data: Union[MessageDict, UserEventDict]):
-        with open(os.path.join(self.store, f"{name}.json"), 'a') as f:
-            f.write(json.dumps(data, default=date_converter) + "\n")
+        if self.segmented:
+            self.get_writer(name).write(data)
+        else:
+            with open(os.path.join(self.store, f"{name}.json"), 'a') as f:
+                f.write(json.dumps(data, default=date_converter) + "\n")
+
+    def close(self):
+        """Closes (and compresses, if enabled) all open segments."""
+        for writer in self.writers.values():
+            writer.close()
+
+
+def create_pg_engine(connection_url: str, prepare_threshold: Optional[int] = 2) -> Engine:
+    """
+    Autocommit engine for connection_url. With psycopg 3, a statement executed prepare_threshold
+    times on a pooled connection is prepared server-side and later executions skip parsing and
+    planning (None disables this, e.g. behind a transaction pooling PgBouncer).
+    """
+    connect_args = {}
+    if make_url(connection_url).get_driver_name() == 'psycopg':
+        connect_args['prepare_threshold'] = prepare_threshold
+    return create_engine(connection_url, echo=False, isolation_level="AUTOCOMMIT", connect_args=connect_args)
 
 
 class PostgresStore(object):
-    def __init__(self, connection_url: str):
-        self.engine = create_engine(connection_url, echo=False, isolation_level="AUTOCOMMIT")
+    def __init__(self, connection_url: str, prepare_threshold: Optional[int] = 2):
+        self.engine = create_pg_engine(connection_url, prepare_threshold)
         if not database_exists(self.engine.url):
             logging.critical("Database {} does not exist".format(connection_url))
 
@@ -25,14 +25,15 @@ import json
 import argparse
 import warnings
 import os
+from typing import Any, Optional, Union
 import appdirs
 from telegram.ext import Application
 
-from telegram_stats_bot import global_vars
+from telegram_stats_bot import global_vars, stats_loader
 from telegram_stats_bot.handlers import load_handlers
 
-from .log_storage import JSONStore, PostgresStore
-from .stats import StatsRunner
+from .log_storage import JSONStore, PostgresStore, create_pg_engine
+from .utils import image_formats, render_modes
 
 warnings.filterwarnings("ignore")
 
@@ -56,30 +57,145 @@ sticker_idx = None
 sticker_id = None
     
 class CommandLineArgs(argparse.Namespace):
-    token:        str = ''
-    chat_id:      int = 0
-    postgres_url: str = ''
-    json_path:    str = ''
-    tz:           str = ''
+    token:            str  = ''
+    chat_id:          int  = 0
+    postgres_url:     str  = ''
+    json_path:        str  = ''
+    json_segmented:   bool = False
+    json_fsync:       Union[str, int] = 'rotate'
+    json_rotate_size: int  = 64
+    json_compression: Optional[str] = None
+    json_format:      str  = 'json'
+    tz:               str  = ''
+    read_budget:      int  = 64
+    render_mode:      str  = 'auto'
+    plot_width:       int  = 1000
+    image_format:     str  = 'png'
+    statement_timeout: list[tuple[str, float]] = []  # ('', seconds) is the default for all commands
+    read_url:         str  = ''
+    max_replica_lag:  Optional[float] = None
+    prepare_threshold: int = 2
+    stats_warmup:     float = 1
+
+
+def fsync_policy(value: str) -> Union[str, int]:
+    if value.isdigit():
+        return int(value)
+    if value not in ('message', 'rotate'):
+        raise argparse.ArgumentTypeError("must be 'message', 'rotate' or a number of milliseconds")
+    return value
+
+
+def statement_timeout(value: str) -> tuple[str, float]:
+    command, _, seconds = value.rpartition('=')
+    try:
+        return command, float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be seconds or command=seconds")
+
+
+async def close_stores(_application: Application[Any, Any, Any, Any, Any, Any]) -> None:
+    if global_vars.stats:
+        global_vars.stats.cancel_all()
+    if global_vars.name_cache and global_vars.stats:
+        changed = global_vars.name_cache.drain()
+        if changed:
+            global_vars.stats.update_user_ids(changed)
+    if global_vars.bak_store:
+        global_vars.bak_store.close()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     _ = parser.add_argument('token', type=str, help="Telegram bot token")
     _ = parser.add_argument('chat_id', type=int, help="Telegram chat id to monitor.")
     _ = parser.add_argument('postgres_url', type=str, help="Sqlalchemy-compatible postgresql url.")
+    _ = parser.add_argument('--read-url',
+        type    = str,
+        help    = "Sqlalchemy-compatible postgresql url of a read replica for stats queries.",
+        default = ""
+    )
+    _ = parser.add_argument('--max-replica-lag',
+        type    = float,
+        help    = "Seconds the read replica may lag behind before stats are read from the primary (default: no check).",
+        default = None
+    )
     _ = parser.add_argument('--json-path',
         type = str,
         help = "Either full path to backup storage folder or prefix (will be stored in app data dir).",
         default = ""
     )
+    _ = parser.add_argument('--json-segmented',
+        action = 'store_true',
+        help   = "Keep backup segments open with a buffered writer, rotating them by size and day."
+    )
+    _ = parser.add_argument('--json-fsync',
+        type    = fsync_policy,
+        help    = "Segment fsync policy: 'message', 'rotate' or a number of milliseconds between syncs.",
+        default = 'rotate'
+    )
+    _ = parser.add_argument('--json-rotate-size',
+        type    = int,
+        help    = "Size in MiB at which backup segments are rotated.",
+        default = 64
+    )
+    _ = parser.add_argument('--json-compression',
+        choices = ['gzip', 'zstd'],
+        help    = "Compress closed backup segments.",
+        default = None
+    )
+    _ = parser.add_argument('--json-format',
+        choices = ['json', 'msgpack'],
+        help    = "Segment format, msgpack segments are indexed by date and message id (requires --json-segmented).",
+        default = 'json'
+    )
     _ = parser.add_argument('--tz',
         type=str,
         help="tz database time zone string, e.g. Europe/London",
         default='Etc/UTC'
     )
+    _ = parser.add_argument('--read-budget',
+        type    = int,
+        help    = "Approximate memory in MiB a streamed stats query may hold at once.",
+        default = 64
+    )
+    _ = parser.add_argument('--render-mode',
+        choices = render_modes,
+        help    = "Renderer for the hours and days plots, aggregate keeps render time constant with history length.",
+        default = 'auto'
+    )
+    _ = parser.add_argument('--plot-width',
+        type    = int,
+        help    = "Time series plots are downsampled to about this many points (pixels wide), 0 to disable.",
+        default = 1000
+    )
+    _ = parser.add_argument('--image-format',
+        choices = image_formats,
+        help    = "Format of plot images, webp and jpeg are smaller uploads than png.",
+        default = 'png'
+    )
+    _ = parser.add_argument('--statement-timeout',
+        type    = statement_timeout,
+        action  = 'append',
+        help    = "Seconds a stats query may run (default 30, 0 for no limit), or command=seconds for one command. Can be repeated.",
+        default = []
+    )
+    _ = parser.add_argument('--prepare-threshold',
+        type    = int,
+        help    = "Executions of a statement on a connection before it is prepared server-side, -1 to never prepare "
+                  "(needed behind PgBouncer in transaction mode).",
+        default = 2
+    )
+
+    _ = parser.add_argument('--stats-warmup',
+        type    = float,
+        help    = "Seconds after startup to load the stats engine in the background, -1 to load it on the first "
+                  "stats command.",
+        default = 1
+    )
 
     args        = parser.parse_args(namespace=CommandLineArgs())
-    application = Application.builder().token(args.token).build()
+    application = Application.builder().token(args.token).post_shutdown(close_stores).build()
     
     other_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'other')
     if not os.path.exists(other_path): os.mkdir(other_path)
@@ -91,16 +207,37 @@ if __name__ == '__main__':
             path = os.path.join(appdirs.user_data_dir('telegram-stats-bot'), path)
 
         os.makedirs(path, exist_ok=True)
-        global_vars.bak_store = JSONStore(path)
+        global_vars.bak_store = JSONStore(path,
+            segmented    = args.json_segmented,
+            fsync        = args.json_fsync,
+            rotate_size  = args.json_rotate_size * 2**20,
+            compression  = args.json_compression,
+            fmt          = args.json_format,
+        )
     else:
         global_vars.bak_store = None
 
     # Use psycopg 3
     if args.postgres_url.startswith('postgresql://'):
         args.postgres_url = args.postgres_url.replace('postgresql://', 'postgresql+psycopg://', 1)
+    if args.read_url.startswith('postgresql://'):
+        args.read_url = args.read_url.replace('postgresql://', 'postgresql+psycopg://', 1)
 
-    global_vars.store   = PostgresStore(args.postgres_url)
-    global_vars.stats   = StatsRunner(global_vars.store.engine, tz=args.tz)
+    prepare_threshold   = args.prepare_threshold if args.prepare_threshold >= 0 else None
+    global_vars.store   = PostgresStore(args.postgres_url, prepare_threshold)
+    timeouts = dict(args.statement_timeout)
+    stats_loader.configure(global_vars.store.engine,
+        stats_warmup       = args.stats_warmup if args.stats_warmup >= 0 else None,
+        tz                 = args.tz,
+        read_budget        = args.read_budget * 2**20,
+        render_mode        = args.render_mode,
+        plot_width         = args.plot_width,
+        image_format       = args.image_format,
+        statement_timeout  = timeouts.pop('', 30),
+        statement_timeouts = timeouts,
+        read_engine        = create_pg_engine(args.read_url, prepare_threshold) if args.read_url else None,
+        max_replica_lag    = args.max_replica_lag,
+    )
     global_vars.chat_id = args.chat_id
 
     load_handlers(application)
@@ -0,0 +1,39 @@
+"""user_names_current
+
+Revision ID: 9a3f1c6e2b7d
+Revises: 4d4339ec115c
+Create Date: 2026-10-19 10:12:40.318274
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision:      str      = '9a3f1c6e2b7d'
+down_revision: Union[str, None] = '4d4339ec115c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on:    Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    _ = op.create_table('user_names_current',
+        sa.Column('user_id', sa.BigInteger(), nullable=False),
+        sa.Column('date', sa.TIMESTAMP(timezone=True), nullable=True),
+        sa.Column('username', sa.Text(), nullable=True),
+        sa.Column('display_name', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('user_id'),
+    )
+    op.execute("""
+        INSERT INTO user_names_current(user_id, date, username, display_name)
+        SELECT DISTINCT ON (user_id) user_id, date, username, display_name
+        FROM user_names
+        WHERE user_id IS NOT NULL
+        ORDER BY user_id, date DESC NULLS LAST;
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table('user_names_current')
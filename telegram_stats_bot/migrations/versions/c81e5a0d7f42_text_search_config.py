@@ -0,0 +1,54 @@
+"""text_search_config
+
+Revision ID: c81e5a0d7f42
+Revises: 9a3f1c6e2b7d
+Create Date: 2026-10-19 16:40:12.507361
+
+Turns the generated text_index_col into a column maintained by a trigger and records its
+text search configuration (english, as generated) in the column's comment. Only the catalog
+changes, switching to another configuration is left to telegram_stats_bot.text_search, which
+rebuilds the column online while the bot runs.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+from telegram_stats_bot import text_search
+
+
+# revision identifiers, used by Alembic.
+revision:      str      = 'c81e5a0d7f42'
+down_revision: Union[str, None] = '9a3f1c6e2b7d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on:    Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    con = op.get_bind()
+    config = text_search.check_config(con, text_search.get_ts_config(con))
+
+    # Keeps the stored values, the trigger computes the same ones for new and edited messages.
+    # Postgres 12 can't drop the expression, its generated column stays until a rebuild replaces it.
+    op.execute(f"""
+        DO $trigger$
+        BEGIN
+            IF current_setting('server_version_num')::int >= 130000 THEN
+                ALTER TABLE messages_utc ALTER COLUMN text_index_col DROP EXPRESSION IF EXISTS;
+                {text_search.trigger_ddl('text_index_col', 'messages_utc_text_index', config)}
+            END IF;
+        END
+        $trigger$
+    """)
+    op.execute(f"COMMENT ON COLUMN messages_utc.text_index_col IS '{config}'")
+
+
+def downgrade() -> None:
+    # Not online: adding the generated column rewrites the table
+    op.execute("DROP TRIGGER IF EXISTS messages_utc_text_index ON messages_utc")
+    op.execute("DROP FUNCTION IF EXISTS messages_utc_text_index()")
+    op.execute("ALTER TABLE messages_utc DROP COLUMN text_index_col")
+    op.execute("""
+        ALTER TABLE messages_utc ADD COLUMN text_index_col tsvector NOT NULL
+            GENERATED ALWAYS AS (to_tsvector('english', coalesce(text, ''))) STORED
+    """)
+    op.create_index('text_idx', 'messages_utc', ['text_index_col'], unique=False, postgresql_using='gin')
@@ -0,0 +1,223 @@
+# !/usr/bin/env python
+#
+# A logging and statistics bot for Telegram based on python-telegram-bot.
+# Copyright (C) 2020
+# Michael DM Dryden <mk.dryden@utoronto.ca>
+#
+# This file is part of telegram-stats-bot.
+#
+# telegram-stats-bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser Public License for more details.
+#
+# You should have received a copy of the GNU Public License
+# along with this program. If not, see [http://www.gnu.org/licenses/].
+"""
+Replies split in pages, turned with inline keyboard buttons.
+"""
+import logging
+import math
+import secrets
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Generic, Hashable, Optional, TypeVar, Union
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from telegram_stats_bot.dispatch import run_method
+from telegram_stats_bot.stats import SearchKey, SearchPage, Table, TableResult
+from telegram_stats_bot.utils import escape_markdown
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+PageReply = tuple[str, Optional[InlineKeyboardMarkup]]  # Markdown text and its buttons
+
+
+class TTLCache(Generic[K, V]):
+    """
+    Dict whose items expire ttl seconds after they were stored. At most max_items are kept,
+    and at most max_bytes of them as measured by sizeof, the least recently used go first.
+    """
+    def __init__(self, ttl: float, max_items: int,
+                 max_bytes: Optional[int] = None, sizeof: Callable[[V], int] = lambda _: 0):
+        self.ttl       = ttl
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof    = sizeof
+
+        self.items: OrderedDict[K, tuple[float, int, V]] = OrderedDict()  # key -> (expiry, size, value), LRU first
+        self.bytes = 0
+
+    def get(self, key: K) -> Optional[V]:
+        item = self.items.get(key)
+        if item is None:
+            return None
+        if item[0] <= time.monotonic():
+            self.pop(key)
+            return None
+        self.items.move_to_end(key)
+        return item[2]
+
+    def put(self, key: K, value: V) -> bool:
+        """Stores value, unless it is larger than max_bytes on its own."""
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+
+        self.pop(key)
+        self.items[key] = time.monotonic() + self.ttl, size, value
+        self.bytes += size
+        self.expire()
+        while len(self.items) > self.max_items or (self.max_bytes is not None and self.bytes > self.max_bytes):
+            self.pop(next(iter(self.items)))
+        return True
+
+    def pop(self, key: K):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.bytes -= item[1]
+
+    def expire(self):
+        now = time.monotonic()
+        for key in [key for key, (expiry, _, _) in self.items.items() if expiry <= now]:
+            self.pop(key)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+def page_buttons(name: str, token: str, index: int, has_next: bool) -> Optional[InlineKeyboardMarkup]:
+    buttons = []
+    if index > 0:
+        buttons.append(InlineKeyboardButton("« Anterior", callback_data=f"{name}:{token}:{index - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Próxima »", callback_data=f"{name}:{token}:{index + 1}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+class KeysetSession(object):
+    """A paged query: its page method, arguments and the key each page starts after, once known."""
+    def __init__(self, page: Callable[..., SearchPage], args: dict[str, Any]):
+        self.page = page
+        self.args = args
+        self.keys: list[Optional[SearchKey]] = [None]  # keys[i] is the key page i starts after
+
+
+class KeysetPager(object):
+    """
+    Pages through a StatsRunner method returning SearchPages with keyset pagination.
+    Sessions remember the key where each page seen ends, so going forward or back runs the
+    query from a key instead of counting rows to skip. Sessions expire after ttl seconds.
+    """
+    def __init__(self, name: str, method: str, page_method: str, ttl: float = 3600, max_sessions: int = 256):
+        self.name        = name    # Prefix of the callback data
+        self.method      = method  # Command method
+        self.page_method = page_method
+        self.sessions: TTLCache[str, KeysetSession] = TTLCache(ttl, max_sessions)
+
+    async def open(self, func: Callable[..., Any], args: dict[str, Any], user_id: int,
+                   on_queued: Optional[Callable[[], Awaitable[Any]]] = None) -> PageReply:
+        """First page of func's results, with func the command method of the runner."""
+        session = KeysetSession(getattr(getattr(func, '__self__'), self.page_method), args)
+        page = await run_method(session.page, args, user_id, on_queued, method=self.method)
+
+        token = secrets.token_hex(4)
+        if page.next_key:
+            self.sessions.put(token, session)
+        return self.render(token, session, 0, page)
+
+    async def turn(self, token: str, index: int, user_id: int) -> Optional[PageReply]:
+        """Page index of a session, None if it expired."""
+        session = self.sessions.get(token)
+        if session is None:
+            return None
+        if not 0 <= index < len(session.keys):
+            raise IndexError(f"Page {index} of {token} isn't reachable")
+
+        args = dict(session.args, after=session.keys[index])
+        page = await run_method(session.page, args, user_id, method=self.method)
+        return self.render(token, session, index, page)
+
+    def render(self, token: str, session: KeysetSession, index: int, page: SearchPage) -> PageReply:
+        del session.keys[index + 1:]
+        if page.next_key:
+            session.keys.append(page.next_key)
+
+        markup = page_buttons(self.name, token, index, page.next_key is not None)
+        if markup is None:
+            return page.text, None
+        return page.text + "\n\n" + escape_markdown(f"Página {index + 1}"), markup
+
+
+def table_size(table: Table) -> int:
+    return int(table.frame.memory_usage(index=True, deep=True).sum()) + len(table.title) + len(table.footer)
+
+
+# Tables being paged through, by token. Short lived and bounded in memory, an expired table
+# has to be asked for again.
+tables: TTLCache[str, Table] = TTLCache(ttl=900, max_items=128, max_bytes=32 * 2**20, sizeof=table_size)
+
+
+class FramePager(object):
+    """
+    Pages through the Table of a tabular stats command, page_rows rows at a time. The table is
+    computed once and kept in tables, turning pages only slices its frame.
+    """
+    def __init__(self, name: str, method: str, table_method: str, page_rows: int = 25):
+        self.name         = name    # Prefix of the callback data
+        self.method       = method  # Command method
+        self.table_method = table_method
+        self.page_rows    = page_rows
+
+    async def open(self, func: Callable[..., Any], args: dict[str, Any], user_id: int,
+                   on_queued: Optional[Callable[[], Awaitable[Any]]] = None) -> PageReply:
+        """First page of func's results, with func the command method of the runner."""
+        table_method: Callable[..., TableResult] = getattr(getattr(func, '__self__'), self.table_method)
+        table = await run_method(table_method, args, user_id, on_queued, method=self.method)
+        if isinstance(table, str):
+            return table, None
+        if len(table.frame) <= self.page_rows:
+            return table.render(), None
+
+        token = secrets.token_hex(4)
+        if not tables.put(token, table):
+            logger.warning("%s table of %d rows is too large to page through", self.name, len(table.frame))
+            return table.render(0, self.page_rows) + "\n" + escape_markdown(f"Primeiras {self.page_rows} linhas."), None
+        return self.render(token, table, 0)
+
+    async def turn(self, token: str, index: int, user_id: int) -> Optional[PageReply]:
+        """Page index of a table, None if it expired."""
+        table = tables.get(token)
+        if table is None:
+            return None
+        if not 0 <= index < self.pages(table):
+            raise IndexError(f"Page {index} of {token} doesn't exist")
+        return self.render(token, table, index)
+
+    def pages(self, table: Table) -> int:
+        return math.ceil(len(table.frame) / self.page_rows)
+
+    def render(self, token: str, table: Table, index: int) -> PageReply:
+        start = index * self.page_rows
+        text  = table.render(start, start + self.page_rows)
+        text += "\n" + escape_markdown(f"Página {index + 1} de {self.pages(table)}")
+        return text, page_buttons(self.name, token, index, index + 1 < self.pages(table))
+
+
+Pager = Union[KeysetPager, FramePager]
+
+pagers: dict[str, Pager] = {pager.method: pager for pager in [
+    KeysetPager('search', 'get_message_search',   'search_page'),
+    FramePager('counts',  'get_chat_counts',      'counts_table'),
+    FramePager('words',   'get_word_stats',       'words_table'),
+]}
+pagers_by_name = {pager.name: pager for pager in pagers.values()}
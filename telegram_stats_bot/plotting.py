@@ -0,0 +1,210 @@
+# !/usr/bin/env python
+#
+# A logging and statistics bot for Telegram based on python-telegram-bot.
+# Copyright (C) 2020
+# Michael DM Dryden <mk.dryden@utoronto.ca>
+#
+# This file is part of telegram-stats-bot.
+#
+# telegram-stats-bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser Public License for more details.
+#
+# You should have received a copy of the GNU Public License
+# along with this program. If not, see [http://www.gnu.org/licenses/].
+"""
+Matplotlib renderers whose cost doesn't grow with the length of the chat history.
+
+Seaborn draws every observation (strip plots) or evaluates a KDE at every observation
+(violins), so render time grows with the length of the chat history. These functions reduce
+each category to box statistics, a KDE on a fixed grid and a capped random sample of points
+before drawing, so the number of artists is constant. They mimic the seaborn defaults used
+by StatsRunner closely enough to be used interchangeably.
+
+Time series are reduced with LTTB to about one point per horizontal pixel before plotting.
+"""
+from colorsys import rgb_to_hls
+from typing import Any, Sequence
+
+import matplotlib as mpl
+import numpy as np
+import pandas as pd
+import seaborn as sns
+from matplotlib.axes import Axes
+from matplotlib.cbook import boxplot_stats
+
+max_strip_points = 4000  # Points drawn by strip_plot over all categories
+kde_bins         = 512   # Histogram bins used to approximate the KDE
+kde_gridsize     = 100   # Same as seaborn
+
+
+def line_color(colors: Sequence[Any]) -> tuple[float, float, float]:
+    """Gray used for box and violin outlines, as seaborn's linecolor='auto'."""
+    lum = min(rgb_to_hls(*mpl.colors.to_rgb(c))[1] for c in colors) * .6
+    return lum, lum, lum
+
+
+def clean_groups(groups: Sequence[np.ndarray]) -> list[np.ndarray]:
+    return [np.asarray(g, dtype=float)[~np.isnan(np.asarray(g, dtype=float))] for g in groups]
+
+
+def sample_points(groups: Sequence[np.ndarray], max_points: int = max_strip_points,
+                  seed: int = 0) -> list[np.ndarray]:
+    """Uniform random sample of at most max_points values, taken proportionally from each group."""
+    total = sum(len(g) for g in groups)
+    if total <= max_points:
+        return list(groups)
+
+    rng = np.random.default_rng(seed)
+    return [rng.choice(g, size=int(round(len(g) * max_points / total)), replace=False) for g in groups]
+
+
+def kde_grid(values: np.ndarray, gridsize: int = kde_gridsize, bins: int = kde_bins) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Gaussian KDE with Scott's bandwidth evaluated between the data extremes (seaborn's cut=0).
+    Values are binned first and the kernel is convolved with the bin counts, so the cost
+    after the histogram doesn't depend on the number of values.
+    :return: (support, density), density is not normalized
+    """
+    lo, hi = values.min(), values.max()
+    bw = values.std(ddof=1) * len(values) ** (-1 / 5)
+
+    # Pad by the kernel reach so values near the edges get their full contribution
+    edges = np.linspace(lo - 3 * bw, hi + 3 * bw, bins + 1)
+    counts, _ = np.histogram(values, bins=edges)
+    centers = (edges[:-1] + edges[1:]) / 2
+
+    step = edges[1] - edges[0]
+    half = int(np.ceil(3 * bw / step))
+    offsets = np.arange(-half, half + 1) * step
+    kernel = np.exp(-0.5 * (offsets / bw) ** 2)
+    density = np.convolve(counts, kernel, mode='same')
+
+    support = np.linspace(lo, hi, gridsize)
+    return support, np.interp(support, centers, density)
+
+
+def box_plot(ax: Axes, groups: Sequence[np.ndarray], colors: Sequence[Any],
+             whis: float = 1.5, width: float = .8, zorder: float = 2, saturation: float = .75):
+    """Box plot at positions 0..n-1 without fliers, like sns.boxplot(showfliers=False)."""
+    groups   = clean_groups(groups)
+    colors   = [sns.desaturate(c, saturation) for c in colors]
+    edge     = line_color(colors)
+
+    positions = [i for i, g in enumerate(groups) if len(g)]
+    stats     = boxplot_stats([groups[i] for i in positions], whis=whis)
+
+    artists = ax.bxp(stats,
+        positions    = positions,
+        widths       = width,
+        patch_artist = True,
+        showfliers   = False,
+        capwidths    = width / 2,
+        boxprops     = {'edgecolor': edge, 'zorder': zorder},
+        medianprops  = {'color': edge, 'zorder': zorder, 'solid_capstyle': 'butt'},
+        whiskerprops = {'color': edge, 'zorder': zorder, 'solid_capstyle': 'butt'},
+        capprops     = {'color': edge, 'zorder': zorder},
+        manage_ticks = False,
+    )
+    for box, i in zip(artists['boxes'], positions):
+        box.set_facecolor(colors[i])
+    ax.xaxis.grid(False)  # Categorical axis, as seaborn
+
+
+def strip_plot(ax: Axes, groups: Sequence[np.ndarray], colors: Sequence[Any],
+               jitter: float = .1, size: float = 5, alpha: float = 1, zorder: float = 1,
+               max_points: int = max_strip_points, seed: int = 0):
+    """Jittered strip plot of a capped sample of each group, like sns.stripplot."""
+    rng = np.random.default_rng(seed)
+    for i, (values, color) in enumerate(zip(sample_points(clean_groups(groups), max_points, seed), colors)):
+        if not len(values):
+            continue
+        x = i + rng.uniform(-jitter, jitter, len(values))
+        _ = ax.scatter(x, values, s=size ** 2, color=color, alpha=alpha, linewidth=0, zorder=zorder)
+
+
+def violin_plot(ax: Axes, groups: Sequence[np.ndarray], color: Any,
+                width: float = .8, saturation: float = .75):
+    """
+    Violins scaled to a common width with an inner box, like
+    sns.violinplot(cut=0, inner='box', density_norm='width').
+    """
+    groups    = clean_groups(groups)
+    color     = sns.desaturate(color, saturation)
+    edge      = line_color([color])
+    linewidth = mpl.rcParams['patch.linewidth'] * 1.25
+    box_width = linewidth * 4.5
+    ax.xaxis.grid(False)
+
+    for i, values in enumerate(groups):
+        if not len(values):
+            continue
+
+        if len(values) < 2 or values.std() == 0:  # No spread, draw a flat line
+            _ = ax.plot([i - width / 2, i + width / 2], [values.mean()] * 2, color=edge, linewidth=linewidth)
+            continue
+
+        support, density = kde_grid(values)
+        half = density / density.max() * width / 2
+        _ = ax.fill_betweenx(support, i - half, i + half, facecolor=color, edgecolor=edge, linewidth=linewidth)
+
+        stats = boxplot_stats(values)[0]
+        _ = ax.plot([i, i], [stats['whislo'], stats['whishi']], color=edge, linewidth=box_width / 3)
+        _ = ax.plot([i, i], [stats['q1'], stats['q3']], color=edge, linewidth=box_width)
+        _ = ax.plot([i], [stats['med']], marker='_', color=edge, markersize=box_width / 1.2,
+                    markeredgewidth=box_width / 5, markeredgecolor='w', markerfacecolor='w')
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets downsampling of a time series.
+    Keeps the first and last points and, from each of n_out - 2 equal buckets in between,
+    the point forming the largest triangle with the point kept before it and the mean of the
+    next bucket, which preserves peaks and troughs much better than averaging.
+    :return: Sorted indices of the points to keep
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    bounds = (np.arange(n_out - 1) * (n - 2) / (n_out - 2)).astype(np.intp) + 1
+    bounds[-1] = n - 1
+
+    kept = np.empty(n_out, dtype=np.intp)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = bounds[i], bounds[i + 1]
+        next_hi = bounds[i + 2] if i + 2 < len(bounds) else n
+        next_x, next_y = x[hi:next_hi].mean(), y[hi:next_hi].mean()
+
+        area = np.abs((x[a] - next_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (next_y - y[a]))
+        a = lo + int(area.argmax())
+        kept[i + 1] = a
+    return kept
+
+
+def downsample(series: pd.Series, n_out: int) -> pd.Series:
+    """LTTB applied to a series with a datetime index, dropping missing values first."""
+    series = series.dropna()
+    if len(series) <= n_out:
+        return series
+    x = (series.index - series.index[0]) / pd.Timedelta('1D')
+    return series.iloc[lttb(np.asarray(x), series.to_numpy(), n_out)]
+
+
+def line_plot(ax: Axes, series: pd.Series, **kwargs: Any):
+    """Plots a downsampled series against its local wall clock dates, like Series.plot."""
+    index = pd.DatetimeIndex(series.index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    _ = ax.plot(index.to_pydatetime(), series.to_numpy(), **kwargs)
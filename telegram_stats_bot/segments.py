@@ -0,0 +1,223 @@
+# !/usr/bin/env python
+#
+# A logging and statistics bot for Telegram based on python-telegram-bot.
+# Copyright (C) 2020
+# Michael DM Dryden <mk.dryden@utoronto.ca>
+#
+# This file is part of telegram-stats-bot.
+#
+# telegram-stats-bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser Public License for more details.
+#
+# You should have received a copy of the GNU Public License
+# along with this program. If not, see [http://www.gnu.org/licenses/].
+"""
+Binary segment format for the backup store.
+
+A segment is a sequence of records, each a little-endian uint32 payload length followed
+by a msgpack map. Next to every segment, ``<segment>.idx`` holds a sparse index of fixed
+size entries (date in microseconds since the epoch, message_id, byte offset), written for
+the first record, every ``index_every`` records after that and for the last record of a
+closed segment. Lookups bisect the index and stop at the first record past what they look
+for, which needs dates and message ids to be non-decreasing. That holds for messages, which
+are appended in arrival order, but not for edited messages: a segment whose records go back in
+either key gets no index, and lookups in it scan every record.
+"""
+import bisect
+import datetime
+import json
+import mmap
+import os
+import struct
+import sys
+from typing import Any, Callable, Iterator, Optional, Union
+
+import typer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+record_header = struct.Struct('<I')
+index_entry   = struct.Struct('<qqQ')
+
+segment_suffix = '.msgpack'
+index_suffix   = '.idx'
+
+epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def require_msgpack():
+    if msgpack is None:
+        raise ImportError("msgpack segments require the msgpack package (pip install telegram-stats-bot[segments])")
+
+
+def date_to_us(date: Union[str, datetime.datetime, None]) -> int:
+    if date is None:
+        return 0
+    if isinstance(date, str):
+        date = datetime.datetime.fromisoformat(date)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return (date - epoch) // datetime.timedelta(microseconds=1)
+
+
+def pack_record(data: dict[str, Any], default: Callable[[Any], Any]) -> bytes:
+    payload: bytes = msgpack.packb(data, default=default)
+    return record_header.pack(len(payload)) + payload
+
+
+def index_key(data: dict[str, Any]) -> tuple[int, int]:
+    """(date in microseconds, message_id) of a record, both must be non-decreasing in an indexed segment."""
+    return date_to_us(data.get('date')), data.get('message_id') or 0
+
+
+def pack_index_entry(data: dict[str, Any], offset: int) -> bytes:
+    return index_entry.pack(*index_key(data), offset)
+
+
+class SegmentReader(object):
+    """
+    Memory-maps a segment and its index for range lookups by date or message id.
+    Segments without an index are scanned in full.
+    """
+    def __init__(self, path: str):
+        require_msgpack()
+        self.path = path
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+        try:
+            with open(path + index_suffix, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            raw = b''
+        raw = raw[:len(raw) - len(raw) % index_entry.size]  # Ignore partially written entry
+
+        entries = list(index_entry.iter_unpack(raw))
+        self.index_dates    = [entry[0] for entry in entries]
+        self.index_ids      = [entry[1] for entry in entries]
+        self.index_offsets  = [entry[2] for entry in entries]
+        self.ordered        = bool(entries)  # Only segments in key order are indexed
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self) -> 'SegmentReader':
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def records(self, offset: int = 0) -> Iterator[tuple[int, dict[str, Any]]]:
+        """Yields (offset, record) pairs from offset, stopping at a truncated tail."""
+        size = len(self.data)
+        while offset + record_header.size <= size:
+            length, = record_header.unpack_from(self.data, offset)
+            start = offset + record_header.size
+            if start + length > size:
+                break
+            yield offset, msgpack.unpackb(self.data[start:start + length])
+            offset = start + length
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        for _, record in self.records():
+            yield record
+
+    def seek(self, keys: list[int], key: int) -> int:
+        """Offset of the last index entry strictly before key, i.e. the first record that can match."""
+        i = bisect.bisect_left(keys, key) - 1
+        if i < 0:
+            return 0
+        return self.index_offsets[i]
+
+    def date_range(self,
+        start: Optional[datetime.datetime] = None,
+        end:   Optional[datetime.datetime] = None,
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Yields records with start <= date < end.
+        :param start: Inclusive lower bound, naive datetimes are taken as UTC
+        :param end: Exclusive upper bound, naive datetimes are taken as UTC
+        """
+        start_us = date_to_us(start) if start else None
+        end_us   = date_to_us(end)   if end   else None
+
+        offset = self.seek(self.index_dates, start_us) if start_us is not None else 0
+        for _, record in self.records(offset):
+            date_us = date_to_us(record.get('date'))
+            if start_us is not None and date_us < start_us:
+                continue
+            if end_us is not None and date_us >= end_us:
+                if self.ordered:
+                    break
+                continue
+            yield record
+
+    def message(self, message_id: int) -> Optional[dict[str, Any]]:
+        """Returns the first record with message_id, if any."""
+        for _, record in self.records(self.seek(self.index_ids, message_id)):
+            record_id = record.get('message_id') or 0
+            if record_id == message_id:
+                return record
+            if record_id > message_id and self.ordered:
+                break
+        return None
+
+    def bounds(self) -> Optional[tuple[int, int]]:
+        """(first, last) indexed dates in microseconds, None for an unindexed segment."""
+        if not self.index_dates:
+            return None
+        return self.index_dates[0], self.index_dates[-1]
+
+
+def segment_paths(path: str, name: str = '') -> list[str]:
+    """Lists the segments in a backup directory, optionally limited to one stream."""
+    if os.path.isfile(path):
+        return [path]
+
+    return sorted(
+        os.path.join(path, fname) for fname in os.listdir(path)
+            if fname.endswith(segment_suffix) and fname.startswith(f"{name}.")
+    )
+
+
+def main(
+    path:  str,
+    name:  str = 'messages',
+    start: Optional[str] = None,
+    end:   Optional[str] = None,
+):
+    """
+    Print backup records between two dates as JSON lines.
+    :param path: Segment file or backup directory
+    :param name: Stream to read from a backup directory (messages, edited-messages, user_events)
+    :param start: Start timestamp (e.g. 2019-01-01, "2019-01-01 14:21"), UTC
+    :param end: End timestamp (e.g. 2019-01-01, "2019-01-01 14:21"), UTC
+    """
+    start_dt = datetime.datetime.fromisoformat(start) if start else None
+    end_dt   = datetime.datetime.fromisoformat(end)   if end   else None
+
+    for segment in segment_paths(path, name):
+        with SegmentReader(segment) as reader:
+            bounds = reader.bounds()
+            # Closed segments index their last record, so whole segments can be skipped
+            if bounds and end_dt and bounds[0] >= date_to_us(end_dt):
+                continue
+            for record in reader.date_range(start_dt, end_dt):
+                _ = sys.stdout.write(json.dumps(record) + "\n")
+
+
+if __name__ == '__main__':
+    typer.run(main)
@@ -20,22 +20,23 @@
 # along with this program. If not, see [http://www.gnu.org/licenses/].
 
 import logging
+import time
 from sre_compile import dis
 import sys
 from textwrap import dedent
-from typing import IO, Any, Callable, Optional, Sequence, Text, NoReturn, TypedDict, Union
+from typing import IO, Any, Callable, Iterable, Iterator, NamedTuple, Optional, Sequence, Text, NoReturn, TypedDict, Union, get_args, get_origin
 from threading import Lock
+from contextvars import ContextVar
+from contextlib import contextmanager
 from io import BytesIO
 import argparse
 import inspect
 import re
 from datetime import timedelta, datetime
 from matplotlib.axes import Axes
-from pandas._libs.properties import AxisProperty
 from pandas.core.api import DataFrame
-from sqlalchemy.dialects.postgresql import insert
-from sqlalchemy.dialects.postgresql.ext import to_tsquery
-from sqlalchemy.sql.functions import count, current_timestamp, user
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.sql.functions import current_timestamp, user
 from sqlalchemy_utils.aggregates import sqlalchemy
 from typing_extensions import override, reveal_type
 
@@ -43,15 +44,21 @@ import pandas as pd
 import seaborn as sns
 import numpy as np
 from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
 from matplotlib.dates import date2num
-from sqlalchemy.engine import Engine, Row
-from sqlalchemy import desc, select, func, text, update
+from sqlalchemy.engine import Connection, Engine, Row
+from sqlalchemy.exc import DBAPIError
+from psycopg.errors import QueryCanceled
+from sqlalchemy import bindparam, desc, select, func, text, update
 
 from telegram_stats_bot.db.tbl_messages import Message
 from telegram_stats_bot.db.tbl_user_names import UserName
+from telegram_stats_bot.db.tbl_user_names_current import UserNameCurrent
 
-from .utils import escape_markdown, TsStat, random_quote
+from .utils import escape_markdown, TsStat, image_formats, render_modes
 from . import __version__
+from . import plotting, text_search
 
 sns.set_context('paper')
 sns.set_style('whitegrid')
@@ -61,14 +68,224 @@ logging.getLogger('matplotlib').setLevel(logging.WARNING)  # Mute matplotlib deb
 logger = logging.getLogger()
 
 
-def output_fig(fig: Figure) -> BytesIO:
+class EncodeProfile(NamedTuple):
+    dpi:    int
+    tight:  bool  # bbox_inches='tight' costs a second layout pass, figures already use constrained layout
+    colors: int   # Quantize PNGs to a palette of this many colors, 0 keeps true color
+
+
+# Telegram scales photos down to 1280 px on the long side, more pixels are wasted upload
+encode_profiles: dict[str, EncodeProfile] = {
+    'default': EncodeProfile(dpi=200, tight=True,  colors=0),
+    'ecdf':    EncodeProfile(dpi=160, tight=False, colors=64),
+    'hours':   EncodeProfile(dpi=160, tight=False, colors=128),
+    'days':    EncodeProfile(dpi=160, tight=False, colors=64),
+    'heatmap': EncodeProfile(dpi=200, tight=True,  colors=256),  # Square cells leave margins to trim
+    'history': EncodeProfile(dpi=160, tight=False, colors=64),
+    'titles':  EncodeProfile(dpi=100, tight=False, colors=64),
+}
+
+
+def output_fig(fig: Figure, profile: str = 'default', fmt: str = 'png') -> BytesIO:
+    """
+    Encodes a figure for upload.
+    :param profile: Key of encode_profiles
+    :param fmt: 'png' (palette quantized as per profile), 'webp' (lossless) or 'jpeg'
+    """
+    settings = encode_profiles[profile]
     bio = BytesIO()
-    bio.name = 'plot.png'
-    fig.savefig(bio, bbox_inches='tight', dpi=200, format='png') # pyright: ignore[reportUnknownMemberType]
+    bio.name = f'plot.{fmt}'
+
+    if fmt == 'png' and not settings.colors:
+        fig.savefig(bio, bbox_inches='tight' if settings.tight else None, dpi=settings.dpi, format='png') # pyright: ignore[reportUnknownMemberType]
+        _ = bio.seek(0)
+        return bio
+
+    if settings.tight:
+        raw = BytesIO()
+        fig.savefig(raw, bbox_inches='tight', dpi=settings.dpi, format='png') # pyright: ignore[reportUnknownMemberType]
+        image = Image.open(raw).convert('RGB')
+    else:
+        fig.set_dpi(settings.dpi)
+        canvas = FigureCanvasAgg(fig)
+        canvas.draw()
+        image = Image.fromarray(np.asarray(canvas.buffer_rgba())).convert('RGB')
+
+    if fmt == 'png':
+        image = image.quantize(colors=settings.colors, method=Image.Quantize.MEDIANCUT)
+        image.save(bio, format='png', optimize=True)
+    elif fmt == 'webp':
+        image.save(bio, format='webp', lossless=True, method=4)
+    else:
+        image.save(bio, format='jpeg', quality=85, optimize=True)
     _ = bio.seek(0)
     return bio
 
 
+aggregate_min_rows = 2000  # Rows above which 'auto' switches to the aggregate renderers
+
+# Compact dtypes for columns returned by stats queries, applied as frames are read
+frame_dtypes: dict[str, str] = {
+    'messages':   'int32',
+    'msg_count':  'int32',
+    'count':      'int32',
+    'user_count': 'int32',
+    'ndoc':       'int32',
+    'nentry':     'int32',
+    'dow':        'int8',
+    'hour':       'int8',
+    'type':       'category',
+}
+
+# Timestamp columns, converted to the runner's time zone as they are read
+date_columns = ('date', 'day', 'msg_time')
+
+week_days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']  # ISO order
+
+
+class Estimate(NamedTuple):
+    counts:      pd.DataFrame  # 'count' and 'error' (95% margin) indexed by group, largest first
+    total:       int
+    total_error: int
+    percent:     float         # Percent of the table that was sampled
+
+
+def approx_note(percent: float) -> str:
+    return escape_markdown(f"Estimativa com amostra de {percent:.2g}% das mensagens, ± é a margem de erro de 95%.")
+
+
+def sql_conditions(
+    lquery: Optional[str]             = None,
+    mtype:  Optional[str]             = None,
+    start:  Optional[str]             = None,
+    end:    Optional[str]             = None,
+    user:   Optional[tuple[int, str]] = None,
+    ts_config: str                    = text_search.default_ts_config,
+) -> tuple[list[str], dict[str, Any]]:
+    """WHERE conditions on messages_utc and their parameters for the common stats options."""
+    conditions: list[str]      = []
+    params:     dict[str, Any] = {}
+
+    if lquery:
+        params['lquery']    = lquery
+        params['ts_config'] = ts_config
+        conditions.append("text_index_col @@ to_tsquery(CAST(:ts_config AS regconfig), :lquery)")
+
+    if mtype:
+        params['mtype'] = mtype
+        conditions.append("type = :mtype")
+
+    if start:
+        params['start_dt'] = pd.to_datetime(start) # pyright: ignore[reportUnknownMemberType]
+        conditions.append("date >= :start_dt")
+
+    if end:
+        params['end_dt'] = pd.to_datetime(end) # pyright: ignore[reportUnknownMemberType]
+        conditions.append("date < :end_dt")
+
+    if user:
+        params['user'] = user[0]
+        conditions.append("from_user = :user")
+
+    return conditions, params
+
+
+def corr_by_hour_of_week(
+    chunks:   Iterable[pd.DataFrame],
+    user_ids: np.ndarray,
+    me_col:   int,
+    thresh:   float,
+) -> Optional[pd.Series]:
+    """
+    Pearson correlation of one user's messages with every other user's, binned by hour of the week.
+    Chunks of (dow, hour, user, messages) rows are summed into a 168 x users matrix; a bin is used
+    for a pair when either user has messages in it.
+    :return: Correlations indexed by user id, None if there were no rows
+    """
+    sums    = np.zeros((7 * 24, len(user_ids)))
+    present = np.zeros((7 * 24, len(user_ids)), dtype=bool)
+    order   = np.argsort(user_ids)
+    rows    = 0
+
+    for chunk in chunks:
+        cols = order[np.searchsorted(user_ids, chunk['user'].to_numpy(), sorter=order).clip(0, len(user_ids) - 1)]
+        known = user_ids[cols] == chunk['user'].to_numpy()
+        bins = ((chunk['dow'].to_numpy(dtype=np.intp) - 1) * 24 + chunk['hour'].to_numpy(dtype=np.intp))[known]
+        np.add.at(sums, (bins, cols[known]), chunk['messages'].to_numpy()[known])
+        present[bins, cols[known]] = True
+        rows += len(chunk)
+
+    if rows == 0:
+        return None
+
+    totals = sums.sum(axis=0)
+    me = sums[:, me_col]
+    corrs = {}
+    for col, uid in enumerate(user_ids):
+        if col == me_col or totals[col] == 0:
+            continue
+        if totals[me_col] / totals[col] > thresh:
+            idx = present[:, me_col] | present[:, col]
+            corrs[uid] = pd.Series(me[idx]).corr(pd.Series(sums[idx, col]))
+    return pd.Series(corrs, dtype=float)
+
+
+def corr_by_hour(
+    chunks:   Iterable[pd.DataFrame],
+    user_ids: np.ndarray,
+    me_col:   int,
+    thresh:   float,
+) -> Optional[pd.Series]:
+    """
+    Pearson correlation of one user's hourly message counts with every other user's, over the hours
+    where both sent messages. Chunks of (msg_time, user, messages) rows ordered by msg_time are reduced
+    into running sums per user, so only the current chunk is held in memory.
+    :param thresh: Minimum fraction of hours (with messages from any named user) a pair needs
+    :return: Correlations indexed by user id, None if there were no rows
+    """
+    n, sx, sy, sxx, syy, sxy = (np.zeros(len(user_ids)) for _ in range(6))
+    order = np.argsort(user_ids)
+    hours = 0
+    carry = None
+
+    def reduce(df: pd.DataFrame):
+        nonlocal hours
+        cols = order[np.searchsorted(user_ids, df['user'].to_numpy(), sorter=order).clip(0, len(user_ids) - 1)]
+        known = user_ids[cols] == df['user'].to_numpy()
+        df, cols = df.loc[known], cols[known]
+        hours += df['msg_time'].nunique()
+
+        is_me = cols == me_col
+        me_by_time = pd.Series(df['messages'].to_numpy()[is_me], index=df['msg_time'].to_numpy()[is_me])
+        x = df['msg_time'].map(me_by_time).to_numpy(dtype=float)
+        y = df['messages'].to_numpy(dtype=float)
+        pair = ~np.isnan(x) & ~is_me
+
+        for acc, values in ((n, 1.), (sx, x[pair]), (sy, y[pair]), (sxx, x[pair]**2),
+                            (syy, y[pair]**2), (sxy, x[pair] * y[pair])):
+            np.add.at(acc, cols[pair], values)
+
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat((carry, chunk), ignore_index=True)
+        # Hold back the last hour in case the next chunk continues it
+        last = chunk['msg_time'].iloc[-1]
+        carry = chunk.loc[chunk['msg_time'] == last]
+        reduce(chunk.loc[chunk['msg_time'] != last])
+
+    if carry is None:
+        return None
+    reduce(carry)
+
+    min_periods = max(int(thresh * hours), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = (n * sxy - sx * sy) / np.sqrt((n * sxx - sx**2) * (n * syy - sy**2))
+    corr[(n < min_periods) | ~np.isfinite(corr)] = np.nan
+
+    valid = np.arange(len(user_ids)) != me_col
+    return pd.Series(corr[valid], index=user_ids[valid])
+
+
 class HelpException(Exception):
     def __init__(self, msg: Optional[str] = None):
         self.msg = msg
@@ -76,6 +293,17 @@ class HelpException(Exception):
 
 
 class InternalParser(argparse.ArgumentParser):
+    # Parsed arguments of the invocations without options (bare /stats and /stats <subcommand>),
+    # filled in by get_parser
+    fast_paths: dict[tuple[str, ...], dict[str, Any]] = {}
+
+    def parse_command(self, args: Sequence[str]) -> dict[str, Any]:
+        """vars() of the parsed args, invocations without options are looked up instead of parsed."""
+        parsed = self.fast_paths.get(tuple(args))
+        if parsed is not None:
+            return dict(parsed)  # Callers consume it
+        return vars(self.parse_args(args))
+
     @override
     def error(self, message: Text) -> NoReturn:
         try:
@@ -98,7 +326,101 @@ class InternalParser(argparse.ArgumentParser):
         sys.exit(status)
 
 
-StatsRunnerResult = tuple[Optional[str], Optional[bool], Optional[BytesIO]]
+# Set by callers that want plots returned unencoded, so they can reply with text first
+defer_images: ContextVar[bool] = ContextVar('defer_images', default=False)
+
+
+class DeferredImage(object):
+    """
+    A finished figure whose encoding is left to the receiver. It is encoded once, and every
+    render() returns a new buffer, so one result can be shared by several replies.
+    """
+    def __init__(self, fig: Figure, profile: str, fmt: str):
+        self.fig     = fig
+        self.profile = profile
+        self.fmt     = fmt
+        self.encoded: Optional[BytesIO] = None
+        self.lock    = Lock()
+
+    def render(self) -> BytesIO:
+        with self.lock:
+            if self.encoded is None:
+                self.encoded = output_fig(self.fig, self.profile, self.fmt)
+        bio = BytesIO(self.encoded.getvalue())
+        bio.name = self.encoded.name
+        return bio
+
+
+class QueryScope(object):
+    """
+    Statement timeout and cancellation shared by the queries of one stats request.
+    cancel() may be called from any thread, it interrupts the statements running in the scope.
+    """
+    def __init__(self, timeout: float):
+        self.timeout     = timeout
+        self.cancelled   = False
+        self.connections: set[Any] = set()
+        self.lock        = Lock()
+
+    def add(self, connection: Any):
+        with self.lock:
+            self.connections.add(connection)
+
+    def discard(self, connection: Any):
+        with self.lock:
+            self.connections.discard(connection)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.cancel()
+            except Exception:
+                logger.debug("Couldn't cancel query", exc_info=True)
+
+
+query_scope: ContextVar[Optional[QueryScope]] = ContextVar('query_scope', default=None)
+
+query_timeout_msg = "A consulta demorou demais e foi cancelada. Tente um período menor ou uma busca mais simples."
+
+
+StatsRunnerResult = tuple[Optional[str], Optional[bool], Optional[Union[BytesIO, DeferredImage]]]
+
+class Table(NamedTuple):
+    """Tabular result of a stats command, long ones are shown a page of rows at a time."""
+    title:     str        # Markdown before the table
+    frame:     DataFrame  # Rows in display order
+    footer:    str = ""   # Markdown after the table
+    precision: int = 1    # Decimals of float columns
+
+    def render(self, start: int = 0, stop: Optional[int] = None) -> str:
+        rows = self.frame.iloc[start:stop].to_string( # pyright: ignore[reportUnknownMemberType]
+            index  = False,
+            header = True,
+            float_format = lambda x: f"{x:.{self.precision}f}",
+        )
+        return f"{self.title}```\n{rows}\n```{self.footer}"
+
+
+TableResult = Union[Table, str]  # A str is a Markdown message shown instead, e.g. when nothing matched
+
+
+def render_table(table: TableResult) -> StatsRunnerResult:
+    return (table if isinstance(table, str) else table.render()), None, None
+
+
+SearchKey = tuple[float, datetime, int]  # (rank, date, message_id) of a search hit, results are ordered by it
+
+
+class SearchPage(NamedTuple):
+    text:     str                  # Markdown
+    next_key: Optional[SearchKey]  # Key of the last hit if there are more
+
+
+# Matched words in headlines, replaced by bold markup once the headline is escaped
+headline_start, headline_stop = '⟦', '⟧'
 
 
 class StatsRunner(object):
@@ -116,96 +438,426 @@ class StatsRunner(object):
         "types":   "get_type_stats",
         "words":   "get_word_stats",
         "random":  "get_random_message",
+        "search":  "get_message_search",
+    }
+
+    plot_methods = {"ecdf", "hours", "days", "week", "history", "titles"}
+
+    # Seconds each command's queries may run, others use statement_timeout
+    statement_timeouts: dict[str, float] = {
+        "corr":  120,
+        "delta": 120,
+        "words": 120,
     }
 
     engine: Engine
     tz:     str
     users:  dict[int, tuple[str, str]]
-    users_lock: Lock
-
-    def __init__(self, engine: Engine, tz: str = 'Etc/UTC'):
+    users_lock:  Lock
+    read_budget: int
+    render_mode: str
+    plot_width:  int
+    image_format: str
+    statement_timeout: float
+    scopes:      set[QueryScope]
+    read_engine: Optional[Engine]
+    max_replica_lag: Optional[float]
+    ts_config:   str  # Text search configuration of text_index_col
+    parser:      Optional[InternalParser] = None  # /stats parser, see get_parser
+
+    replica_check_interval = 5  # Seconds a replica lag measurement is trusted
+    replica_check_timeout  = 1  # Seconds the lag query may take before the replica counts as lagging
+
+    search_page_size = 10
+
+    approx_sample_rows = 200_000  # Rows read by -approx counts, tables this small are counted exactly
+    approx_periods     = 120      # Days (weeks for one user) read by -approx hours
+
+    def __init__(self, engine: Engine, tz: str = 'Etc/UTC', read_budget: int = 64 * 2**20,
+                 render_mode: str = 'auto', plot_width: int = 1000, image_format: str = 'png',
+                 statement_timeout: float = 30, statement_timeouts: Optional[dict[str, float]] = None,
+                 read_engine: Optional[Engine] = None, max_replica_lag: Optional[float] = None):
+        """
+        :param engine: Database engine
+        :param tz: tz database time zone used for output
+        :param read_budget: Approximate memory in bytes a streamed query may hold at once
+        :param render_mode: 'seaborn' draws every observation, 'aggregate' draws precomputed
+                            summaries (see plotting), 'auto' picks aggregate for long histories
+        :param plot_width: Points kept when downsampling time series plots, about their width in
+                           pixels. 0 plots every point.
+        :param image_format: Plot image format, one of image_formats
+        :param statement_timeout: Seconds a query may run for commands not in statement_timeouts, 0 for no limit
+        :param statement_timeouts: Per command overrides of statement_timeout
+        :param read_engine: Engine for a read replica, stats queries use it instead of engine
+        :param max_replica_lag: Seconds the replica may lag behind before reads go to engine,
+                                None to always use the replica
+        """
         self.engine = engine
+        self.read_engine     = read_engine
+        self.max_replica_lag = max_replica_lag
+        self.replica_ok      = True
+        self.replica_checked = float('-inf')
+        self.replica_checking = False  # A thread is measuring the lag, the others use the last decision
+        self.replica_lock    = Lock()
         self.tz     = tz
         self.users  = self.get_db_users()
-        self.users_lock = Lock()
+        with self.connect(primary=True) as con:
+            self.ts_config = text_search.get_ts_config(con)
+        self.users_lock  = Lock()
+        self.read_budget = read_budget
+        self.render_mode = render_mode
+        self.plot_width  = plot_width
+        self.image_format = image_format
+        self.statement_timeout  = statement_timeout
+        self.statement_timeouts = {**self.statement_timeouts, **(statement_timeouts or {})}
+        self.scopes = set()
+        _ = get_parser(self)
+
+    @contextmanager
+    def scoped(self, method: str) -> Iterator[QueryScope]:
+        """
+        Runs the queries started in this context (and threads it starts) in a new QueryScope
+        with the timeout of method, which cancel_all() can interrupt.
+        """
+        commands = [name for name, func in self.allowed_methods.items() if func == method]
+        timeout  = self.statement_timeouts.get(commands[0], self.statement_timeout) if commands else self.statement_timeout
+
+        scope = QueryScope(timeout)
+        token = query_scope.set(scope)
+        self.scopes.add(scope)
+        try:
+            yield scope
+        finally:
+            self.scopes.discard(scope)
+            query_scope.reset(token)
+
+    def cancel_all(self):
+        """Cancels the queries of every running scope, e.g. on shutdown."""
+        for scope in list(self.scopes):
+            scope.cancel()
+
+    def replica_lag(self) -> float:
+        """Seconds the replica's replayed data is behind the primary, 0 if it has replayed all it received."""
+        assert self.read_engine != None
+
+        query = text("""
+            SELECT CASE
+                WHEN NOT pg_is_in_recovery() THEN 0
+                WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+            END
+        """)
+        with self.read_engine.connect() as con:
+            timeout_ms = str(int(self.replica_check_timeout * 1000))
+            _ = con.execute(text("SELECT set_config('statement_timeout', :timeout, false)"), {'timeout': timeout_ms})
+            try:
+                return float(con.execute(query).scalar_one())
+            finally:
+                try:
+                    _ = con.execute(text("RESET statement_timeout"))
+                except DBAPIError:
+                    con.invalidate()
+
+    def reader(self) -> Engine:
+        """Engine for stats queries: the replica, unless it is lagging or unreachable."""
+        if self.read_engine is None:
+            return self.engine
+        if self.max_replica_lag is None:
+            return self.read_engine
+
+        # The lag is measured outside the lock, so a slow replica only holds up the thread checking it
+        with self.replica_lock:
+            now = time.monotonic()
+            if self.replica_checking or now - self.replica_checked < self.replica_check_interval:
+                return self.read_engine if self.replica_ok else self.engine
+            self.replica_checking = True
+
+        lag, ok = None, False
+        try:
+            lag = self.replica_lag()
+            ok  = lag <= self.max_replica_lag
+        except DBAPIError:
+            logger.warning("Couldn't check read replica lag", exc_info=True)
+        finally:
+            with self.replica_lock:
+                if ok != self.replica_ok:
+                    logger.warning("Read replica %s (lag %s s)", "back in use" if ok else "lagging, reading from primary", lag)
+                self.replica_ok       = ok
+                self.replica_checked  = now
+                self.replica_checking = False
+
+        return self.read_engine if ok else self.engine
+
+    @contextmanager
+    def connect(self, primary: bool = False) -> Iterator[Connection]:
+        """
+        Connection with the statement timeout of the current QueryScope, whose queries can be
+        cancelled. A query cancelled by timeout raises HelpException.
+        :param primary: Read from the primary even if there is a replica, e.g. to see our own writes
+        """
+        scope = query_scope.get()
+        if scope and scope.cancelled:
+            raise HelpException(query_timeout_msg)
+        timeout_ms = int(scope.timeout * 1000) if scope else 0
+
+        engine = self.engine if primary else self.reader()
+        with engine.connect() as con:
+            if timeout_ms:
+                _ = con.execute(text("SELECT set_config('statement_timeout', :timeout, false)"), {'timeout': str(timeout_ms)})
+            driver_con = con.connection.driver_connection
+            if scope:
+                scope.add(driver_con)
+            try:
+                yield con
+            except DBAPIError as e:
+                if isinstance(e.orig, QueryCanceled):
+                    raise HelpException(query_timeout_msg) from e
+                raise
+            finally:
+                if scope:
+                    scope.discard(driver_con)
+                if timeout_ms:  # The engine is in autocommit mode, so the setting outlives the statement
+                    try:
+                        _ = con.execute(text("RESET statement_timeout"))
+                    except DBAPIError:
+                        con.invalidate()
+
+    def output_image(self, fig: Figure, profile: str) -> Union[BytesIO, DeferredImage]:
+        """Encodes fig, or leaves it to the caller if defer_images is set."""
+        if defer_images.get():
+            return DeferredImage(fig, profile, self.image_format)
+        return output_fig(fig, profile, self.image_format)
+
+    def use_aggregate(self, n_rows: int) -> bool:
+        if self.render_mode == 'auto':
+            return n_rows > aggregate_min_rows
+        return self.render_mode == 'aggregate'
+
+    def compact_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Applies frame_dtypes and converts timestamp columns to the runner's time zone."""
+        df = df.astype({col: dtype for col, dtype in frame_dtypes.items() if col in df.columns})
+        for col in date_columns:
+            if col in df.columns:
+                df[col] = pd.to_datetime(df[col], utc=True).dt.tz_convert(self.tz) # pyright: ignore[reportUnknownMemberType]
+        return df
+
+    def read_frame(self, con: Any, query: Any, params: Optional[dict[str, Any]] = None, **kwargs: Any) -> pd.DataFrame:
+        """pd.read_sql_query followed by compact_frame."""
+        df = pd.read_sql_query(query, con, params=params, **kwargs) # pyright: ignore[reportUnknownMemberType]
+        return self.compact_frame(df)
+
+    def user_names(self) -> pd.Series:
+        """Usernames indexed by user id, as a categorical series."""
+        return pd.Series({uid: value[0] for uid, value in self.users.items()}, name="user", dtype='category')
+
+    def read_sql_chunks(self, query: Any, params: Optional[dict[str, Any]] = None,
+                        row_bytes: int = 128) -> Iterator[pd.DataFrame]:
+        """
+        Streams a query through a server-side cursor as DataFrames of at most
+        read_budget // row_bytes rows, so peak memory doesn't depend on result size.
+        :param query: SQLAlchemy selectable or text clause
+        :param params: Bound parameters
+        :param row_bytes: Estimated memory per row, including driver overhead
+        """
+        chunksize = max(self.read_budget // row_bytes, 1)
+        with self.connect() as con:
+            # psycopg can only declare a server-side cursor in a transaction, which the
+            # autocommit engine doesn't open, so this connection leaves autocommit while streaming
+            con.commit()
+            _ = con.execution_options(isolation_level='READ COMMITTED', stream_results=True, max_row_buffer=chunksize)
+            try:
+                with con.begin():
+                    for chunk in pd.read_sql_query(query, con, params=params, chunksize=chunksize): # pyright: ignore[reportUnknownMemberType]
+                        yield self.compact_frame(chunk)
+            finally:
+                _ = con.execution_options(isolation_level='AUTOCOMMIT', stream_results=False)
+
+    def estimate_counts(self, group: str, conditions: list[str], params: dict[str, Any]) -> Optional[Estimate]:
+        """
+        Estimates count(*) of matching messages grouped by the group expression from a
+        TABLESAMPLE SYSTEM sample of about approx_sample_rows rows. SYSTEM samples whole pages,
+        so the margin of error comes from the spread of the counts between sampled pages.
+        :return: None if the table is small (or not analyzed yet) and should be counted exactly
+        """
+        with self.connect() as con:
+            rows, pages = con.execute(text(
+                "SELECT reltuples, relpages FROM pg_class WHERE oid = 'messages_utc'::regclass"
+            )).one()
+
+        if rows <= self.approx_sample_rows or pages <= 0:
+            return None
+        fraction = self.approx_sample_rows / rows
+        blocks   = max(fraction * pages, 2)  # Expected number of sampled pages
 
-    def get_message_user_ids(self) -> list[int]:
-        """Returns list of unique user ids from messages in database."""
+        query_where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"""
+                WITH blocks AS (
+                    SELECT {group} as grp, (ctid::text::point)[0] as blk, count(*) as y
+                    FROM messages_utc TABLESAMPLE SYSTEM (CAST(:sample_pct AS real))
+                    {query_where}
+                    GROUP BY grp, blk
+                ), totals AS (
+                    SELECT sum(y) as n, sum(y * y) as n2
+                    FROM (SELECT sum(y) as y FROM blocks GROUP BY blk) t
+                )
+                SELECT grp, sum(y) as n, sum(y * y) as n2, totals.n as total_n, totals.n2 as total_n2
+                FROM blocks CROSS JOIN totals
+                GROUP BY grp, totals.n, totals.n2
+                """
+        with self.connect() as con:
+            df = pd.read_sql_query(text(query), con, params={**params, 'sample_pct': fraction * 100}) # pyright: ignore[reportUnknownMemberType]
+
+        def estimate(n: pd.Series, n2: pd.Series) -> tuple[pd.Series, pd.Series]:
+            n  = n.astype(float)
+            s2 = ((n2.astype(float) - n**2 / blocks) / (blocks - 1)).clip(lower=0)  # Variance between pages
+            return (n / fraction).round().astype('int64'), \
+                   (1.96 * np.sqrt((1 - fraction) / fraction**2 * blocks * s2)).round().astype('int64')
+
+        df['count'], df['error'] = estimate(df['n'], df['n2'])
+        total, total_error = estimate(df['total_n'], df['total_n2'])
+
+        counts = df.set_index('grp')[['count', 'error']].sort_values('count', ascending=False)
+        return Estimate(
+            counts      = counts,
+            total       = int(total.iloc[0]) if len(df) else 0,
+            total_error = int(total_error.iloc[0]) if len(df) else 0,
+            percent     = fraction * 100,
+        )
+
+    def get_message_user_ids(self, since: Optional[datetime] = None) -> list[int]:
+        """
+        Returns list of unique user ids from messages in database.
+        :param since: Only include users with messages at or after this time
+        """
         query = select(Message.from_user.distinct())
-        with self.engine.connect() as con:
+        if since:
+            query = query.where(Message.date >= since)
+        with self.connect() as con:
             result = con.execute(query)
         return [ user for user, in result.fetchall() if user is not None ] # pyright: ignore[reportAny]
 
     def get_db_users(self) -> dict[int, tuple[str, str]]:
         """Returns dictionary mapping user ids to usernames and full names."""
 
-        subquery = select(
-            UserName.user_id,
-            UserName.username,
-            UserName.display_name,
-            func.row_number()
-                .over(
-                    partition_by = UserName.user_id,
-                    order_by     = desc(UserName.date),
-                )
-                .label("rn"),
-        ).alias("t")
-
+        # SELECT user_id, username, display_name FROM user_names_current;
         query = select(
-            subquery.columns["user_id"],
-            subquery.columns["username"],
-            subquery.columns["display_name"],
-        ).where(subquery.columns["rn"] == 1)
+            UserNameCurrent.user_id,
+            UserNameCurrent.username,
+            UserNameCurrent.display_name,
+        )
 
-        with self.engine.connect() as con:
+        with self.connect(primary=True) as con:  # Called right after update_user_ids
             result = con.execute(query)
 
         return { row[0]: (row[1], row[2]) for row in result }
 
-    def update_user_ids(self, user_dict: dict[int, tuple[str, str]]):
+    def update_user_ids(self, user_dict: dict[int, tuple[str, Optional[str]]]):
         """
-        Updates user names table with user_dict
-        :param user_dict: mapping of user ids to (username, display name)
+        Updates user names table with user_dict in a single statement
+        :param user_dict: mapping of user ids to (username, display name). A display name of None
+                          only updates the username, without inserting a new row.
         """
-        for uid in user_dict:
-            username, display_name = user_dict[uid]
+        if not user_dict:
+            return
+
+        # O BD não é normalizado. As queries originais estão preservadas nos comentários.
+        # Sempre insere-se os dados do usuário de novo, e atualiza username se mudar.
+        # Não usamos Session.add para representar essas operações pois a semântica
+        # não é exatamente a mesma.
+        # Todos os usuários vão em três arrays, então é uma só ida ao banco.
+
+        new = func.unnest(
+            bindparam('user_ids',      type_=ARRAY(UserName.user_id.type)),
+            bindparam('usernames',     type_=ARRAY(UserName.username.type)),
+            bindparam('display_names', type_=ARRAY(UserName.display_name.type)),
+        ).table_valued('user_id', 'username', 'display_name').render_derived(name='new')
+
+        # UPDATE user_names
+        # SET username = new.username
+        # FROM unnest(:user_ids, :usernames, :display_names) AS new(user_id, username, display_name)
+        # WHERE user_names.user_id = new.user_id AND user_names.username IS DISTINCT FROM new.username;
+        update_query = (update(UserName)
+            .values(username = new.c.username)
+            .where(
+                UserName.user_id == new.c.user_id,
+                UserName.username.is_distinct_from(new.c.username),
+            )
+            .returning(UserName.user_id)
+            .cte('updated')
+        )
 
-            # O BD não é normalizado. As queries originais estão preservadas nos comentários.
-            # Sempre insere-se os dados do usuário de novo, e atualiza username se mudar.
-            # Não usamos Session.add para representar essas operações pois a semântica
-            # não é exatamente a mesma.
-            
-            # INSERT INTO user_names(user_id, date, username, display_name)
-            # VALUES (:uid, current_timestamp, :username, :display_name);
-            insert_query = insert(UserName).values(
-                user_id      = uid,
-                date         = current_timestamp(),
-                username     = username,
-                display_name = display_name,
+        # user_names_current guarda só a última linha de cada usuário.
+        # Os dois conjuntos são disjuntos, pois uma linha não pode ser alterada duas vezes no mesmo comando.
+
+        # UPDATE user_names_current
+        # SET username = new.username
+        # FROM unnest(:user_ids, :usernames, :display_names) AS new(user_id, username, display_name)
+        # WHERE user_names_current.user_id = new.user_id AND new.display_name IS NULL;
+        rename_current_query = (update(UserNameCurrent)
+            .values(username = new.c.username)
+            .where(
+                UserNameCurrent.user_id == new.c.user_id,
+                new.c.display_name.is_(None),
             )
+            .returning(UserNameCurrent.user_id)
+            .cte('renamed_current')
+        )
 
-            # UPDATE user_names
-            # SET username = :username
-            # WHERE user_id = :uid AND username IS DISTINCT FROM :username;
-            update_query = (update(UserName)
-                .values(display_name = display_name)
-                .where(
-                    UserName.user_id == uid,
-                    UserName.display_name.is_distinct_from(display_name),
-                )
+        # INSERT INTO user_names_current(user_id, date, username, display_name)
+        # SELECT user_id, current_timestamp, username, display_name
+        # FROM unnest(:user_ids, :usernames, :display_names) AS new(user_id, username, display_name)
+        # WHERE display_name IS NOT NULL
+        # ON CONFLICT (user_id) DO UPDATE
+        # SET date = excluded.date, username = excluded.username, display_name = excluded.display_name;
+        upsert_current = (insert(UserNameCurrent)
+            .from_select(
+                ['user_id', 'date', 'username', 'display_name'],
+                select(new.c.user_id, current_timestamp(), new.c.username, new.c.display_name)
+                    .where(new.c.display_name.is_not(None)),
+            )
+        )
+        upsert_current_query = (upsert_current
+            .on_conflict_do_update(
+                index_elements = [UserNameCurrent.user_id],
+                set_           = {
+                    'date':         upsert_current.excluded.date,
+                    'username':     upsert_current.excluded.username,
+                    'display_name': upsert_current.excluded.display_name,
+                },
+            )
+            .returning(UserNameCurrent.user_id)
+            .cte('upserted_current')
+        )
+
+        # INSERT INTO user_names(user_id, date, username, display_name)
+        # SELECT user_id, current_timestamp, username, display_name
+        # FROM unnest(:user_ids, :usernames, :display_names) AS new(user_id, username, display_name)
+        # WHERE display_name IS NOT NULL;
+        insert_query = (insert(UserName)
+            .from_select(
+                ['user_id', 'date', 'username', 'display_name'],
+                select(new.c.user_id, current_timestamp(), new.c.username, new.c.display_name)
+                    .where(new.c.display_name.is_not(None)),
             )
+            .add_cte(update_query, rename_current_query, upsert_current_query)
+        )
+
+        params = {
+            'user_ids':      list(user_dict),
+            'usernames':     [username for username, _ in user_dict.values()],
+            'display_names': [display_name or None for _, display_name in user_dict.values()],
+        }
 
-            with self.engine.connect() as con:
-                _ = con.execute(update_query)
-                if display_name:
-                    _ = con.execute(insert_query)
+        with self.engine.begin() as con:
+            _ = con.execute(insert_query, params)
 
     def get_chat_counts(self,
-        n:      int = 20,
-        lquery: str = "",
-        mtype:  str = "",
-        start:  str = "",
-        end:    str = "",
+        n:      int  = 20,
+        lquery: str  = "",
+        mtype:  str  = "",
+        start:  str  = "",
+        end:    str  = "",
+        approx: bool = False,
     ) -> StatsRunnerResult:
         """
         Get top chat users
@@ -214,29 +866,22 @@ class StatsRunner(object):
         :param n: Number of users to show
         :param start: Start timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
+        :param approx: Estimate from a sample of the messages, much faster for long periods
         """
+        return render_table(self.counts_table(n, lquery, mtype, start, end, approx))
+
+    def counts_table(self,
+        n:      int  = 20,
+        lquery: str  = "",
+        mtype:  str  = "",
+        start:  str  = "",
+        end:    str  = "",
+        approx: bool = False,
+    ) -> TableResult:
+        """Table of get_chat_counts."""
         if n <= 0:
             raise HelpException(f'n must be greater than 0, got: {n}')
 
-        count_lbl = "msg_count"
-        count_col = count().label(count_lbl)
-
-        # SELECT "from_user", COUNT(*) as "count"
-        # FROM "messages_utc"
-        # {query_where}
-        # GROUP BY "from_user"
-        # ORDER BY "count" DESC;
-        query = (select(Message.from_user, count_col)
-            .group_by(Message.from_user)
-            .order_by(count_col.desc())
-        )
-
-        if lquery:
-            query = query.where(
-                Message.text_index_col
-                    .bool_op("@@")(to_tsquery(lquery)) # .match(lquery) uses plainto_tsquery instead
-            )
-
         if mtype:
             valid_mtype = (
                 'text',  'sticker', 'photo',    'animation',
@@ -245,44 +890,49 @@ class StatsRunner(object):
             )
             if mtype not in valid_mtype:
                 raise HelpException(f'mtype {mtype} is invalid.')
-            query = query.where(Message.type == mtype)
 
-        if start:
-            query = query.where(Message.date >= pd.to_datetime(start)) # pyright: ignore[reportUnknownMemberType]
+        # Same conditions for the exact count and the estimate
+        query_conditions, sql_dict = sql_conditions(lquery=lquery, mtype=mtype, start=start, end=end, ts_config=self.ts_config)
 
-        if end:
-            query = query.where(Message.date < pd.to_datetime(end)) # pyright: ignore[reportUnknownMemberType] 
+        count_lbl = "msg_count"
+        query_where = f"WHERE {' AND '.join(query_conditions)}" if query_conditions else ""
+        query = f"""
+                    SELECT from_user, count(*) as {count_lbl}
+                    FROM messages_utc
+                    {query_where}
+                    GROUP BY from_user
+                    ORDER BY {count_lbl} DESC;
+                """
+
+        estimate = None
+        if approx:
+            estimate = self.estimate_counts('from_user', query_conditions, sql_dict)
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(query, con, index_col='from_user') # pyright: ignore[reportUnknownMemberType]
+        if estimate:
+            df = estimate.counts.rename(columns={'count': count_lbl})
+        else:
+            with self.connect() as con:
+                df = self.read_frame(con, text(query), sql_dict, index_col='from_user')
 
         if len(df) == 0:
-            return "Sem mensagens correspondente", None, None
+            return "Sem mensagens correspondente"
 
         # Filters out @usernames
-        user_df = pd.Series(self.users, name="user") # pyright: ignore[reportUnknownVariableType]
-        user_df = user_df.apply(lambda x: x[0])      # pyright: ignore[reportUnknownLambdaType, reportUnknownMemberType, reportUnknownVariableType]
-        df = df.join(user_df)                        # pyright: ignore[reportUnknownMemberType]
+        df = df.join(self.user_names()) # pyright: ignore[reportUnknownMemberType]
 
         msg_count      = df[count_lbl]                     # pyright: ignore[reportUnknownVariableType]
         df['Percent']  = msg_count / msg_count.sum() * 100 # pyright: ignore[reportUnknownMemberType]
-        df             = df[['user', count_lbl, 'Percent']]
+        df             = df[['user', count_lbl, 'Percent'] + (['error'] if estimate else [])]
 
         if mtype:
-            df.columns = ['User', mtype, 'Percent']
+            columns = ['User', mtype, 'Percent']
         elif lquery:
-            df.columns = ['User', 'lquery', 'Percent']
+            columns = ['User', 'lquery', 'Percent']
         else:
-            df.columns = ['User', 'Total Messages', 'Percent']
+            columns = ['User', 'Total Messages', 'Percent']
+        df.columns = columns + (['±'] if estimate else [])
 
-        out_text  = "```\n"
-        out_text += df.iloc[:n].to_string( # pyright: ignore[reportUnknownMemberType]
-            index  = False,
-            header = True,
-            float_format = lambda x: f"{x:.1f}",
-        )
-        out_text += "```"
-        return out_text, None, None
+        return Table("", df.iloc[:n], footer=f"\n{approx_note(estimate.percent)}" if estimate else "")
 
     def get_chat_ecdf(self,
         lquery: str  = "",
@@ -290,6 +940,7 @@ class StatsRunner(object):
         start:  str  = "",
         end:    str  = "",
         log:    bool = False,
+        approx: bool = False,
     ) -> StatsRunnerResult:
         """
         Get message counts by number of users as an ECDF plot.
@@ -298,26 +949,8 @@ class StatsRunner(object):
         :param start: Start timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param log: Plot with log scale.
+        :param approx: Estimate from a sample of the messages, much faster for long periods
         """
-        count_lbl = "msg_count"
-        count_col = count().label(count_lbl)
-
-        # SELECT "from_user", COUNT(*) as "count"
-        # FROM "messages_utc"
-        # {query_where}
-        # GROUP BY "from_user"
-        # ORDER BY "count" DESC;
-        query = (select(Message.from_user, count_col)
-            .group_by(Message.from_user)
-            .order_by(count_col.desc())
-        )
-
-        if lquery:
-            query = query.where(
-                Message.text_index_col
-                    .bool_op("@@")(to_tsquery(lquery))
-            )
-
         if mtype:
             valid_mtype = (
                 'text',  'sticker', 'photo',    'animation',
@@ -326,20 +959,31 @@ class StatsRunner(object):
             )
             if mtype not in valid_mtype:
                 raise HelpException(f'mtype {mtype} is invalid.')
-            query = query.where(Message.type == mtype)
 
-        if start:
-            query = query.where(Message.date >= pd.to_datetime(start)) # pyright: ignore[reportUnknownMemberType]
+        # Same conditions for the exact count and the estimate
+        query_conditions, sql_dict = sql_conditions(lquery=lquery, mtype=mtype, start=start, end=end, ts_config=self.ts_config)
 
-        if end:
-            query = query.where(Message.date < pd.to_datetime(end)) # pyright: ignore[reportUnknownMemberType] 
+        count_lbl = "msg_count"
+        query_where = f"WHERE {' AND '.join(query_conditions)}" if query_conditions else ""
+        query = f"""
+                    SELECT from_user, count(*) as {count_lbl}
+                    FROM messages_utc
+                    {query_where}
+                    GROUP BY from_user
+                    ORDER BY {count_lbl} DESC;
+                """
+
+        estimate = None
+        if approx:
+            estimate = self.estimate_counts('from_user', query_conditions, sql_dict)
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(query, con) # pyright: ignore[reportUnknownMemberType] 
+        if estimate:
+            df = estimate.counts.rename(columns={'count': count_lbl}).rename_axis('from_user').reset_index()
+        else:
+            with self.connect() as con:
+                df = self.read_frame(con, text(query), sql_dict)
         
-        user_df = pd.Series(self.users, name="user") # pyright: ignore[reportUnknownVariableType]
-        user_df = user_df.apply(lambda x: x[0])      # pyright: ignore[reportUnknownMemberType, reportUnknownLambdaType, reportUnknownVariableType]
-        df = df.join(user_df, on='from_user')        # pyright: ignore[reportUnknownMemberType]
+        df = df.join(self.user_names(), on='from_user') # pyright: ignore[reportUnknownMemberType]
         
         if len(df) == 0:
             return "No matching messages", None, None
@@ -358,7 +1002,7 @@ class StatsRunner(object):
 
         sns.despine(fig=fig)
 
-        bio = output_fig(fig)
+        bio = self.output_image(fig, 'ecdf')
 
         user_list = (', '
             .join([
@@ -371,117 +1015,153 @@ class StatsRunner(object):
         lgd += "por usuários, ou seja, quantos usuários contribuíram para dada "
         lgd += "quantidade de mensagens.\n\n"
         lgd += f"Os cinco que mais contribuíram para o total de mensagens foram: {user_list}."
+        if estimate:
+            lgd += f"\n\n{approx_note(estimate.percent)}"
         return lgd, None, bio
 
     def get_counts_by_hour(self,
         user:   Optional[tuple[int, str]] = None,
         lquery: Optional[str] = None,
         start:  Optional[str] = None,
-        end:    Optional[str] = None
+        end:    Optional[str] = None,
+        approx: bool          = False,
     ) -> StatsRunnerResult:
         """
         Get plot of messages for hours of the day
         :param lquery: Limit results to lexical query (&, |, !, <n>)
         :param start: Start timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
+        :param approx: Estimate from randomly chosen days, much faster for long periods
         """
-        query_conditions: list[str]   = []
-        sql_dict: dict[str, Union[int, datetime]] = {}
-
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start) # pyright: ignore[reportUnknownMemberType]  
-            query_conditions.append("date >= :start_dt")  
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)  # pyright: ignore[reportUnknownMemberType]   
-            query_conditions.append("date < :end_dt")
-
-        if user:
-            sql_dict['user'] = user[0]
-            query_conditions.append("from_user = :user")
+        query_conditions, sql_dict = sql_conditions(lquery=lquery, start=start, end=end, user=user, ts_config=self.ts_config)
 
         query_where = ""
         if query_conditions:
             query_where = f"WHERE {' AND '.join(query_conditions)}"
 
+        # One row per local hour of the covered range (at least a day), zero-filled,
+        # summed over weeks when looking at a single user
+        sql_dict['tz']     = self.tz
+        sql_dict['period'] = 7 if user else 1
+        sql_dict['n_periods'] = self.approx_periods
+
+        # The plot shows how the counts are distributed over days (weeks), so -approx reads
+        # the messages of approx_periods random ones, each found with a range scan on date
+        approx_query = f"""
+                 WITH bounds AS (
+                     SELECT (min(date) AT TIME ZONE :tz)::date as lo, (max(date) AT TIME ZONE :tz)::date as hi
+                     FROM messages_utc
+                     {query_where}
+                 ), periods AS (
+                     SELECT bounds.lo + p * :period as first_day, count(*) OVER () as total
+                     FROM bounds CROSS JOIN generate_series(0, (bounds.hi - bounds.lo) / :period) as p
+                     ORDER BY random()
+                     LIMIT :n_periods
+                 ), msgs AS (
+                     SELECT date_trunc('hour', date AT TIME ZONE :tz) as msg_time, count(*) as messages
+                     FROM periods
+                          JOIN messages_utc ON date >= periods.first_day::timestamp AT TIME ZONE :tz
+                                           AND date <  (periods.first_day + :period)::timestamp AT TIME ZONE :tz
+                     {query_where}
+                     GROUP BY msg_time
+                 )
+                 SELECT extract(HOUR FROM t.msg_time)::int as hour, periods.first_day as period,
+                        sum(coalesce(msgs.messages, 0))::int as messages, max(periods.total) as total
+                 FROM periods
+                      CROSS JOIN generate_series(periods.first_day::timestamp,
+                                                 (periods.first_day + :period)::timestamp - interval '1 hour',
+                                                 interval '1 hour') as t(msg_time)
+                      LEFT JOIN msgs ON msgs.msg_time = t.msg_time
+                 GROUP BY hour, period
+                 ORDER BY period, hour
+                 """
         query = f"""
-                 SELECT date_trunc('hour', date) as day, count(*) as messages
-                 FROM messages_utc
-                 {query_where}
-                 GROUP BY day
-                 ORDER BY day
+                 WITH msgs AS (
+                     SELECT date_trunc('hour', date AT TIME ZONE :tz) as msg_time, count(*) as messages
+                     FROM messages_utc
+                     {query_where}
+                     GROUP BY msg_time
+                 ), bounds AS (
+                     SELECT min(msg_time) as lo, greatest(max(msg_time), min(msg_time) + interval '23 hours') as hi
+                     FROM msgs
+                 )
+                 SELECT extract(HOUR FROM t.msg_time)::int as hour,
+                        (t.msg_time::date - bounds.lo::date) / :period as period,
+                        sum(coalesce(msgs.messages, 0))::int as messages
+                 FROM bounds
+                      CROSS JOIN generate_series(bounds.lo, bounds.hi, interval '1 hour') as t(msg_time)
+                      LEFT JOIN msgs ON msgs.msg_time = t.msg_time
+                 GROUP BY hour, period
+                 ORDER BY period, hour
                  """
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)  # pyright: ignore[reportUnknownMemberType]   
+        with self.connect() as con:
+            df = self.read_frame(con, text(approx_query if approx else query), sql_dict)  # pyright: ignore[reportUnknownMemberType]   
 
         if len(df) == 0:
             return "Sem mensagem correspondente", None, None
 
-        df['day'] = pd.to_datetime(df.day) # pyright: ignore[reportUnknownMemberType, reportUnknownArgumentType]   
-        df['day'] = df.day.dt.tz_convert(self.tz)  # pyright: ignore[reportUnknownMemberType]
-        df = df.set_index('day') # pyright: ignore[reportUnknownMemberType]
-        df = df.asfreq('h', fill_value=0)  # Insert 0s for periods with no messages
-        assert type(df) == pd.DataFrame
-        assert type(df.index) == AxisProperty
-
-        if (df.index.max() - df.index.min()) < pd.Timedelta('24 hours'):  # Deal with data covering < 24 hours
-            df = df.reindex(pd.date_range(df.index.min(), periods=24, freq='h')) # pyright: ignore[reportUnknownMemberType]
-            assert type(df.index) == AxisProperty
-
-        df['hour'] = df.index.hour
-
-        if user:
-            # Aggregate over 1 week periods
-            df = df.groupby('hour').resample('7D').sum().drop(columns='hour') # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType] 
-            assert type(df) == pd.DataFrame # pyright: ignore[reportUnknownArgumentType]  
-            df['hour'] = df.index.get_level_values('hour') # pyright: ignore[reportUnknownMemberType] 
+        lgd = None
+        if approx:
+            sampled, total = df['period'].nunique(), int(df['total'].max())
+            if sampled < total:
+                # Margin of error of each hour's mean, with the finite population correction
+                by_hour = df.groupby('hour')['messages']
+                error   = 1.96 * by_hour.std() / np.sqrt(sampled) * np.sqrt(1 - sampled / total)
+                lgd = escape_markdown(
+                    f"Estimativa com {sampled} de {total} {'semanas' if user else 'dias'} sorteados, "
+                    f"a média de cada hora tem margem de erro de até ±{error.max():.1f} mensagens (95%)."
+                )
 
         fig = Figure(constrained_layout=True)
         subplot = fig.subplots() # pyright: ignore[reportUnknownMemberType] 
 
-        CommonKeywordArgs = TypedDict("CommonKeywordArgs", {
-            "x":       str,
-            "y":       str,
-            "hue":     str,
-            "data":    DataFrame,
-            "ax":      Axes,
-            "legend":  bool,
-            "palette": str,
-        })
-
-        plot_common_kwargs: CommonKeywordArgs = {
-            "x":      "hour",
-            "y":      "messages",
-            "hue":    "hour",
-            "data":    df,
-            "ax":      subplot,
-            "legend":  False,
-            "palette": "flare"
-        }
-        
-        _ = sns.stripplot(
-            jitter = 0.4,
-            size   = 2,
-            alpha  = 0.5,
-            zorder = 1,
-            **plot_common_kwargs
-        )
+        if self.use_aggregate(len(df)):
+            groups = [df.loc[df['hour'] == hour, 'messages'].to_numpy() for hour in range(24)]
+            colors = sns.color_palette("flare", 24)
+            plotting.strip_plot(subplot, groups, colors, jitter=0.4, size=2, alpha=0.5, zorder=1)
+            plotting.box_plot(subplot, groups, colors, whis=1, zorder=10)
+            _ = subplot.set_xticks(range(24))
+            _ = subplot.set_xlabel('hour') # pyright: ignore[reportUnknownMemberType]
+        else:
+            CommonKeywordArgs = TypedDict("CommonKeywordArgs", {
+                "x":       str,
+                "y":       str,
+                "hue":     str,
+                "data":    DataFrame,
+                "ax":      Axes,
+                "legend":  bool,
+                "palette": str,
+            })
+
+            plot_common_kwargs: CommonKeywordArgs = {
+                "x":      "hour",
+                "y":      "messages",
+                "hue":    "hour",
+                "data":    df,
+                "ax":      subplot,
+                "legend":  False,
+                "palette": "flare"
+            }
+
+            _ = sns.stripplot(
+                jitter = 0.4,
+                size   = 2,
+                alpha  = 0.5,
+                zorder = 1,
+                **plot_common_kwargs
+            )
 
-        _ = sns.boxplot(
-            whis         = 1,
-            showfliers   = False,
-            whiskerprops = {"zorder": 10},
-            boxprops     = {"zorder": 10},
-            zorder       = 10,
-            **plot_common_kwargs
-        )
-        
-        top = df['messages'].quantile(0.999, interpolation='higher') # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType] 
-        assert type(top) == float                                    # pyright: ignore[reportUnknownArgumentType]
+            _ = sns.boxplot(
+                whis         = 1,
+                showfliers   = False,
+                whiskerprops = {"zorder": 10},
+                boxprops     = {"zorder": 10},
+                zorder       = 10,
+                **plot_common_kwargs
+            )
+
+        top = float(df['messages'].quantile(0.999, interpolation='higher')) # pyright: ignore[reportUnknownMemberType, reportUnknownArgumentType]
         _ = subplot.set_ylim(bottom=0, top=top)
 
         _ = subplot.axvspan(11.5, 23.5, zorder=0, color=(0, 0, 0, 0.05)) # pyright: ignore[reportUnknownMemberType]  
@@ -498,8 +1178,8 @@ class StatsRunner(object):
             _ = subplot.set_title("Mensagens por Hora") # pyright: ignore[reportUnknownMemberType]   
 
         sns.despine(fig=fig)
-        bio = output_fig(fig)
-        return None, None, bio
+        bio = self.output_image(fig, 'hours')
+        return lgd, None, bio
 
     def get_counts_by_day(self,
         user:   Optional[tuple[int, str]] = None,
@@ -515,62 +1195,54 @@ class StatsRunner(object):
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param plot: Type of plot. ('box' or 'violin')
         """
-        query_conditions: list[str] = []
-        sql_dict: dict[str, Union[datetime, int]] = {}
-
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start) # pyright: ignore[reportUnknownMemberType]
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end) # pyright: ignore[reportUnknownMemberType]  
-            query_conditions.append("date < :end_dt")
-
-        if user:
-            sql_dict['user'] = user[0]
-            query_conditions.append("from_user = :user")
+        query_conditions, sql_dict = sql_conditions(lquery=lquery, start=start, end=end, user=user, ts_config=self.ts_config)
 
         query_where = ""
         if query_conditions:
             query_where = f"WHERE {' AND '.join(query_conditions)}"
 
+        # One row per local day of the covered range (at least a week), zero-filled
+        sql_dict['tz'] = self.tz
         query = f"""
-                     SELECT date_trunc('day', date)
-                         as day, count(*) as messages
-                     FROM messages_utc
-                     {query_where}
-                     GROUP BY day
-                     ORDER BY day
+                     WITH msgs AS (
+                         SELECT (date AT TIME ZONE :tz)::date as day, count(*) as messages
+                         FROM messages_utc
+                         {query_where}
+                         GROUP BY day
+                     ), bounds AS (
+                         SELECT min(day) as lo, greatest(max(day), min(day) + 6) as hi
+                         FROM msgs
+                     )
+                     SELECT extract(ISODOW FROM t.day)::int as dow, coalesce(msgs.messages, 0) as messages
+                     FROM bounds
+                          CROSS JOIN generate_series(bounds.lo::timestamp, bounds.hi::timestamp, interval '1 day') as t(day)
+                          LEFT JOIN msgs ON msgs.day = t.day::date
+                     ORDER BY dow, t.day
                  """
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict) # pyright: ignore[reportUnknownMemberType]    
+        with self.connect() as con:
+            df = self.read_frame(con, text(query), sql_dict) # pyright: ignore[reportUnknownMemberType]    
 
         if len(df) == 0:
             return "Sem mensagem correspondente", None, None
 
-        df['day'] = pd.to_datetime(df.day)        # pyright: ignore[reportUnknownMemberType, reportUnknownArgumentType]
-        df['day'] = df.day.dt.tz_convert(self.tz) # pyright: ignore[reportUnknownMemberType] 
-        df = df.set_index('day')                  # pyright: ignore[reportUnknownMemberType] 
-        df = df.asfreq('d', fill_value=0)  # Fill periods with no messages
-
-        assert type(df) == pd.DataFrame
-        assert type(df.index) == AxisProperty
-
-        if (df.index.max() - df.index.min()) < pd.Timedelta('7 days'):  # Deal with data covering < 7 days
-            df = df.reindex(pd.date_range(df.index.min(), periods=7, freq='d')) # pyright: ignore[reportUnknownMemberType]  
-            assert type(df.index) == AxisProperty
+        df['day_name'] = [week_days[dow - 1] for dow in df['dow']]
 
-        df['dow'] = df.index.weekday
-        df['day_name'] = df.index.day_name()
-        df = df.sort_values('dow')  # Make sure start is Monday # pyright: ignore[reportUnknownMemberType]   
+        if plot not in ('box', 'violin', None):
+            raise HelpException("plot precisa ser 'box' ou 'violin'")
 
         fig = Figure(constrained_layout=True)
         subplot = fig.subplots() # pyright: ignore[reportUnknownMemberType]   
-        if plot == 'box':
+        if self.use_aggregate(len(df)):
+            day_names = df['day_name'].unique()
+            groups    = [df.loc[df['day_name'] == name, 'messages'].to_numpy() for name in day_names]
+            color     = sns.color_palette()[2]
+            if plot == 'box':
+                plotting.box_plot(subplot, groups, [color] * len(groups), whis=1)
+            else:
+                plotting.violin_plot(subplot, groups, color)
+            _ = subplot.set_xticks(range(len(day_names)), day_names)
+        elif plot == 'box':
             _ = sns.boxplot(
                 x    = 'day_name',
                 y    = 'messages',
@@ -580,7 +1252,7 @@ class StatsRunner(object):
                 ax    = subplot,
                 color = sns.color_palette()[2],
             )
-        elif plot == 'violin' or plot is None:
+        else:
             _ = sns.violinplot(
                 x    = 'day_name',
                 y    = 'messages',
@@ -591,8 +1263,6 @@ class StatsRunner(object):
                 ax   = subplot,
                 color = sns.color_palette()[2]
             )
-        else:
-            raise HelpException("plot precisa ser 'box' ou 'violin'")
 
         _ = subplot.axvspan(4.5, 6.5, zorder=0, color=(0, .8, 0, 0.1)) # pyright: ignore[reportUnknownMemberType]   
         _ = subplot.set_xlabel('')                                     # pyright: ignore[reportUnknownMemberType]   
@@ -608,7 +1278,7 @@ class StatsRunner(object):
 
         sns.despine(fig=fig)
 
-        bio = output_fig(fig)
+        bio = self.output_image(fig, 'days')
         lgd = 'Esse gráfico mostra a quantidade de mensagens no grupo por dia da semana!'
         
         return lgd, None, bio
@@ -618,60 +1288,44 @@ class StatsRunner(object):
         user:   Optional[tuple[int, str]] = None,
         start:  Optional[str]             = None,
         end:    Optional[str]             = None
-    ) -> tuple[Optional[str], Optional[bool], Optional[BytesIO]]:
+    ) -> StatsRunnerResult:
         """
         Get plot of messages over the week by day and hour.
         :param lquery: Limit results to lexical query (&, |, !, <n>)
         :param start: Start timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         """
-        query_conditions = []
-        sql_dict = {}
-
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
-
-        if user:
-            sql_dict['user'] = user[0]
-            query_conditions.append("from_user = :user")
+        query_conditions, sql_dict = sql_conditions(lquery=lquery, start=start, end=end, user=user, ts_config=self.ts_config)
 
         query_where = ""
         if query_conditions:
             query_where = f"WHERE {' AND '.join(query_conditions)}"
 
+        # Every (day of week, hour) cell in local time, zero-filled
+        sql_dict['tz'] = self.tz
         query = f"""
-                     SELECT date_trunc('hour', date)
-                         as msg_time, count(*) as messages
-                     FROM messages_utc
-                     {query_where}
-                     GROUP BY msg_time
-                     ORDER BY msg_time
+                     WITH msgs AS (
+                         SELECT extract(ISODOW FROM date AT TIME ZONE :tz)::int as dow,
+                                extract(HOUR FROM date AT TIME ZONE :tz)::int as hour,
+                                count(*) as messages
+                         FROM messages_utc
+                         {query_where}
+                         GROUP BY dow, hour
+                     )
+                     SELECT d.dow, h.hour, coalesce(msgs.messages, 0) as messages
+                     FROM generate_series(1, 7) as d(dow)
+                          CROSS JOIN generate_series(0, 23) as h(hour)
+                          LEFT JOIN msgs ON msgs.dow = d.dow AND msgs.hour = h.hour
+                     ORDER BY h.hour, d.dow
                  """
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)
+        with self.connect() as con:
+            df = self.read_frame(con, text(query), sql_dict)
 
-        if len(df) == 0:
+        if df['messages'].sum() == 0:
             return "Sem mensagens.", None, None
 
-        df['msg_time'] = pd.to_datetime(df.msg_time)
-        df['msg_time'] = df.msg_time.dt.tz_convert(self.tz)
-        df = df.set_index('msg_time')
-        df = df.asfreq('h', fill_value=0)  # Fill periods with no messages
-        df['dow'] = df.index.weekday
-        df['hour'] = df.index.hour
-        df['day_name'] = df.index.day_name()
-        df_grouped = df[['messages', 'hour', 'day_name']].groupby(['hour', 'day_name']).sum().unstack()
-        df_grouped = df_grouped.loc[:, 'messages']
-        df_grouped = df_grouped.reindex(columns=['Monday', 'Tuesday', 'Wednesday', 'Thursday',
-                                                 'Friday', 'Saturday', 'Sunday'])
+        df_grouped = df.pivot(index='hour', columns='dow', values='messages')
+        df_grouped.columns = week_days
 
         row_sums = df_grouped.sum(axis=1)
         df_percent = df_grouped.div(row_sums, axis=0) * 100
@@ -698,7 +1352,7 @@ class StatsRunner(object):
             ax.set_title("Porcentagem de mensagens por dia por hora")
             lgd = 'Nesse gráfico temos a relação das mensagens por hora por dia desde que comecei a contar\!Quanto mais escuro for o quadrado, mais foi falado naquele dia da semana em relação a hora\.'
             
-        bio = output_fig(fig)
+        bio = self.output_image(fig, 'heatmap')
         return lgd, None, bio
 
     def get_message_history(self,
@@ -707,7 +1361,7 @@ class StatsRunner(object):
         averages: Optional[int] = None,
         start:    Optional[str] = None,
         end:      Optional[str] = None,
-    ) -> tuple[Optional[str], Optional[bool], Optional[BytesIO]]:
+    ) -> StatsRunnerResult:
         """
         Make a plot of message history over time
         :param lquery: Limit results to lexical query (&, |, !, <n>)
@@ -715,28 +1369,12 @@ class StatsRunner(object):
         :param start: Start timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         """
-        query_conditions = []
-        sql_dict = {}
+        query_conditions, sql_dict = sql_conditions(lquery=lquery, start=start, end=end, user=user, ts_config=self.ts_config)
 
         if averages:
             if averages < 0:
                 raise HelpException("médias precisam ser>= 0")
 
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
-
-        if user:
-            sql_dict['user'] = user[0]
-            query_conditions.append("from_user = :user")
-
         query_where = ""
         if query_conditions:
             query_where = f"WHERE {' AND '.join(query_conditions)}"
@@ -750,14 +1388,12 @@ class StatsRunner(object):
                     ORDER BY day
                  """
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)
+        with self.connect() as con:
+            df = self.read_frame(con, text(query), sql_dict)
 
         if len(df) == 0:
             return "Sem mensagens correspondentes", None, None
 
-        df['day'] = pd.to_datetime(df.day)
-        df['day'] = df.day.dt.tz_convert(self.tz)
         df = df.set_index('day')
         df = df.resample('1D').sum()
 
@@ -773,9 +1409,15 @@ class StatsRunner(object):
 
         fig = Figure(constrained_layout=True)
         subplot = fig.subplots()
-        df.plot(y='messages', alpha=alpha, legend=False, ax=subplot, color=sns.color_palette()[2])
-        if averages:
-            df.plot(y='msg_rolling', legend=False, ax=subplot)
+        if self.plot_width and len(df) > self.plot_width:
+            plotting.line_plot(subplot, plotting.downsample(df['messages'], self.plot_width), alpha=alpha, color=sns.color_palette()[2])
+            if averages:
+                plotting.line_plot(subplot, plotting.downsample(df['msg_rolling'], self.plot_width))
+            _ = subplot.set_xlim(df.index[0].tz_localize(None), df.index[-1].tz_localize(None))
+        else:
+            df.plot(y='messages', alpha=alpha, legend=False, ax=subplot, color=sns.color_palette()[2])
+            if averages:
+                df.plot(y='msg_rolling', legend=False, ax=subplot)
         subplot.set_ylabel("Mensagens")
         subplot.set_xlabel("Data")
         if lquery:
@@ -787,7 +1429,7 @@ class StatsRunner(object):
         sns.despine(fig=fig)
         fig.tight_layout()
 
-        bio = output_fig(fig)
+        bio = self.output_image(fig, 'history')
 
         return None, None, bio
 
@@ -803,16 +1445,7 @@ class StatsRunner(object):
         :param duration: If true, order by duration instead of time.
         """
         
-        query_conditions = []
-        sql_dict = {}
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
+        query_conditions, sql_dict = sql_conditions(start=start, end=end)
 
         query_where = ""
         if query_conditions:
@@ -825,8 +1458,8 @@ class StatsRunner(object):
                     ORDER BY date;
                  """
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)
+        with self.connect() as con:
+            df = self.read_frame(con, text(query), sql_dict)
 
         if len(df) == 0:
             return "No chat titles in range", None, None
@@ -836,9 +1469,9 @@ class StatsRunner(object):
         df['end'] = df['date'] + df['diff']
 
         if end:
-            last = pd.Timestamp(sql_dict['end_dt'], tz=self.tz).tz_convert('utc')
+            last = pd.Timestamp(sql_dict['end_dt'], tz=self.tz)
         else:
-            last = pd.Timestamp(datetime.utcnow(), tz='utc')
+            last = pd.Timestamp(datetime.utcnow(), tz='utc').tz_convert(self.tz)
 
         df_end = df['end']
         df_end.iloc[-1] = last
@@ -896,7 +1529,7 @@ class StatsRunner(object):
             ax.tick_params(axis='y', which='both', labelleft=False, left=False)
             sns.despine(fig=fig, left=True)
 
-        bio = output_fig(fig)
+        bio = self.output_image(fig, 'titles')
 
         return lgd, False, bio
 
@@ -942,7 +1575,7 @@ class StatsRunner(object):
                      """
         
 
-        with self.engine.connect() as con:
+        with self.connect() as con:
             result = con.execute(text(count_query), sql_dict)
             msg_count: int = result.fetchall()[0][0]
             result = con.execute(text(days_query), sql_dict)
@@ -952,7 +1585,7 @@ class StatsRunner(object):
             result = con.execute(text(username_query), sql_dict)
             name_count: int = result.fetchall()[0][0]
             
-            df_u = pd.read_sql_query(text(type_query), con, params=sql_dict)
+            df_u = self.read_frame(con, text(type_query), sql_dict)
             df_u['User Percent'] = df_u['count'] / df_u['count'].sum() * 100
             df_u.columns = ['type', 'Count', 'Percent']
             
@@ -1003,20 +1636,7 @@ class StatsRunner(object):
         :param n: Show n highest and lowest correlation scores
         :param thresh: Fraction of time bins that have data for both users to be considered valid (0-1)
         """
-        query_conditions = []
-        sql_dict = {}
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
-
-        query_where = ""
-        if query_conditions:
-            query_where = f"WHERE {' AND '.join(query_conditions)}"
+        query_conditions, sql_dict = sql_conditions(start=start, end=end)
 
         if n <= 0:
             raise HelpException(f'n must be greater than 0, got: {n}.')
@@ -1029,65 +1649,73 @@ class StatsRunner(object):
         if not 0 <= thresh <= 1:
             raise HelpException(f'n precisa estar entre [0, 1], solicitado: {n}')
 
+        # Prune messages from before the user's first message
+        first_query = f"""
+                      SELECT date_trunc('hour', min(date))
+                      FROM messages_utc
+                      WHERE {' AND '.join(query_conditions + ["from_user = :user"])};
+                      """
+        with self.connect() as con:
+            user_first_date = con.execute(text(first_query), {**sql_dict, 'user': user[0]}).scalar()
+
+        if user_first_date is None:
+            return 'Sem mensagens na pesquisa.', None, None
+
+        sql_dict['first_dt'] = user_first_date
+        sql_dict['tz'] = self.tz
+        query_conditions.append("date >= :first_dt")
+
         query = f"""
-                SELECT msg_time, extract(ISODOW FROM msg_time) as dow, extract(HOUR FROM msg_time) as hour,
+                SELECT msg_time,
+                       extract(ISODOW FROM msg_time AT TIME ZONE :tz)::int as dow,
+                       extract(HOUR FROM msg_time AT TIME ZONE :tz)::int as hour,
                        "user", messages
                 FROM (
                          SELECT date_trunc('hour', date)
                                          as msg_time,
                                 count(*) as messages, from_user as "user"
                          FROM messages_utc
-                         {query_where}
+                         WHERE {' AND '.join(query_conditions)}
                          GROUP BY msg_time, from_user
-                         ORDER BY msg_time
                      ) t
-                ORDER BY dow, hour;
+                ORDER BY msg_time;
                 """
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)
-
-        if len(df) == 0:
+        # Only users with names can be shown, columns are in self.users order
+        user_ids = np.array(list(self.users.keys()), dtype=np.int64)
+        user_names = [value[0] for value in self.users.values()]
+        me_col = int(np.flatnonzero(user_ids == user[0])[0]) if user[0] in self.users else -1
+        if me_col < 0:
             return 'Sem mensagens na pesquisa.', None, None
 
-        df['msg_time'] = pd.to_datetime(df.msg_time)
-        df['msg_time'] = df.msg_time.dt.tz_convert(self.tz)
-
-        # Prune irrelevant messages (not sure if this actually improves performance)
-        user_first_date = df.loc[df.user == user[0], 'msg_time'].iloc[0]
-        df = df.loc[df.msg_time >= user_first_date]
-
-        df = df.set_index('msg_time')
-
-        user_dict = {'user': {user_id: value[0] for user_id, value in self.users.items()}}
-        df = df.loc[df.user.isin(list(user_dict['user'].keys()))]  # Filter out users with no names
-        df = df.replace(user_dict)  # Replace user ids with names
-        #df['user'] = df['user'].str.replace(r'[^\x00-\x7F]', "", regex=True)
+        chunks = self.read_sql_chunks(text(query), sql_dict)
 
         if agg:
-            df = df.pivot_table(index=['dow', 'hour'], columns='user', values='messages', aggfunc='sum')
-            corrs = []
-            for other_user in df.columns.values:
-                if df[user[1]].sum() / df[other_user].sum() > thresh:
-                    me_notna = df[user[1]].notna()
-                    other_notna = df[other_user].notna()
-                    idx = me_notna | other_notna
-                    corrs.append(df.loc[idx, user[1]].fillna(0).corr(df.loc[idx, other_user].fillna(0)))
-                else:
-                    corrs.append(pd.NA)
-
-            me = pd.Series(corrs, index=df.columns.values).sort_values(ascending=False).iloc[1:].dropna()
+            me = corr_by_hour_of_week(chunks, user_ids, me_col, thresh)
+        elif c_type == 'pearson':
+            me = corr_by_hour(chunks, user_ids, me_col, thresh)
         else:
-            df = df.pivot(columns='user', values='messages')
+            # Rank correlation needs every pairwise-complete sample, so the hour x user matrix is built in memory
+            df = pd.concat(list(chunks), ignore_index=True)
+            if len(df) == 0:
+                return 'Sem mensagens na pesquisa.', None, None
+            df = df.loc[df.user.isin(user_ids)]
+            df = df.pivot(index='msg_time', columns='user', values='messages')
 
             if thresh == 0:
-                df_corr = df.corr(method=c_type)
+                df_corr = df.corrwith(df[user[0]], method=c_type)
             else:
-                df_corr = df.corr(method=c_type, min_periods=int(thresh * len(df)))
-            me = df_corr[user[1]].sort_values(ascending=False).iloc[1:].dropna()
+                df_corr = df.corr(method=c_type, min_periods=int(thresh * len(df)))[user[0]]
+            me = df_corr.drop(index=user[0], errors='ignore')
+
+        if me is None:
+            return 'Sem mensagens na pesquisa.', None, None
+
+        me.index = [user_names[int(np.flatnonzero(user_ids == uid)[0])] for uid in me.index]
+        me = me.dropna().sort_values(ascending=False)
 
         if len(me) < 1:
-            return "`Desculpa, poucos dados, tente com -aggtimes, diminuir -thresh, ou usando um período de tempo maior.`", None
+            return "`Desculpa, poucos dados, tente com -aggtimes, diminuir -thresh, ou usando um período de tempo maior.`", None, None
 
         if n > len(me) // 2:
             n = int(len(me) // 2)
@@ -1115,19 +1743,7 @@ class StatsRunner(object):
         :param n: Show n highest and lowest correlation scores
         :param thresh: Only consider users with at least this many message group pairs with you
         """
-        query_conditions = []
-        sql_dict = {}
-
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
+        query_conditions, sql_dict = sql_conditions(lquery=lquery, start=start, end=end, ts_config=self.ts_config)
 
         query_where = ""
         if query_conditions:
@@ -1163,7 +1779,7 @@ class StatsRunner(object):
             sql_dict['me'] = me
             sql_dict['other'] = other
 
-            with self.engine.connect() as con:
+            with self.connect() as con:
                 result = con.execute(text(query), sql_dict)
             output: tuple[timedelta, int] = result.fetchall()[0]
 
@@ -1186,68 +1802,82 @@ class StatsRunner(object):
         return f"**Tempo médio entre as mensagens de {escape_markdown(user[1])} e:**\n```\n{out_text}\n```", None, None
 
     def get_type_stats(self,
-        start: Optional[str] = None,
-        end:   Optional[str] = None,
-        autouser             = None,
+        start:  Optional[str] = None,
+        end:    Optional[str] = None,
+        approx: bool          = False,
+        autouser              = None,
         **kwargs
     ) -> StatsRunnerResult:
         """
         Print table of message statistics by type.
         :param start: Start timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
+        :param approx: Estimate from a sample of the messages, much faster for long periods
         """
         user: tuple[int, str] = kwargs['user']
-        query_conditions = []
-        sql_dict = {}
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
+        query_conditions, sql_dict = sql_conditions(start=start, end=end)
 
         query_where = ""
         if query_conditions:
             query_where = f" AND {' AND '.join(query_conditions)}"
 
-        query = f"""
-                    SELECT type, count(*) as count
-                    FROM messages_utc
-                    WHERE type NOT IN ('new_chat_members', 'left_chat_member', 'new_chat_photo',
-                                       'new_chat_title', 'migrate_from_group', 'pinned_message')
-                          {query_where}
-                    GROUP BY type
-                    ORDER BY count DESC;
-                 """
+        excluded_types = """type NOT IN ('new_chat_members', 'left_chat_member', 'new_chat_photo',
+                                         'new_chat_title', 'migrate_from_group', 'pinned_message')"""
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(text(query), con, params=sql_dict)
+        estimate = None
+        if approx:
+            estimate = self.estimate_counts('type', [excluded_types] + query_conditions, sql_dict)
+
+        if estimate:
+            df = estimate.counts.rename_axis('type').reset_index()
+            df = df.rename(columns={'error': 'Group ±'})
+        else:
+            query = f"""
+                        SELECT type, count(*) as count
+                        FROM messages_utc
+                        WHERE {excluded_types}
+                              {query_where}
+                        GROUP BY type
+                        ORDER BY count DESC;
+                     """
+
+            with self.connect() as con:
+                df = self.read_frame(con, text(query), sql_dict)
 
         if len(df) == 0:
             return 'Sem mensagens no período', None, None
 
         df['Group Percent'] = df['count'] / df['count'].sum() * 100
-        df.columns = ['type', 'Group Count', 'Group Percent']
+        df = df.rename(columns={'count': 'Group Count'})[
+            ['type', 'Group Count', 'Group Percent'] + (['Group ±'] if estimate else [])
+        ]
 
+        user_estimate = None
         if user:
             sql_dict['user'] = user[0]
             query_conditions.append("from_user = :user")
 
-            query = f"""
-                        SELECT type, count(*) as user_count
-                        FROM messages_utc
-                        WHERE type NOT IN ('new_chat_members', 'left_chat_member', 'new_chat_photo',
-                                           'new_chat_title', 'migrate_from_group', 'pinned_message')
-                              AND {' AND '.join(query_conditions)}
-                        GROUP BY type
-                        ORDER BY user_count DESC;
-                     """
-            with self.engine.connect() as con:
-                df_u = pd.read_sql_query(text(query), con, params=sql_dict)
+            if estimate:
+                user_estimate = self.estimate_counts('type', [excluded_types] + query_conditions, sql_dict)
+
+            if user_estimate:
+                df_u = user_estimate.counts.rename_axis('type').reset_index()
+                df_u = df_u.rename(columns={'count': 'user_count', 'error': 'User ±'})
+            else:
+                query = f"""
+                            SELECT type, count(*) as user_count
+                            FROM messages_utc
+                            WHERE {excluded_types}
+                                  AND {' AND '.join(query_conditions)}
+                            GROUP BY type
+                            ORDER BY user_count DESC;
+                         """
+                with self.connect() as con:
+                    df_u = self.read_frame(con, text(query), sql_dict)
             df_u['User Percent'] = df_u['user_count'] / df_u['user_count'].sum() * 100
-            df_u.columns = ['type', 'User Count', 'User Percent']
+            df_u = df_u.rename(columns={'user_count': 'User Count'})[
+                ['type', 'User Count', 'User Percent'] + (['User ±'] if user_estimate else [])
+            ]
 
             df = df.merge(df_u, on="type", how="outer")
 
@@ -1260,12 +1890,19 @@ class StatsRunner(object):
         except KeyError:
             pass
 
+        # The margin of the total isn't the sum of the margins
+        for column, est in (('Group ±', estimate), ('User ±', user_estimate)):
+            if est:
+                df.loc[df.index[-1], column] = est.total_error
+                df[column] = df[column].astype('Int64')
+
         out_text = df.to_string(index=False, header=True, float_format=lambda x: f"{x:.1f}")
 
+        note = f"\n{approx_note(estimate.percent)}" if estimate else ""
         if user:
-            return f"**Mensagens por tipo - {escape_markdown(user[1])} vs grupo:**\n```\n{out_text}\n```", None, None
+            return f"**Mensagens por tipo - {escape_markdown(user[1])} vs grupo:**\n```\n{out_text}\n```{note}", None, None
         else:
-            return f"**Mensagens por tipo:**\n```\n{out_text}\n```", None, None
+            return f"**Mensagens por tipo:**\n```\n{out_text}\n```{note}", None, None
 
     def get_word_stats(self,
         n:     int = 4,
@@ -1273,7 +1910,7 @@ class StatsRunner(object):
         start: Optional[str] = None,
         end:   Optional[str] = None,
         user:  Optional[tuple[int, str]] = None,
-    ) -> tuple[str, None, None]:
+    ) -> StatsRunnerResult:
         """
         Print table of lexeme statistics.
         :param n: Only consider lexemes with length of at least n
@@ -1281,7 +1918,16 @@ class StatsRunner(object):
         :param start: Start timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         """
+        return render_table(self.words_table(n, limit, start, end, user))
 
+    def words_table(self,
+        n:     int = 4,
+        limit: int = 20,
+        start: Optional[str] = None,
+        end:   Optional[str] = None,
+        user:  Optional[tuple[int, str]] = None,
+    ) -> TableResult:
+        """Table of get_word_stats."""
         tsquery = select(Message.text_index_col)
 
         if user:
@@ -1314,24 +1960,18 @@ class StatsRunner(object):
         if limit:
             stmt = stmt.limit(limit)
 
-        with self.engine.connect() as con:
-            df = pd.read_sql_query(stmt, con) # pyright: ignore[reportUnknownMemberType]
+        with self.connect() as con:
+            df = self.read_frame(con, stmt)
 
         if len(df) == 0:
-            return 'No messages in range', None, None
+            return 'No messages in range'
 
         df.columns = ['Lexeme', 'Messages', 'Uses']
 
-        out_text = df.to_string( # pyright: ignore[reportUnknownMemberType]
-            index  = False,
-            header = True,
-            float_format = lambda x: f"{x:.1f}"
-        )
-
         if user:
-            return f"**Most frequently used lexemes, {escape_markdown(user[1].lstrip('@'))}\n```\n{out_text}\n```", None, None
+            return Table(f"**Most frequently used lexemes, {escape_markdown(user[1].lstrip('@'))}\n", df)
         else:
-            return f"**Most frequently used lexemes, all users:**\n```\n{out_text}\n```", None, None
+            return Table("**Most frequently used lexemes, all users:**\n", df)
 
     def get_random_message(self,
         lquery: Optional[str] = None,
@@ -1345,23 +1985,7 @@ class StatsRunner(object):
         :param start: Start timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
         """
-        query_conditions = []
-        sql_dict = {}
-
-        if lquery:
-            query_conditions.append(f"text_index_col @@ to_tsquery( {random_quote(lquery)} )")
-
-        if user:
-            sql_dict['user'] = user[0]
-            query_conditions.append("from_user = :user")
-
-        if start:
-            sql_dict['start_dt'] = pd.to_datetime(start)
-            query_conditions.append("date >= :start_dt")
-
-        if end:
-            sql_dict['end_dt'] = pd.to_datetime(end)
-            query_conditions.append("date < :end_dt")
+        query_conditions, sql_dict = sql_conditions(lquery=lquery, start=start, end=end, user=user, ts_config=self.ts_config)
 
         query_where = ""
         if query_conditions:
@@ -1376,7 +2000,7 @@ class StatsRunner(object):
                     LIMIT 1;
                 """
 
-        with self.engine.connect() as con:
+        with self.connect() as con:
             result = con.execute(text(query), sql_dict)
         try:
             date, from_user, out_text = result.fetchall()[0]
@@ -1390,8 +2014,109 @@ class StatsRunner(object):
             + f"{escape_markdown(out_text)}\n"
         ), None, None
 
+    def get_message_search(self,
+        lquery: str = "",
+        start:  Optional[str] = None,
+        end:    Optional[str] = None,
+        user:   Optional[tuple[int, str]] = None,
+    ) -> StatsRunnerResult:
+        """
+        Search messages, best matches first.
+        :param lquery: Lexical query (&, |, !, <n>)
+        :param start: Start timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
+        :param end: End timestamp (e.g. 2019, 2019-01, 2019-01-01, "2019-01-01 14:21")
+        """
+        return self.search_page(lquery, start, end, user).text, True, None
+
+    def search_page(self,
+        lquery: str,
+        start:  Optional[str]             = None,
+        end:    Optional[str]             = None,
+        user:   Optional[tuple[int, str]] = None,
+        after:  Optional[SearchKey]       = None,
+    ) -> SearchPage:
+        """
+        One page of messages matching lquery, ordered by (rank, date, message_id) descending.
+        Pages are read with keyset pagination: the page after a key only looks at matches
+        ranked below it, so later pages cost the same as the first one.
+        :param after: next_key of the previous page
+        """
+        if not lquery:
+            raise HelpException("search precisa de um -lquery, por exemplo: /stats search -lquery 'gato & preto'")
+
+        query_conditions, sql_dict = sql_conditions(start=start, end=end, user=user)
+        sql_dict['lquery']    = lquery
+        sql_dict['ts_config'] = self.ts_config
+        sql_dict['limit']     = self.search_page_size + 1  # One more tells if there is a next page
+        sql_dict['headline_options'] = f"MaxWords=30, MinWords=12, StartSel={headline_start}, StopSel={headline_stop}"
+
+        if after:
+            sql_dict['after_rank'], sql_dict['after_date'], sql_dict['after_id'] = after
+            query_conditions.append("(ts_rank(text_index_col, query), date, message_id) "
+                                    "< (CAST(:after_rank AS real), :after_date, :after_id)")
+
+        query_where = ""
+        if query_conditions:
+            query_where = f"AND {' AND '.join(query_conditions)}"
+
+        # Headlines are only made for the hits on the page
+        query = f"""
+                SELECT hits.rank, hits.date, hits.message_id, hits.from_user,
+                       ts_headline(CAST(:ts_config AS regconfig), hits.text, hits.query, :headline_options) as headline
+                FROM (
+                    SELECT ts_rank(text_index_col, query) as rank, date, message_id, from_user, text, query
+                    FROM messages_utc, to_tsquery(CAST(:ts_config AS regconfig), :lquery) as query
+                    WHERE text_index_col @@ query
+                          AND date IS NOT NULL AND message_id IS NOT NULL
+                          {query_where}
+                    ORDER BY rank DESC, date DESC, message_id DESC
+                    LIMIT :limit
+                ) hits
+                ORDER BY hits.rank DESC, hits.date DESC, hits.message_id DESC
+                """
+
+        with self.connect() as con:
+            rows = con.execute(text(query), sql_dict).all()
+
+        if not rows:
+            return SearchPage("Sem mais resultados" if after else "Nenhuma mensagem correspondente", None)
+
+        next_key = None
+        if len(rows) > self.search_page_size:
+            rows = rows[:self.search_page_size]
+            next_key = rows[-1].rank, rows[-1].date, rows[-1].message_id
+
+        hits = []
+        for row in rows:
+            date     = pd.Timestamp(row.date).tz_convert(self.tz).strftime('%d/%m/%Y %H:%M')
+            name     = self.users.get(row.from_user, (str(row.from_user),))[0].lstrip('@')
+            headline = escape_markdown(row.headline).replace(headline_start, '*').replace(headline_stop, '*')
+            hits.append(f"*{escape_markdown(date)}* {escape_markdown(name)}: {headline}")
+
+        return SearchPage(f"*Mensagens com {escape_markdown(lquery)}:*\n\n" + "\n\n".join(hits), next_key)
+
 
 def get_parser(runner: StatsRunner) -> InternalParser:
+    """
+    The runner's /stats parser. It is built once, walking the signatures and docstrings of
+    allowed_methods, together with the parsed arguments of each subcommand without options.
+    """
+    if runner.parser is None:
+        parser = build_parser(runner)
+        parser.fast_paths = {tuple(args): vars(parser.parse_args(args))
+                             for args in [[]] + [[name] for name, func in runner.allowed_methods.items() if hasattr(runner, func)]}
+        runner.parser = parser
+    return runner.parser
+
+
+def argument_type(annotation: Any) -> Any:
+    """Type of an option from its parameter's annotation, Optional[X] parses as X."""
+    if get_origin(annotation) is Union:
+        return next(a for a in get_args(annotation) if a is not type(None))
+    return annotation
+
+
+def build_parser(runner: StatsRunner) -> InternalParser:
     parser = InternalParser(prog="/stats")
     parser.set_defaults(func=runner.get_chat_counts)
     subparsers = parser.add_subparsers(title="Statistics:")
@@ -1438,14 +2163,18 @@ def get_parser(runner: StatsRunner) -> InternalParser:
                         if match:
                             arg_doc = match.group(1)
 
-                if isinstance(arg.annotation, bool): # pyright: ignore[reportAny]
-                    _ = subparser.add_argument(f"-{arg.name}".replace('_', '-'),
-                        action = 'store_true',
+                arg_type = argument_type(arg.annotation)
+                if arg_type is bool: # pyright: ignore[reportAny]
+                    # Flags that default to on are turned off with -no-<name>
+                    on_by_default = arg.default is True
+                    _ = subparser.add_argument(f"-{'no-' if on_by_default else ''}{arg.name}".replace('_', '-'),
+                        dest   = arg.name,
+                        action = 'store_false' if on_by_default else 'store_true',
                         help   = arg_doc,
                     )
                 else:
                     _ = subparser.add_argument(f"-{arg.name}".replace('_', '-'),
-                        type = arg.annotation, # pyright: ignore[reportAny] 
+                        type = arg_type, # pyright: ignore[reportAny] 
                         help = arg_doc,
                         default = arg.default, # pyright: ignore[reportAny] 
                     )
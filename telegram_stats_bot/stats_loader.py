@@ -0,0 +1,87 @@
+# !/usr/bin/env python
+#
+# A logging and statistics bot for Telegram based on python-telegram-bot.
+# Copyright (C) 2020
+# Michael DM Dryden <mk.dryden@utoronto.ca>
+#
+# This file is part of telegram-stats-bot.
+#
+# telegram-stats-bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser Public License for more details.
+#
+# You should have received a copy of the GNU Public License
+# along with this program. If not, see [http://www.gnu.org/licenses/].
+"""
+Deferred start of the stats engine.
+
+Importing stats brings in pandas, numpy, matplotlib and seaborn, which takes seconds, and
+creating the StatsRunner queries the database. Neither is needed to log messages, so the bot
+starts without them: the runner is created in a worker thread the first time a handler asks
+for it, or by the warm-up job once polling has started.
+"""
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Any, Optional
+
+from sqlalchemy import Engine
+
+from telegram_stats_bot import global_vars
+from telegram_stats_bot.utils import NameCache
+
+if TYPE_CHECKING:
+    from telegram_stats_bot.stats import StatsRunner
+
+logger = logging.getLogger(__name__)
+
+engine:  Optional[Engine] = None
+options: dict[str, Any]   = {}  # StatsRunner keyword arguments
+warmup:  Optional[float]  = 1   # Seconds after startup to load the runner in the background, None to wait for a command
+
+loading: Optional['asyncio.Future[StatsRunner]'] = None
+
+
+def configure(stats_engine: Engine, stats_warmup: Optional[float] = 1, **kwargs: Any):
+    """Sets the arguments of the StatsRunner, created by get_stats()."""
+    global engine, options, warmup
+    engine  = stats_engine
+    options = kwargs
+    warmup  = stats_warmup
+
+
+def load() -> 'StatsRunner':
+    """Imports the stats engine and creates the runner, blocking."""
+    assert engine != None
+
+    started = time.perf_counter()
+    from telegram_stats_bot.stats import StatsRunner
+    imported = time.perf_counter()
+    runner = StatsRunner(engine, **options)
+    logger.info("Stats engine imported in %.2f s and started in %.2f s",
+                imported - started, time.perf_counter() - imported)
+    return runner
+
+
+async def start() -> 'StatsRunner':
+    runner = await asyncio.to_thread(load)
+    global_vars.stats      = runner
+    global_vars.name_cache = NameCache(runner.users)
+    return runner
+
+
+async def get_stats() -> 'StatsRunner':
+    """The StatsRunner, loading it on first use. Concurrent callers wait for the same load."""
+    global loading
+    if global_vars.stats is not None:
+        return global_vars.stats
+
+    if loading is None or (loading.done() and loading.exception() is not None):  # Retry a failed load
+        loading = asyncio.ensure_future(start())
+    return await asyncio.shield(loading)
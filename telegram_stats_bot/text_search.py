@@ -0,0 +1,203 @@
+# !/usr/bin/env python
+#
+# A logging and statistics bot for Telegram based on python-telegram-bot.
+# Copyright (C) 2020
+# Michael DM Dryden <mk.dryden@utoronto.ca>
+#
+# This file is part of telegram-stats-bot.
+#
+# telegram-stats-bot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser Public License for more details.
+#
+# You should have received a copy of the GNU Public License
+# along with this program. If not, see [http://www.gnu.org/licenses/].
+"""
+Online rebuild of the full text search column of messages_utc.
+
+messages_utc.text_index_col is kept up to date by the messages_utc_text_index trigger and
+the text search configuration it uses is stored as the column's comment, so the stats
+queries can parse lexical queries with the same configuration. A rebuild fills a new column
+next to the live one, indexes it concurrently and swaps the two in one short transaction,
+so logging and stats keep working while it runs.
+"""
+import datetime
+import logging
+import re
+import time
+from typing import Iterator, Optional
+
+import typer
+from psycopg.errors import LockNotAvailable
+from sqlalchemy import Connection, Engine, create_engine, text
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger(__name__)
+
+default_ts_config = 'english'  # Configuration of the generated column created by the initial migration
+
+config_name = re.compile(r"^[A-Za-z_][A-Za-z0-9_.]*$")
+
+lock_timeout  = '2s'  # Longest we make logging wait for a DDL lock, on timeout we back off and retry
+lock_attempts = 30
+
+
+def column_comment(con: Connection, column: str) -> Optional[str]:
+    return con.execute(text("""
+        SELECT col_description(attrelid, attnum)
+        FROM pg_attribute
+        WHERE attrelid = 'messages_utc'::regclass AND attname = :column AND NOT attisdropped
+    """), {'column': column}).scalar()
+
+
+def get_ts_config(con: Connection) -> str:
+    """Text search configuration of text_index_col."""
+    return column_comment(con, 'text_index_col') or default_ts_config
+
+
+def check_config(con: Connection, config: str) -> str:
+    """Validates a text search configuration name, which is then safe to use as a literal."""
+    if not config_name.match(config):
+        raise ValueError(f"Invalid text search configuration {config!r}")
+    return con.execute(text("SELECT CAST(:config AS regconfig)::text"), {'config': config}).scalar_one()
+
+
+def trigger_ddl(column: str, name: str, config: str) -> str:
+    """Function and trigger setting column for inserted rows and edited texts."""
+    return f"""
+        CREATE OR REPLACE FUNCTION {name}() RETURNS trigger LANGUAGE plpgsql AS $f$
+        BEGIN
+            NEW.{column} := to_tsvector('{config}'::regconfig, coalesce(NEW.text, ''));
+            RETURN NEW;
+        END
+        $f$;
+        DROP TRIGGER IF EXISTS {name} ON messages_utc;
+        CREATE TRIGGER {name} BEFORE INSERT OR UPDATE OF text ON messages_utc
+            FOR EACH ROW EXECUTE FUNCTION {name}();
+    """
+
+
+def with_lock_timeout(con: Connection, statement: str):
+    """
+    Runs DDL that needs a strong lock on messages_utc with a short lock_timeout, so it never
+    queues every insert behind a long running stats query for more than a moment.
+    """
+    _ = con.execute(text(f"SET lock_timeout = '{lock_timeout}'"))
+    try:
+        for attempt in range(lock_attempts):
+            try:
+                _ = con.execute(text(statement))
+                return
+            except OperationalError as e:
+                if not isinstance(e.orig, LockNotAvailable) or attempt == lock_attempts - 1:
+                    raise
+                logger.info("messages_utc is busy, retrying")
+                time.sleep(min(2 ** attempt, 30))
+    finally:
+        _ = con.execute(text("RESET lock_timeout"))
+
+
+def date_ranges(con: Connection, days: int) -> Iterator[tuple[datetime.datetime, datetime.datetime]]:
+    first, last = con.execute(text("SELECT min(date), max(date) FROM messages_utc")).one()
+    if first is None:
+        return
+    step = datetime.timedelta(days=days)
+    lo = first
+    while lo <= last:
+        yield lo, lo + step
+        lo += step
+
+
+def rebuild(con: Connection, config: str, batch_days: int = 7):
+    """
+    Rebuilds text_index_col with a text search configuration without blocking messages_utc.
+    1. Adds text_index_new and a trigger filling it for new and edited messages
+    2. Backfills it batch_days of messages per transaction
+    3. Builds its GIN index with CREATE INDEX CONCURRENTLY
+    4. Replaces text_index_col and text_idx with them in one transaction
+    :param con: Connection in autocommit mode
+    :param config: Text search configuration, e.g. portuguese
+    :param batch_days: Days of messages updated per transaction
+    """
+    config = check_config(con, config)
+
+    # An interrupted rebuild resumes where it stopped, unless it was for another configuration
+    previous = column_comment(con, 'text_index_new')
+    if previous and previous != config:
+        with_lock_timeout(con, "ALTER TABLE messages_utc DROP COLUMN text_index_new")
+
+    with_lock_timeout(con, f"""
+        DO $new$
+        BEGIN
+            ALTER TABLE messages_utc ADD COLUMN IF NOT EXISTS text_index_new tsvector;
+            COMMENT ON COLUMN messages_utc.text_index_new IS '{config}';
+            {trigger_ddl('text_index_new', 'messages_utc_text_index_new', config)}
+        END
+        $new$
+    """)
+
+    fill = f"""
+        UPDATE messages_utc
+        SET text_index_new = to_tsvector('{config}'::regconfig, coalesce(text, ''))
+        WHERE text_index_new IS NULL
+    """
+    for lo, hi in date_ranges(con, batch_days):
+        result = con.execute(text(fill + " AND date >= :lo AND date < :hi"), {'lo': lo, 'hi': hi})
+        logger.info("Indexed %d messages before %s", result.rowcount, hi)
+    # Messages without a date, and any row a batch raced with
+    result = con.execute(text(fill))
+    logger.info("Indexed %d remaining messages", result.rowcount)
+
+    # A failed concurrent build leaves an invalid index behind
+    _ = con.execute(text("DROP INDEX CONCURRENTLY IF EXISTS text_idx_new"))
+    _ = con.execute(text("CREATE INDEX CONCURRENTLY text_idx_new ON messages_utc USING gin (text_index_new)"))
+    logger.info("Built text_idx_new")
+
+    # Every row has text_index_new by now: backfilled, or set by the trigger since it was created
+    with_lock_timeout(con, f"""
+        DO $swap$
+        BEGIN
+            LOCK TABLE messages_utc IN ACCESS EXCLUSIVE MODE;
+            ALTER TABLE messages_utc DROP COLUMN text_index_col;
+            ALTER TABLE messages_utc RENAME COLUMN text_index_new TO text_index_col;
+            ALTER INDEX text_idx_new RENAME TO text_idx;
+            DROP TRIGGER messages_utc_text_index_new ON messages_utc;
+            DROP FUNCTION messages_utc_text_index_new();
+            {trigger_ddl('text_index_col', 'messages_utc_text_index', config)}
+            COMMENT ON COLUMN messages_utc.text_index_col IS '{config}';
+        END
+        $swap$
+    """)
+    logger.info("text_index_col now uses %s", config)
+
+
+def main(
+    db_url:     str,
+    config:     str,
+    batch_days: int = 7,
+):
+    """
+    Rebuild the full text search index with another text search configuration, online.
+    Restart the bot afterwards so its queries use the new configuration.
+    :param db_url: Sqlalchemy-compatible postgresql url
+    :param config: Text search configuration (e.g. portuguese, english, simple)
+    :param batch_days: Days of messages updated per transaction
+    """
+    logging.basicConfig(level=logging.INFO)
+
+    if db_url.startswith('postgresql://'):
+        db_url = db_url.replace('postgresql://', 'postgresql+psycopg://', 1)
+    engine: Engine = create_engine(db_url, echo=False, isolation_level="AUTOCOMMIT")
+
+    with engine.connect() as con:
+        rebuild(con, config, batch_days)
+
+
+if __name__ == '__main__':
+    typer.run(main)
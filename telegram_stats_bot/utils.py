@@ -18,11 +18,13 @@
 #
 # You should have received a copy of the GNU Public License
 # along with this program. If not, see [http://www.gnu.org/licenses/].
+import asyncio
 import string
 import secrets
 import re
 import datetime
-from typing import Any
+import time
+from typing import Any, Optional
 from typing_extensions import override
 from sqlalchemy import Column, Integer, Text
 from sqlalchemy.ext.compiler import compiles
@@ -30,6 +32,10 @@ from sqlalchemy.sql.functions import FunctionElement
 from sqlalchemy.sql.base import ColumnCollection
 
 
+# Choices of StatsRunner options, kept here so the command line is parsed without importing the stats engine
+image_formats = ('png', 'webp', 'jpeg')
+render_modes  = ('auto', 'seaborn', 'aggregate')
+
 md_match = re.compile(r"(\[[^][]*]\(http[^()]*\))|([_*[\]()~>#+-=|{}.!\\])")
 
 
@@ -81,3 +87,73 @@ def is_valid_date(date_string, date_format="%d/%m/%Y"):
         return True
     except ValueError:
         return False
+
+
+class TokenBucket(object):
+    """
+    Async token bucket allowing rate acquisitions per second with bursts of up to capacity.
+    pause() blocks every acquirer for a while, e.g. when the API asks us to back off.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate     = rate
+        self.capacity = capacity
+        self.tokens   = capacity
+        self.updated  = time.monotonic()
+        self.paused_until = 0.
+        self.lock = asyncio.Lock()
+
+    def refill(self, now: float):
+        self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.refill(now)
+        self.tokens = 0
+
+
+class NameCache(object):
+    """
+    Last known (username, display name) of each user, filled from incoming updates.
+    Changes are queued until drain() so they can be written in one batch.
+    """
+    def __init__(self, known: dict[int, tuple[str, str]]):
+        self.known = dict(known)
+        self.pending: dict[int, tuple[str, Optional[str]]] = {}
+        self.seen: set[int] = set()
+
+    def observe(self, user_id: int, username: str, display_name: str):
+        self.seen.add(user_id)
+        old = self.known.get(user_id)
+        if old == (username, display_name):
+            return
+        self.known[user_id] = username, display_name
+
+        if old is not None and old[1] == display_name and self.pending.get(user_id, (None, None))[1] is None:
+            self.pending[user_id] = username, None  # Only the username changed, don't insert a new row
+        else:
+            self.pending[user_id] = username, display_name
+
+    def drain(self) -> dict[int, tuple[str, Optional[str]]]:
+        """Returns and clears the changes observed since the last call."""
+        pending, self.pending = self.pending, {}
+        return pending
+
+    def take_seen(self) -> set[int]:
+        """Returns and clears the users observed since the last call."""
+        seen, self.seen = self.seen, set()
+        return seen
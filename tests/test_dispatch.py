@@ -0,0 +1,188 @@
+import asyncio
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+from telegram_stats_bot import dispatch
+from telegram_stats_bot.dispatch import AdmissionController, Overloaded, SingleFlight, freeze, run_method
+
+
+def test_single_flight_coalesces():
+    flights: SingleFlight[int] = SingleFlight()
+    calls = []
+
+    async def compute() -> int:
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def main():
+        first  = asyncio.ensure_future(flights.run('key', compute))
+        second = asyncio.ensure_future(flights.run('key', compute))
+        other  = asyncio.ensure_future(flights.run('other', compute))
+        await asyncio.sleep(0.01)
+        _ = first.cancel()  # Leaving receiver doesn't cancel the shared call
+        return await second, await other
+
+    assert asyncio.run(main()) == (42, 42)
+    assert len(calls) == 2
+    assert flights.calls == {}
+
+
+def test_freeze_is_order_independent():
+    assert freeze({'a': 1, 'user': (1, '@u'), 'lquery': ' x '}) == freeze({'lquery': 'x', 'user': [1, '@u'], 'a': 1})
+
+
+def test_admission_priority_and_budgets():
+    controller = AdmissionController(global_budget=4, user_budget=4, max_queue=2, max_wait=1)
+    order = []
+
+    async def request(user_id: int, cost: int, name: str, hold: float = 0.05):
+        async with controller.slot(user_id, cost):
+            order.append(name)
+            await asyncio.sleep(hold)
+
+    async def main():
+        running   = asyncio.ensure_future(request(1, 4, 'running'))
+        await asyncio.sleep(0.01)
+        expensive = asyncio.ensure_future(request(2, 4, 'expensive'))
+        await asyncio.sleep(0.01)
+        cheap     = asyncio.ensure_future(request(3, 1, 'cheap'))
+        await asyncio.sleep(0.01)
+
+        with pytest.raises(Overloaded):  # Queue full
+            await request(4, 1, 'refused')
+        with pytest.raises(Overloaded):  # User 1 is over budget
+            await request(1, 1, 'refused')
+
+        await asyncio.gather(running, expensive, cheap)
+
+    asyncio.run(main())
+    assert order == ['running', 'cheap', 'expensive']
+    assert controller.in_use == 0 and not controller.user_in_use
+
+
+def test_admission_timeout():
+    controller = AdmissionController(global_budget=1, user_budget=1, max_queue=4, max_wait=0.05)
+
+    async def main():
+        async with controller.slot(1, 1):
+            with pytest.raises(Overloaded):
+                async with controller.slot(2, 1):
+                    pass
+
+    asyncio.run(main())
+    assert controller.in_use == 0 and not controller.user_in_use
+
+
+def test_single_flight_cancels_abandoned_call():
+    flights: SingleFlight[int] = SingleFlight()
+    cancelled = []
+
+    async def compute() -> int:
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+        return 1
+
+    async def main():
+        receiver = asyncio.ensure_future(flights.run('key', compute))
+        await asyncio.sleep(0.01)
+        _ = receiver.cancel()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    assert cancelled == [1]
+    assert flights.calls == {}
+
+
+def test_admission_forgets_cancelled_waiters():
+    controller = AdmissionController(global_budget=1, user_budget=1, max_queue=1, max_wait=1)
+
+    async def main():
+        async with controller.slot(1, 1):
+            waiting = asyncio.ensure_future(controller.slot(2, 1).__aenter__())
+            await asyncio.sleep(0.01)
+            _ = waiting.cancel()
+            await asyncio.sleep(0.01)
+            assert controller.queue == []
+
+            queued = asyncio.ensure_future(controller.slot(3, 1).__aenter__())  # Not refused as a full queue
+            await asyncio.sleep(0.01)
+            assert len(controller.queue) == 1
+            _ = queued.cancel()
+            await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    assert controller.in_use == 0 and not controller.user_in_use
+
+
+class FakeScope(object):
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeRunner(object):
+    def __init__(self):
+        self.release = threading.Event()
+        self.scope   = FakeScope()
+
+    @contextmanager
+    def scoped(self, method: str):
+        yield self.scope
+
+    def get_chat_counts(self, n: int = 5) -> int:
+        _ = self.release.wait(5)
+        return 1
+
+
+def test_slot_held_until_worker_returns(monkeypatch):
+    controller = AdmissionController(global_budget=4, user_budget=4, max_queue=4, max_wait=1)
+    monkeypatch.setattr(dispatch, 'admission', controller)
+    runner = FakeRunner()
+
+    async def main():
+        task = asyncio.ensure_future(run_method(runner.get_chat_counts, {}, 1))
+        await asyncio.sleep(0.05)
+        _ = task.cancel()
+        await asyncio.sleep(0.05)
+        assert runner.scope.cancelled
+        assert controller.in_use > 0  # The thread is still running
+
+        runner.release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.05)
+
+    asyncio.run(main())
+    assert controller.in_use == 0 and not controller.user_in_use
+
+
+def test_replacing_request_admitted_while_worker_runs(monkeypatch):
+    controller = AdmissionController(global_budget=8, user_budget=4, max_queue=4, max_wait=1)
+    monkeypatch.setattr(dispatch, 'admission', controller)
+    runner = FakeRunner()
+
+    async def main():
+        # corr costs the whole user budget
+        first = asyncio.ensure_future(run_method(runner.get_chat_counts, {}, 1, method='get_user_correlation'))
+        await asyncio.sleep(0.05)
+        _ = first.cancel()
+        second = asyncio.ensure_future(run_method(runner.get_chat_counts, {'n': 1}, 1, method='get_user_correlation'))
+        await asyncio.sleep(0.05)
+        assert controller.in_use == 8  # Both threads hold their global share
+        assert controller.user_in_use[1] == 4
+
+        runner.release.set()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        assert await second == 1
+
+    asyncio.run(main())
+    assert controller.in_use == 0 and not controller.user_in_use
@@ -0,0 +1,44 @@
+import datetime
+from datetime import timezone
+
+from telegram_stats_bot.export import is_complete, month_ranges, read_manifest, write_manifest
+
+month = datetime.datetime(2023, 1, 1, tzinfo=timezone.utc)
+columns = ['date', 'from_user', 'type']
+
+
+def manifest(start: datetime.datetime, end: datetime.datetime, written_at: datetime.datetime,
+             cols: list[str] = columns) -> dict:
+    return {'start': start.isoformat(), 'end': end.isoformat(), 'columns': cols, 'written_at': written_at.isoformat()}
+
+
+def test_month_ranges():
+    ranges = list(month_ranges(month + datetime.timedelta(days=10), datetime.datetime(2023, 3, 5, tzinfo=timezone.utc)))
+    assert [lo.day for lo, _ in ranges] == [11, 1, 1]
+    assert ranges[0][1] == datetime.datetime(2023, 2, 1, tzinfo=timezone.utc)
+
+
+def test_manifest_roundtrip(tmp_path):
+    path = str(tmp_path / 'month=2023-01' / 'part-0.parquet')
+    assert read_manifest(path) is None
+
+    (tmp_path / 'month=2023-01').mkdir()
+    data = manifest(month, datetime.datetime(2023, 2, 1, tzinfo=timezone.utc), datetime.datetime.now(timezone.utc))
+    write_manifest(path, data)
+    assert read_manifest(path) == data
+
+
+def test_is_complete():
+    next_month = datetime.datetime(2023, 2, 1, tzinfo=timezone.utc)
+    later = datetime.datetime(2023, 3, 1, tzinfo=timezone.utc)
+
+    assert is_complete(manifest(month, next_month, later), month, columns)
+    assert not is_complete(None, month, columns)
+    # Started after the beginning of the month (--start)
+    assert not is_complete(manifest(month + datetime.timedelta(days=3), next_month, later), month, columns)
+    # Stopped before its end (--end)
+    assert not is_complete(manifest(month, next_month - datetime.timedelta(days=3), later), month, columns)
+    # Different --columns
+    assert not is_complete(manifest(month, next_month, later, columns[:2]), month, columns)
+    # Written while the month was still open
+    assert not is_complete(manifest(month, next_month, month + datetime.timedelta(days=20)), month, columns)
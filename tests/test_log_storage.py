@@ -0,0 +1,68 @@
+import datetime
+import gzip
+import json
+import os
+
+import pytest
+
+from telegram_stats_bot.log_storage import JSONStore
+
+
+def read_segments(path, name) -> list[dict]:
+    lines = []
+    for fname in sorted(os.listdir(path)):
+        if not fname.startswith(name + '.'):
+            continue
+        opener = gzip.open if fname.endswith('.gz') else open
+        with opener(os.path.join(path, fname), 'rt') as f:
+            lines += [json.loads(line) for line in f]
+    return lines
+
+
+def test_append_legacy(tmp_path):
+    store = JSONStore(str(tmp_path))
+    store.append_data('messages', {'message_id': 1, 'date': datetime.datetime(2020, 1, 1)})
+    store.append_data('messages', {'message_id': 2, 'date': datetime.datetime(2020, 1, 2)})
+
+    with open(tmp_path / 'messages.json') as f:
+        assert [json.loads(line)['message_id'] for line in f] == [1, 2]
+
+
+@pytest.mark.parametrize('fsync', ['message', 'rotate', 0, 1000])
+def test_segmented_fsync(tmp_path, fsync):
+    store = JSONStore(str(tmp_path), segmented=True, fsync=fsync)
+    for n in range(10):
+        store.append_data('messages', {'message_id': n, 'date': datetime.datetime(2020, 1, 1)})
+    store.close()
+
+    assert [m['message_id'] for m in read_segments(tmp_path, 'messages')] == list(range(10))
+
+
+def test_segmented_rotate_compress(tmp_path):
+    store = JSONStore(str(tmp_path), segmented=True, rotate_size=100, compression='gzip')
+    for n in range(20):
+        store.append_data('messages', {'message_id': n, 'date': datetime.datetime(2020, 1, 1)})
+    store.append_data('user_events', {'message_id': 1, 'event': 'joined'})
+    store.close()
+
+    files = os.listdir(tmp_path)
+    assert all(f.endswith('.json.gz') for f in files)
+    assert len([f for f in files if f.startswith('messages.')]) > 1
+    assert [m['message_id'] for m in read_segments(tmp_path, 'messages')] == list(range(20))
+    assert len(read_segments(tmp_path, 'user_events')) == 1
+
+
+def test_segmented_restart_continues_sequence(tmp_path):
+    for _ in range(2):
+        store = JSONStore(str(tmp_path), segmented=True)
+        store.append_data('messages', {'message_id': 1})
+        store.close()
+
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_invalid_options(tmp_path):
+    with pytest.raises(ValueError):
+        JSONStore(str(tmp_path), compression='lzma')
+    with pytest.raises(ValueError):
+        JSONStore(str(tmp_path), fsync='sometimes')
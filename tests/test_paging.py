@@ -0,0 +1,111 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional
+
+import pandas as pd
+
+from telegram_stats_bot.paging import FramePager, KeysetPager, TTLCache, tables
+from telegram_stats_bot.stats import SearchKey, SearchPage, Table
+
+
+def test_ttl_cache_expiry_and_lru():
+    cache: TTLCache[str, int] = TTLCache(ttl=0.05, max_items=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1  # 'b' is now the least recently used
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+    time.sleep(0.06)
+    assert cache.get('a') is None
+    assert len(cache) == 1
+    cache.expire()
+    assert len(cache) == 0
+
+
+def test_ttl_cache_memory_bound():
+    cache: TTLCache[str, bytes] = TTLCache(ttl=60, max_items=10, max_bytes=10, sizeof=len)
+    assert cache.put('a', b'1234')
+    assert cache.put('b', b'1234')
+    assert cache.put('c', b'1234')  # Evicts 'a'
+    assert cache.get('a') is None and cache.bytes == 8
+    assert not cache.put('d', b'12345678901')
+    assert len(cache) == 2
+
+
+class FakeScope(object):
+    def cancel(self):
+        pass
+
+
+class FakeRunner(object):
+    """Pages of 2 over hits ranked 9..0."""
+    hits = [(float(rank), datetime(2020, 1, 1, tzinfo=timezone.utc), rank) for rank in range(9, -1, -1)]
+
+    def __init__(self):
+        self.calls: list[Optional[SearchKey]] = []
+
+    @contextmanager
+    def scoped(self, method: str):
+        yield FakeScope()
+
+    def get_message_search(self, lquery: str):
+        raise AssertionError("Paged commands run their page method")
+
+    def counts_table(self, n: int):
+        return Table("", pd.DataFrame({'User': [f"u{i}" for i in range(n)], 'Messages': range(n)}))
+
+    def search_page(self, lquery: str, after: Optional[SearchKey] = None) -> SearchPage:
+        self.calls.append(after)
+        rows = [hit for hit in self.hits if after is None or hit < after][:3]
+        next_key = rows[1] if len(rows) > 2 else None
+        return SearchPage(",".join(str(hit[2]) for hit in rows[:2]), next_key)
+
+
+def test_keyset_pager():
+    runner = FakeRunner()
+    pager  = KeysetPager('search', 'get_message_search', 'search_page')
+
+    async def main():
+        text, markup = await pager.open(runner.get_message_search, {'lquery': 'x'}, user_id=1)
+        assert text.startswith("9,8")
+        assert markup != None
+        token = markup.inline_keyboard[0][0].callback_data.split(':')[1]
+
+        pages = [text]
+        for index in range(1, 5):
+            reply = await pager.turn(token, index, user_id=1)
+            assert reply != None
+            pages.append(reply[0])
+        assert [page.split('\n')[0] for page in pages] == ["9,8", "7,6", "5,4", "3,2", "1,0"]
+        assert reply[1] != None and len(reply[1].inline_keyboard[0]) == 1  # Only "previous" on the last page
+
+        back = await pager.turn(token, 1, user_id=1)
+        assert back != None and back[0].startswith("7,6")
+        assert runner.calls[-1] == runner.hits[1]
+        assert await pager.turn('missing', 0, user_id=1) is None
+
+    asyncio.run(main())
+
+
+def test_frame_pager():
+    runner = FakeRunner()
+    pager  = FramePager('counts', 'counts_table', 'counts_table', page_rows=4)
+
+    async def main():
+        text, markup = await pager.open(runner.counts_table, {'n': 3}, user_id=1)
+        assert markup is None and "u2" in text
+
+        text, markup = await pager.open(runner.counts_table, {'n': 10}, user_id=1)
+        assert markup != None and "u3" in text and "u4" not in text
+        token = markup.inline_keyboard[0][0].callback_data.split(':')[1]
+        assert token in tables.items
+
+        last = await pager.turn(token, 2, user_id=1)
+        assert last != None and "u9" in last[0] and "u7" not in last[0]
+        assert last[1] != None and last[1].inline_keyboard[0][0].callback_data == f"counts:{token}:1"
+
+    asyncio.run(main())
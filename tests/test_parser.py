@@ -0,0 +1,42 @@
+from telegram_stats_bot.stats import StatsRunner, build_parser, get_parser
+
+
+class ParserRunner(StatsRunner):
+    """Only what the parser needs, no database."""
+    def __init__(self):
+        pass
+
+
+def test_parser_is_built_once():
+    runner = ParserRunner()
+    assert get_parser(runner) is get_parser(runner)
+
+
+def test_fast_paths_match_argparse():
+    runner = ParserRunner()
+    parser = get_parser(runner)
+    reference = build_parser(runner)
+
+    for args in [[]] + [[name] for name in runner.allowed_methods]:
+        assert tuple(args) in parser.fast_paths
+        assert parser.parse_command(args) == vars(reference.parse_args(args))
+
+    parsed = parser.parse_command(['counts'])
+    _ = parsed.pop('func')
+    assert 'func' in parser.parse_command(['counts'])  # Callers get a copy
+
+    assert parser.parse_command(['counts', '-n', '200']) == vars(reference.parse_args(['counts', '-n', '200']))
+
+
+def test_optional_options_parse_as_their_type():
+    parser = get_parser(ParserRunner())
+    parsed = parser.parse_command(['hours', '-start', '2024-01', '-approx'])
+    assert parsed['start'] == '2024-01' and parsed['approx'] is True
+    assert parser.parse_command(['corr', '-c-type', 'spearman'])['c_type'] == 'spearman'
+
+
+def test_bool_options_keep_their_defaults():
+    parser = get_parser(ParserRunner())
+    assert parser.parse_command(['corr'])['agg'] is True
+    assert parser.parse_command(['corr', '-no-agg'])['agg'] is False
+    assert parser.parse_command(['hours'])['approx'] is False
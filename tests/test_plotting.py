@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from telegram_stats_bot.plotting import kde_grid, lttb, sample_points
+
+
+def test_kde_grid_matches_exact_kde():
+    values = np.random.default_rng(0).poisson(120, 2000).astype(float)
+    support, density = kde_grid(values)
+
+    bw = values.std(ddof=1) * len(values) ** (-1 / 5)
+    exact = np.exp(-0.5 * ((support[:, None] - values[None, :]) / bw) ** 2).sum(axis=1)
+
+    assert support[0] == values.min() and support[-1] == values.max()
+    assert density / density.max() == pytest.approx(exact / exact.max(), abs=0.02)
+
+
+def test_sample_points_is_capped():
+    groups = [np.arange(n, dtype=float) for n in (10, 5000, 20000)]
+
+    sample = sample_points(groups, max_points=1000)
+    assert sum(len(g) for g in sample) == pytest.approx(1000, abs=len(groups))
+    assert len(sample[2]) > len(sample[1]) > len(sample[0])
+
+    assert sample_points(groups[:1], max_points=1000)[0] is groups[0]
+
+
+def test_lttb_keeps_ends_and_peaks():
+    x = np.arange(10000, dtype=float)
+    y = np.sin(x / 500)
+    y[4321] = 50  # Spike must survive
+
+    kept = lttb(x, y, 200)
+    assert len(kept) == 200
+    assert kept[0] == 0 and kept[-1] == len(x) - 1
+    assert np.all(np.diff(kept) > 0)
+    assert 4321 in kept
+
+    assert len(lttb(x[:100], y[:100], 200)) == 100
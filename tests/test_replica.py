@@ -0,0 +1,98 @@
+"""
+Read replica routing, mostly against a primary and a streaming replica given by
+TSB_PRIMARY_URL and TSB_REPLICA_URL (see "Read Replica" in the README). The primary must
+have the bot's tables.
+"""
+import os
+import threading
+import time
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from telegram_stats_bot.stats import StatsRunner
+
+primary_url = os.environ.get('TSB_PRIMARY_URL')
+replica_url = os.environ.get('TSB_REPLICA_URL')
+
+requires_replica = pytest.mark.skipif(not (primary_url and replica_url), reason="needs TSB_PRIMARY_URL and TSB_REPLICA_URL")
+
+
+@pytest.fixture
+def engines():
+    primary = create_engine(primary_url, isolation_level="AUTOCOMMIT")
+    replica = create_engine(replica_url, isolation_level="AUTOCOMMIT")
+    yield primary, replica
+    primary.dispose()
+    replica.dispose()
+
+
+@requires_replica
+def test_reads_go_to_replica(engines):
+    primary, replica = engines
+    sr = StatsRunner(primary, read_engine=replica, max_replica_lag=30)
+
+    assert sr.replica_lag() < 30
+    with sr.connect() as con:
+        assert con.execute(text("SELECT pg_is_in_recovery()")).scalar_one()
+    with sr.connect(primary=True) as con:
+        assert not con.execute(text("SELECT pg_is_in_recovery()")).scalar_one()
+
+
+@requires_replica
+def test_lagging_replica_falls_back(engines):
+    primary, replica = engines
+    sr = StatsRunner(primary, read_engine=replica, max_replica_lag=0)
+
+    def write():
+        with primary.connect() as con:
+            _ = con.execute(text("CREATE TABLE IF NOT EXISTS replica_lag_probe(x int)"))
+            _ = con.execute(text("INSERT INTO replica_lag_probe VALUES (1)"))
+
+    write()  # So the replica has a replay timestamp
+    time.sleep(1)
+    with replica.connect() as con:
+        _ = con.execute(text("SELECT pg_wal_replay_pause()"))
+    try:
+        write()
+        time.sleep(1)
+
+        assert sr.replica_lag() > 0
+        with sr.connect() as con:
+            assert not con.execute(text("SELECT pg_is_in_recovery()")).scalar_one()
+    finally:
+        with replica.connect() as con:
+            _ = con.execute(text("SELECT pg_wal_replay_resume()"))
+        with primary.connect() as con:
+            _ = con.execute(text("DROP TABLE replica_lag_probe"))
+
+
+def test_slow_lag_check_doesnt_block_readers():
+    primary, replica = object(), object()
+    sr = StatsRunner.__new__(StatsRunner)  # Without a database
+    sr.engine, sr.read_engine = primary, replica  # pyright: ignore[reportAttributeAccessIssue]
+    sr.max_replica_lag  = 30
+    sr.replica_ok       = True
+    sr.replica_checked  = float('-inf')
+    sr.replica_checking = False
+    sr.replica_lock     = threading.Lock()
+
+    measuring, release = threading.Event(), threading.Event()
+
+    def replica_lag() -> float:
+        measuring.set()
+        _ = release.wait(5)
+        return 60
+
+    sr.replica_lag = replica_lag
+    checker = threading.Thread(target=sr.reader)
+    checker.start()
+    assert measuring.wait(5)
+
+    start = time.monotonic()
+    assert sr.reader() is replica  # Last decision while the check is running
+    assert time.monotonic() - start < 1
+
+    release.set()
+    checker.join()
+    assert sr.reader() is primary
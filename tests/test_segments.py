@@ -0,0 +1,83 @@
+import datetime
+from datetime import timedelta, timezone
+
+import pytest
+
+from telegram_stats_bot.log_storage import JSONStore
+from telegram_stats_bot.segments import SegmentReader, segment_paths
+
+pytest.importorskip('msgpack')
+
+start_date = datetime.datetime(2020, 1, 1, tzinfo=timezone.utc)
+n_rows = 1000
+
+
+@pytest.fixture
+def segment(tmp_path) -> str:
+    store = JSONStore(str(tmp_path), segmented=True, fmt='msgpack')
+    for n in range(n_rows):
+        store.append_data('messages', {'message_id': n, 'date': start_date + timedelta(hours=n), 'text': str(n)})
+    store.close()
+
+    paths = segment_paths(str(tmp_path), 'messages')
+    assert len(paths) == 1
+    return paths[0]
+
+
+def test_read_all(segment):
+    with SegmentReader(segment) as reader:
+        assert [r['message_id'] for r in reader] == list(range(n_rows))
+
+
+def test_date_range(segment):
+    with SegmentReader(segment) as reader:
+        records = list(reader.date_range(start_date + timedelta(hours=300), start_date + timedelta(hours=310)))
+    assert [r['message_id'] for r in records] == list(range(300, 310))
+
+
+def test_date_range_open_ended(segment):
+    with SegmentReader(segment) as reader:
+        assert len(list(reader.date_range(start=start_date + timedelta(hours=n_rows - 5)))) == 5
+        assert len(list(reader.date_range(end=start_date + timedelta(hours=5)))) == 5
+
+
+def test_message(segment):
+    with SegmentReader(segment) as reader:
+        assert reader.message(777)['text'] == '777'
+        assert reader.message(n_rows + 1) is None
+
+
+def test_bounds_include_last_record(segment):
+    with SegmentReader(segment) as reader:
+        first, last = reader.bounds()
+    assert last - first == (n_rows - 1) * 3600 * 10**6
+
+
+def test_truncated_tail(segment):
+    with open(segment, 'ab') as f:
+        f.write(b'\xff\x00\x00\x00partial')
+
+    with SegmentReader(segment) as reader:
+        assert len(list(reader)) == n_rows
+
+
+def test_out_of_order_edits(tmp_path):
+    store = JSONStore(str(tmp_path), segmented=True, fmt='msgpack')
+    edits = [(n * 7) % 50 for n in range(50)]  # Edits of older messages arrive in any order
+    for n in edits:
+        store.append_data('edited-messages', {'message_id': n, 'date': start_date + timedelta(hours=n), 'text': str(n)})
+    store.close()
+
+    path, = segment_paths(str(tmp_path), 'edited-messages')
+    with SegmentReader(path) as reader:
+        assert not reader.ordered and reader.bounds() is None
+        records = list(reader.date_range(start_date + timedelta(hours=10), start_date + timedelta(hours=20)))
+        assert sorted(r['message_id'] for r in records) == list(range(10, 20))
+        assert all(reader.message(n)['text'] == str(n) for n in range(50))
+
+
+def test_msgpack_options(tmp_path):
+    with pytest.raises(ValueError):
+        JSONStore(str(tmp_path), fmt='msgpack')
+    with pytest.raises(ValueError):
+        JSONStore(str(tmp_path), segmented=True, fmt='msgpack', compression='gzip')
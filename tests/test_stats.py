@@ -1,5 +1,7 @@
 from io import BytesIO
 
+from sqlalchemy import create_engine, text
+
 from tests.conftest import n_users, n_rows, user_table
 from telegram_stats_bot.stats import StatsRunner, HelpException
 
@@ -15,6 +17,19 @@ def test_get_message_user_ids(sr):
     assert set(sr.get_message_user_ids()) == set(range(len(user_table)))
 
 
+def test_read_sql_chunks_on_autocommit_engine(db_connection):
+    engine = create_engine(db_connection.url, isolation_level="AUTOCOMMIT", pool_size=1)  # As log_storage creates it
+    sr = StatsRunner(engine, read_budget=128 * 700)
+
+    chunks = list(sr.read_sql_chunks(text("SELECT message_id FROM messages_utc ORDER BY message_id")))
+    assert len(chunks) > 1
+    assert sum(len(chunk) for chunk in chunks) == n_rows
+
+    with sr.connect() as con:  # Same pooled connection, back in autocommit
+        assert con.connection.driver_connection.autocommit
+    engine.dispose()
+
+
 def test_get_db_users(sr):
     for k, v in sr.get_db_users().items():
         username, display_name = v
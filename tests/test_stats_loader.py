@@ -0,0 +1,37 @@
+import asyncio
+import time
+
+from telegram_stats_bot import global_vars, stats_loader
+
+
+class FakeRunner(object):
+    users = {1: ('@u', 'U')}
+
+
+def test_concurrent_callers_share_one_load(monkeypatch):
+    loads = []
+
+    def load():
+        loads.append(1)
+        time.sleep(0.05)
+        if len(loads) == 1:
+            raise ConnectionError("database is starting")
+        return FakeRunner()
+
+    monkeypatch.setattr(stats_loader, 'load', load)
+    monkeypatch.setattr(stats_loader, 'loading', None)
+    monkeypatch.setattr(global_vars, 'stats', None)
+    monkeypatch.setattr(global_vars, 'name_cache', None)
+
+    async def main():
+        failed = await asyncio.gather(stats_loader.get_stats(), stats_loader.get_stats(), return_exceptions=True)
+        assert all(isinstance(e, ConnectionError) for e in failed)
+
+        first, second = await asyncio.gather(stats_loader.get_stats(), stats_loader.get_stats())  # Retried
+        assert first is second
+        assert await stats_loader.get_stats() is first
+
+    asyncio.run(main())
+    assert len(loads) == 2
+    assert isinstance(global_vars.stats, FakeRunner)
+    assert global_vars.name_cache != None and global_vars.name_cache.known == FakeRunner.users
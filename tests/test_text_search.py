@@ -0,0 +1,17 @@
+import pytest
+
+from telegram_stats_bot.text_search import check_config, trigger_ddl
+
+
+def test_config_names_are_checked_before_use():
+    # Rejected without touching the connection, the name ends up in DDL as a literal
+    for config in ("english'; DROP TABLE messages_utc; --", "pt-br", ""):
+        with pytest.raises(ValueError):
+            _ = check_config(None, config)  # pyright: ignore[reportArgumentType]
+
+
+def test_trigger_ddl():
+    ddl = trigger_ddl('text_index_new', 'messages_utc_text_index_new', 'portuguese')
+    assert "NEW.text_index_new := to_tsvector('portuguese'::regconfig" in ddl
+    assert "BEFORE INSERT OR UPDATE OF text ON messages_utc" in ddl
+    assert "EXECUTE FUNCTION messages_utc_text_index_new()" in ddl
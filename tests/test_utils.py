@@ -0,0 +1,19 @@
+from telegram_stats_bot.utils import NameCache
+
+
+def test_name_cache_changes():
+    cache = NameCache({1: ('@a', 'A')})
+
+    cache.observe(1, '@a', 'A')
+    assert cache.drain() == {}
+
+    cache.observe(1, '@b', 'A')
+    cache.observe(2, 'X', 'X')
+    assert cache.drain() == {1: ('@b', None), 2: ('X', 'X')}
+
+    # A display name change queued earlier is kept when the username changes later
+    cache.observe(1, '@b', 'B')
+    cache.observe(1, '@c', 'B')
+    assert cache.drain() == {1: ('@c', 'B')}
+    assert cache.take_seen() == {1, 2}
+    assert cache.take_seen() == set()